@@ -0,0 +1,311 @@
+from TreeShaker import SplitFunctions
+
+# Where the VM keeps its segments in the Hack RAM
+segment_registers = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS',
+                     'that': 'THAT'}
+fixed_segments = {'temp': 5, 'pointer': 3}
+stack_base = 256
+
+# The largest index of a segment entry reached by incrementing A from the
+# segment's base, rather than by adding the index (which pop can only do
+# through R13)
+max_push_steps = 2
+max_pop_steps = 6
+
+binary_assignments = {'add': "M=D+M", 'sub': "M=M-D", 'and': "M=D&M",
+                      'or': "M=D|M"}
+unary_assignments = {'neg': "M=-M", 'not': "M=!M"}
+
+# Constants the ALU computes without loading them into A first
+alu_constants = {0: "0", 1: "1"}
+
+
+def Parse(line):
+    return line.split('//', 1)[0].split()
+
+
+def PushD(operand="D"):
+    return ["@SP", "AM=M+1", "A=A-1", "M=" + operand]
+
+
+def PopD():
+    return ["@SP", "AM=M-1", "D=M"]
+
+
+def ComparisonRoutine(command, jump):
+    """
+    The shared routine of lt or gt: pops y and replaces x with x < y (or
+    x > y), then jumps to the return address in D. x - y would overflow
+    when x and y have different signs, so then the sign of x decides.
+    """
+    name = "$" + command
+    negative_x = "true" if command == 'lt' else "false"
+    positive_x = "false" if command == 'lt' else "true"
+    return ["({0})".format(name),
+            "@R15", "M=D",  # The return address
+            "@SP", "AM=M-1", "D=M", "@R14", "M=D",  # y
+            "@SP", "A=M-1", "D=M",  # x
+            "@{0}.negative".format(name), "D;JLT",
+            "@R14", "D=M", "@{0}.same".format(name), "D;JGE",
+            "@{0}.{1}".format(name, positive_x), "0;JMP",
+            "({0}.negative)".format(name),
+            "@R14", "D=M", "@{0}.same".format(name), "D;JLT",
+            "@{0}.{1}".format(name, negative_x), "0;JMP",
+            "({0}.same)".format(name),  # x - y can't overflow
+            "@R14", "D=M", "@SP", "A=M-1", "D=M-D",
+            "@{0}.true".format(name), "D;" + jump,
+            "({0}.false)".format(name),
+            "@SP", "A=M-1", "M=0", "@R15", "A=M", "0;JMP",
+            "({0}.true)".format(name),
+            "@SP", "A=M-1", "M=-1", "@R15", "A=M", "0;JMP"]
+
+
+class AssemblyWriter(object):
+    """
+    Translates the VM code of a whole program into Hack assembly.
+
+    Instead of expanding every VM command on its own, it uses what the
+    commands around it tell: a push followed by a pop moves the value
+    through D without touching the stack, a push followed by add, sub,
+    and, or or if-goto works on the pushed value in D, constants 0 and 1
+    come from the ALU, and segment entries at small indices are reached
+    by incrementing A. Calls, returns, lt and gt jump to routines shared
+    by the whole program (one call routine per argument count), so each
+    costs a few instructions at its site.
+
+    bootstrap: start the code by setting SP and calling Sys.init (or
+    Main.main, if the program has no Sys.init, and then stopping).
+    """
+
+    def __init__(self, bootstrap=False):
+        self.bootstrap = bootstrap
+        self.call_routines = set()  # Argument counts
+        self.comparisons = set()
+        self.uses_return = False
+        self.label_index = 0
+        self.called = set()
+
+    def Translate(self, vm_code):
+        """
+        vm_code: {class name: [lines]} for the whole program. Returns
+        the assembly lines.
+        """
+        functions = []
+        for class_name in sorted(vm_code):
+            for name, lines in SplitFunctions(vm_code[class_name]):
+                functions.append((class_name, name, lines))
+
+        code = []
+        names = set(name for class_name, name, lines in functions)
+        if self.bootstrap:
+            entry = "Sys.init" if "Sys.init" in names else "Main.main"
+            code += ["@{0}".format(stack_base), "D=A", "@SP", "M=D"]
+            code += self.Call("$bootstrap", entry, 0)
+            code += ["($halt)", "@$halt", "0;JMP"]
+
+        for class_name, name, lines in functions:
+            commands = [Parse(line) for line in lines]
+            code += self.TranslateFunction(class_name, name,
+                                           [words for words in commands
+                                            if words])
+        code += self.Routines()
+
+        # The assembler would take a missing function for a variable
+        missing = sorted(self.called - names)
+        if missing:
+            raise Exception("Function {0} is called but not defined (are "
+                            "the OS .vm files missing?)".format(missing[0]))
+        return code
+
+    def TranslateFunction(self, class_name, name, commands):
+        self.class_name = class_name
+        self.function = name
+        code = []
+        i = 0
+        while i < len(commands):
+            consumed, lines = self.TranslatePair(commands[i:i + 2])
+            if consumed == 0:
+                lines = self.TranslateCommand(commands[i])
+                consumed = 1
+            code += lines
+            i += consumed
+        return code
+
+    def TranslatePair(self, pair):
+        """
+        Translates two commands together, when they make one of the
+        combinations handled specially. Returns (commands consumed,
+        lines); consumed is 0 when they don't.
+        """
+        if len(pair) < 2:
+            return 0, []
+        first, second = pair
+        if first[0] == 'push':
+            load, operand = self.Load(first[1], int(first[2]))
+            if second[0] == 'pop':
+                setup, store = self.Store(second[1], int(second[2]))
+                store[-1] = "M=" + operand
+                return 2, setup + load + store
+            if second[0] in ('add', 'sub') and operand == "1":
+                return 2, ["@SP", "A=M-1",
+                           "M=M+1" if second[0] == 'add' else "M=M-1"]
+            if second[0] in binary_assignments:
+                if operand != "D":
+                    load = ["D=" + operand]
+                return 2, load + ["@SP", "A=M-1",
+                                  binary_assignments[second[0]]]
+            if second[0] == 'if-goto':
+                if operand != "D":  # Always or never jumps
+                    return 2, (["@" + self.Label(second[1]), "0;JMP"]
+                               if operand != "0" else [])
+                return 2, load + ["@" + self.Label(second[1]), "D;JNE"]
+        if first[0] == 'eq' and second[0] == 'if-goto':
+            return 2, PopD() + ["@SP", "AM=M-1", "D=M-D",
+                                "@" + self.Label(second[1]), "D;JEQ"]
+        if first[0] == 'not' and second[0] == 'if-goto':
+            # not x is true unless x is -1
+            return 2, PopD() + ["@" + self.Label(second[1]), "D+1;JNE"]
+        return 0, []
+
+    def TranslateCommand(self, words):
+        command = words[0]
+        if command == 'push':
+            load, operand = self.Load(words[1], int(words[2]))
+            return load + PushD(operand)
+        if command == 'pop':
+            setup, store = self.Store(words[1], int(words[2]))
+            return setup + PopD() + store
+        if command in binary_assignments:
+            return PopD() + ["A=A-1", binary_assignments[command]]
+        if command in unary_assignments:
+            return ["@SP", "A=M-1", unary_assignments[command]]
+        if command == 'eq':
+            done = self.NewLabel()
+            return PopD() + ["A=A-1", "D=M-D", "M=0", "@" + done, "D;JNE",
+                             "@SP", "A=M-1", "M=-1", "({0})".format(done)]
+        if command in ('lt', 'gt'):
+            self.comparisons.add(command)
+            back = self.NewLabel()
+            return ["@" + back, "D=A", "@$" + command, "0;JMP",
+                    "({0})".format(back)]
+        if command == 'label':
+            return ["({0})".format(self.Label(words[1]))]
+        if command == 'goto':
+            return ["@" + self.Label(words[1]), "0;JMP"]
+        if command == 'if-goto':
+            return PopD() + ["@" + self.Label(words[1]), "D;JNE"]
+        if command == 'function':
+            return self.Function(words[1], int(words[2]))
+        if command == 'call':
+            return self.Call(self.function, words[1], int(words[2]))
+        if command == 'return':
+            self.uses_return = True
+            return ["@$return", "0;JMP"]
+        raise Exception("Unknown VM command " + command)
+
+    def Load(self, segment, index):
+        """
+        Returns (lines, operand): the lines put the value of a segment
+        entry in D, and operand is "D", or the ALU constant that stands
+        for the value (with no lines).
+        """
+        if segment == 'constant':
+            if index in alu_constants:
+                return [], alu_constants[index]
+            return ["@{0}".format(index), "D=A"], "D"
+        if segment in segment_registers:
+            base = segment_registers[segment]
+            if index == 0:
+                return ["@" + base, "A=M", "D=M"], "D"
+            if index <= max_push_steps:
+                return (["@" + base, "A=M+1"] + ["A=A+1"] * (index - 1) +
+                        ["D=M"], "D")
+            return ["@{0}".format(index), "D=A", "@" + base, "A=D+M",
+                    "D=M"], "D"
+        return ["@" + self.Address(segment, index), "D=M"], "D"
+
+    def Store(self, segment, index):
+        """
+        Returns (setup, lines): the setup lines come before the value is
+        put in D (they may use D), and the lines store D in the segment
+        entry. The last line is always "M=D".
+        """
+        if segment in segment_registers:
+            base = segment_registers[segment]
+            if index == 0:
+                return [], ["@" + base, "A=M", "M=D"]
+            if index <= max_pop_steps:
+                return [], (["@" + base, "A=M+1"] + ["A=A+1"] * (index - 1) +
+                            ["M=D"])
+            return (["@{0}".format(index), "D=A", "@" + base, "D=D+M",
+                     "@R13", "M=D"], ["@R13", "A=M", "M=D"])
+        if segment == 'constant':
+            raise Exception("Can't pop to constant")
+        return [], ["@" + self.Address(segment, index), "M=D"]
+
+    def Address(self, segment, index):
+        """
+        The symbol or address of a temp, pointer or static entry.
+        """
+        if segment == 'static':
+            return "{0}.{1}".format(self.class_name, index)
+        if segment in fixed_segments:
+            return str(fixed_segments[segment] + index)
+        raise Exception("Unknown segment " + segment)
+
+    def Function(self, name, nVars):
+        code = ["({0})".format(name)]
+        if nVars:
+            code += ["@SP", "A=M", "M=0"]
+            code += ["A=A+1", "M=0"] * (nVars - 1)
+            code += ["D=A+1", "@SP", "M=D"]
+        return code
+
+    def Call(self, caller, function, nArgs):
+        """
+        Jumps to the shared call routine for nArgs with the function in
+        R13 and the return address in D.
+        """
+        self.call_routines.add(nArgs)
+        self.called.add(function)
+        self.label_index += 1
+        back = "{0}$ret.{1}".format(caller, self.label_index)
+        return ["@" + function, "D=A", "@R13", "M=D", "@" + back, "D=A",
+                "@$call.{0}".format(nArgs), "0;JMP", "({0})".format(back)]
+
+    def Label(self, label):
+        return "{0}${1}".format(self.function, label)
+
+    def NewLabel(self):
+        self.label_index += 1
+        return "{0}$asm.{1}".format(self.function, self.label_index)
+
+    def Routines(self):
+        """
+        The shared routines the translated code jumps to.
+        """
+        code = []
+        for nArgs in sorted(self.call_routines):
+            code.append("($call.{0})".format(nArgs))
+            code += PushD()  # The return address
+            for register in ("LCL", "ARG", "THIS", "THAT"):
+                code += ["@" + register, "D=M"] + PushD()
+            code += ["@SP", "D=M", "@LCL", "M=D",
+                     "@{0}".format(nArgs + 5), "D=D-A", "@ARG", "M=D",
+                     "@R13", "A=M", "0;JMP"]
+
+        if self.uses_return:
+            code += ["($return)",
+                     "@LCL", "D=M", "@R13", "M=D",  # The frame
+                     "@5", "A=D-A", "D=M", "@R14", "M=D"]  # Return address
+            code += PopD() + ["@ARG", "A=M", "M=D",
+                              "@ARG", "D=M+1", "@SP", "M=D"]
+            for register in ("THAT", "THIS", "ARG", "LCL"):
+                code += ["@R13", "AM=M-1", "D=M", "@" + register, "M=D"]
+            code += ["@R14", "A=M", "0;JMP"]
+
+        if 'lt' in self.comparisons:
+            code += ComparisonRoutine('lt', "JLT")
+        if 'gt' in self.comparisons:
+            code += ComparisonRoutine('gt', "JGT")
+        return code
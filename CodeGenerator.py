@@ -0,0 +1,524 @@
+from SymbolTable import (SymbolTable, CategoryUtils, SymbolTableEntry,
+                         Categories)
+from JackAST import (IntegerConstant, VarRef, ArrayRef, SubroutineCall,
+                     UnaryOp, BinaryOp)
+
+
+op_symbols = {'+': 'add',
+              '-': 'sub',
+              '*': 'call Math.multiply 2',
+              '/': 'call Math.divide 2',
+              '&': 'and',
+              '|': 'or',
+              '<': 'lt',
+              '>': 'gt',
+              '=': 'eq'}
+
+unary_symbols = {'-': 'neg',
+                 '~': 'not'}
+
+# Longest inline sequence a multiplication by a constant other than a
+# power of two is replaced with; Math.multiply costs hundreds of steps.
+max_multiply_sequence = 20
+
+
+def ConstantOperand(node):
+    """
+    Returns the value of an operand that is an integer constant or a
+    negated one, or None.
+    """
+    if isinstance(node, IntegerConstant):
+        return node.value
+    if isinstance(node, UnaryOp) and node.op == '-' and \
+            isinstance(node.operand, IntegerConstant):
+        return -node.operand.value
+    return None
+
+
+def HasCalls(node):
+    """
+    Can evaluating the expression have side effects, i.e. does it call
+    a subroutine?
+    """
+    if isinstance(node, SubroutineCall):
+        return True
+    if isinstance(node, BinaryOp):
+        return HasCalls(node.left) or HasCalls(node.right)
+    if isinstance(node, UnaryOp):
+        return HasCalls(node.operand)
+    if isinstance(node, ArrayRef):
+        return HasCalls(node.index)
+    return False
+
+
+def MultiplySequence(operand, factor):
+    """
+    Returns VM code that turns x, on top of the stack, into x * factor
+    (factor >= 2), modulo 2^16 like Math.multiply. operand is a line
+    that pushes x again. Either adds x factor - 1 times, or doubles the
+    product for each bit of factor after the first (through temp 2) and
+    adds x for the set ones, whichever is shorter.
+    """
+    chain = [operand, "add"] * (factor - 1)
+
+    doubling = []
+    for bit in bin(factor)[3:]:
+        if doubling:
+            doubling += ["pop temp 2", "push temp 2", "push temp 2", "add"]
+        else:  # The product is still x
+            doubling += [operand, "add"]
+        if bit == '1':
+            doubling += [operand, "add"]
+
+    return min(chain, doubling, key=len)
+
+
+class CodeGenerator(object):
+    """
+    Generates the VM code of one class from its AST. Every node type has
+    a Visit<NodeType> method; statements and expressions append their
+    code to self.code.
+    """
+
+    def __init__(self, class_symbol_tables, type_size_map, optimizations=()):
+        """
+        optimizations: the code generation optimizations to apply, out of
+        "strength" (strength reduction of * and / by constants),
+        "strings" (string literal pooling), "offsets" (constant array
+        indices as offsets of the that segment) and "tailcalls" (self-
+        recursive tail calls as jumps).
+        """
+        self.class_symbol_tables = class_symbol_tables
+        self.optimizations = optimizations
+        self.type_size_map = type_size_map
+        self.local_symbol_table = None
+        self.current_class_name = None
+        self.current_sub_name = None
+        self.current_sub_node = None
+        self.code = []
+        self.unique_label_index = 0
+
+        # Pooled string literals: {literal: static index}, the first
+        # static used by the pool, and whether the current subroutine
+        # uses it
+        self.string_pool = {}
+        self.string_pool_base = 0
+        self.uses_string_pool = False
+
+        # The label a tail call of the current subroutine jumps to, once
+        # there is one
+        self.tail_call_label = None
+
+        # The locals of every subroutine, by index: {function name: [names]}
+        self.local_names = {}
+
+        # What this class's code was generated against in other classes:
+        # {class name: {symbol name: entry description or None}}
+        self.dependencies = {}
+
+    def Visit(self, node):
+        return getattr(self, "Visit" + node.__class__.__name__)(node)
+
+    def VisitStatements(self, statements):
+        for statement in statements:
+            self.Visit(statement)
+
+    def VisitClassNode(self, node):
+        self.current_class_name = node.name
+        self.string_pool_base = sum(len(var_dec.names)
+                                    for var_dec in node.class_vars
+                                    if var_dec.kind == "static")
+        for subroutine in node.subroutines:
+            self.Visit(subroutine)
+        if self.string_pool:
+            self.WriteStringPoolInitializer()
+        return self.code
+
+    def WriteStringPoolInitializer(self):
+        """
+        Writes the function that builds every pooled literal of the class
+        into its static.
+        """
+        self.WriteCode("function {0}.$strings 0".
+                       format(self.current_class_name))
+        for literal, index in sorted(self.string_pool.items(),
+                                     key=lambda item: item[1]):
+            self.WriteStringConstruction(literal)
+            self.WriteCode("pop static {0}".format(index))
+        self.WriteCode("push constant 0")
+        self.WriteCode("return")
+
+    def VisitSubroutineNode(self, node):
+        self.current_sub_name = node.name
+        self.current_sub_node = node
+        self.local_symbol_table = SymbolTable()
+
+        if node.kind == "method":  # argument 0 is this
+            self.local_symbol_table.indexList[Categories.ARGUMENT[0]] += 1
+        for varType, name in node.parameters:
+            self.Declare("argument", varType, name)
+
+        nVars = 0
+        local_names = []
+        for var_dec in node.local_vars:
+            for name in var_dec.names:
+                self.Declare("var", var_dec.type, name)
+                local_names.append(name)
+                nVars += 1
+        self.local_names["{0}.{1}".format(self.current_class_name,
+                                          self.current_sub_name)] = local_names
+
+        self.WriteCode("function {0}.{1} {2}".format(self.current_class_name,
+                                                     self.current_sub_name,
+                                                     str(nVars)))
+
+        body_start = len(self.code)
+        self.uses_string_pool = False
+
+        if node.kind == "constructor":
+            self.WriteCode("push constant {0}".
+                           format(self.type_size_map[self.current_class_name]))
+            self.WriteCode("call Memory.alloc 1")
+            self.WriteCode("pop pointer 0")
+        elif node.kind == "method":
+            self.WriteCode("push argument 0")
+            self.WriteCode("pop pointer 0")
+
+        statements_start = len(self.code)
+        self.tail_call_label = None
+        self.VisitStatements(node.statements)
+
+        if self.tail_call_label is not None:
+            self.code.insert(statements_start,
+                             "label {0}".format(self.tail_call_label))
+
+        if self.uses_string_pool:
+            # Build the pool on the first call of a subroutine that uses
+            # it. The first literal's static is 0 until then.
+            ready = self.GenerateUniqueLabel()
+            self.code[body_start:body_start] = [
+                "push static {0}".format(self.string_pool_base),
+                "if-goto {0}".format(ready),
+                "call {0}.$strings 0".format(self.current_class_name),
+                "pop temp 0",
+                "label {0}".format(ready)]
+
+    def Declare(self, category, varType, name):
+        entry = SymbolTableEntry()
+        entry.SetCategory(category)
+        entry.name = name
+        entry.type = varType
+        self.local_symbol_table.InsertEntry(entry)
+
+    def VisitDoStatement(self, node):
+        self.Visit(node.call)
+
+        # Get rid of the return value (garbage)
+        self.WriteCode("pop temp 0")
+
+    def VisitLetStatement(self, node):
+        entry = self.SymbolTableLookup(node.name)
+        offset = self.ConstantIndex(node)
+        if offset is not None:
+            if HasCalls(node.value):
+                # The call may change the array variable; read it first
+                self.WriteCode("push {0} {1}".
+                               format(entry.segment, entry.index))
+                self.Visit(node.value)
+                self.WriteCode("pop temp 0")
+                self.WriteCode("pop pointer 1")
+                self.WriteCode("push temp 0")
+            else:
+                self.Visit(node.value)
+                self.WriteCode("push {0} {1}".
+                               format(entry.segment, entry.index))
+                self.WriteCode("pop pointer 1")
+            self.WriteCode("pop that {0}".format(offset))
+        elif node.index is not None:
+            self.Visit(node.index)
+            self.WriteCode("push {0} {1}".
+                           format(entry.segment, entry.index))  # array base
+            self.WriteCode("add")  # Add offset
+            self.Visit(node.value)
+            self.WriteCode("pop temp 0")  # Save the expression result
+            self.WriteCode("pop pointer 1")  # Align THAT
+            self.WriteCode("push temp 0")  # Push the exp result
+            # Put the exp result in the array position
+            self.WriteCode("pop that 0")
+        else:
+            self.Visit(node.value)
+            self.WriteCode("pop {0} {1}".format(entry.segment, entry.index))
+
+    def VisitWhileStatement(self, node):
+        L1 = self.GenerateUniqueLabel()
+        L2 = self.GenerateUniqueLabel()
+
+        # While entry point
+        self.WriteCode("label {0}".format(L1))
+
+        # Jump to L2 if condition doesn't hold
+        self.Visit(node.condition)
+        self.WriteCode("not")
+        self.WriteCode("if-goto {0}".format(L2))
+
+        # While loop logic
+        self.VisitStatements(node.statements)
+
+        # Go back to L1 for another iteration
+        self.WriteCode("goto {0}".format(L1))
+
+        # While termination point
+        self.WriteCode("label {0}".format(L2))
+
+    def VisitReturnStatement(self, node):
+        if "tailcalls" in self.optimizations and \
+                self.IsSelfCall(node.value):
+            self.WriteTailCall(node.value)
+            return
+
+        if node.value is not None:
+            self.Visit(node.value)
+        else:
+            self.WriteCode("push constant 0")
+
+        self.WriteCode("return")
+
+    def VisitIfStatement(self, node):
+        IF_TRUE = self.GenerateUniqueLabel()
+        IF_FALSE = self.GenerateUniqueLabel()
+        IF_END = self.GenerateUniqueLabel()
+
+        self.Visit(node.condition)
+
+        # Jump to IF_FALSE if condition doesn't hold
+        self.WriteCode("if-goto {0}".format(IF_TRUE))
+        self.WriteCode("goto {0}".format(IF_FALSE))
+        self.WriteCode("label {0}".format(IF_TRUE))
+
+        self.VisitStatements(node.then_statements)
+
+        self.WriteCode("goto {0}".format(IF_END))
+        self.WriteCode("label {0}".format(IF_FALSE))
+        if node.else_statements is not None:
+            self.VisitStatements(node.else_statements)
+
+        self.WriteCode("label {0}".format(IF_END))
+
+    def VisitBinaryOp(self, node):
+        if "strength" in self.optimizations and node.op in "*/" and \
+                self.ReduceStrength(node):
+            return
+        self.Visit(node.left)
+        self.Visit(node.right)
+        self.WriteCode(op_symbols[node.op])
+
+    def ReduceStrength(self, node):
+        """
+        Writes inline code for a multiplication by a constant, or a
+        division by 1. Returns False if Math should still be called.
+        """
+        if node.op == '/':
+            if ConstantOperand(node.right) != 1:
+                return False
+            self.Visit(node.left)
+            return True
+
+        factor = ConstantOperand(node.right)
+        operand = node.left
+        if factor is None:
+            factor = ConstantOperand(node.left)
+            operand = node.right
+        if factor is None:
+            return False
+
+        magnitude = abs(factor)
+        if magnitude & (magnitude - 1) and magnitude > 1 and \
+                len(MultiplySequence("", magnitude)) > max_multiply_sequence:
+            return False
+
+        if magnitude == 0:
+            if HasCalls(operand):  # Still make the calls
+                self.Visit(operand)
+                self.WriteCode("pop temp 0")
+            self.WriteCode("push constant 0")
+            return True
+
+        self.Visit(operand)
+        if magnitude > 1:
+            if isinstance(operand, VarRef) or \
+                    (isinstance(operand, IntegerConstant) and
+                     operand.value >= 0):  # Pushed again by one line
+                push_operand = self.code[-1]
+            else:
+                self.WriteCode("pop temp 1")
+                self.WriteCode("push temp 1")
+                push_operand = "push temp 1"
+            for line in MultiplySequence(push_operand, magnitude):
+                self.WriteCode(line)
+        if factor < 0:
+            self.WriteCode("neg")
+        return True
+
+    def VisitUnaryOp(self, node):
+        self.Visit(node.operand)
+        self.WriteCode(unary_symbols[node.op])
+
+    def VisitIntegerConstant(self, node):
+        # Folded constants may be negative, which push constant can't take
+        if node.value >= 0:
+            self.WriteCode("push constant {0}".format(node.value))
+        elif node.value == -32768:
+            self.WriteCode("push constant 32767")
+            self.WriteCode("not")
+        else:
+            self.WriteCode("push constant {0}".format(-node.value))
+            self.WriteCode("neg")
+
+    def VisitStringConstant(self, node):
+        if "strings" in self.optimizations:
+            if node.value not in self.string_pool:
+                self.string_pool[node.value] = \
+                    self.string_pool_base + len(self.string_pool)
+            self.uses_string_pool = True
+            self.WriteCode("push static {0}".
+                           format(self.string_pool[node.value]))
+        else:
+            self.WriteStringConstruction(node.value)
+
+    def WriteStringConstruction(self, literal):
+        self.WriteCode("push constant {0}".format(len(literal)))
+        self.WriteCode("call String.new 1")
+        for c in literal:
+            self.WriteCode("push constant {0}".format(ord(c)))
+            self.WriteCode("call String.appendChar 2")
+
+    def VisitKeywordConstant(self, node):
+        if node.keyword == "false":
+            self.WriteCode("push constant 0")
+        elif node.keyword == "true":
+            self.WriteCode("push constant 0")
+            self.WriteCode("not")
+        elif node.keyword == "this":
+            self.WriteCode("push pointer 0")
+        elif node.keyword == "null":
+            self.WriteCode("push constant 0")
+
+    def VisitVarRef(self, node):
+        entry = self.SymbolTableLookup(node.name)
+        self.WriteCode("push {0} {1} //{2}".
+                       format(entry.segment, entry.index, node.name))
+
+    def VisitArrayRef(self, node):
+        entry = self.SymbolTableLookup(node.name)
+        self.WriteCode("push {0} {1} //{2}".
+                       format(entry.segment, entry.index, node.name))
+        offset = self.ConstantIndex(node)
+        if offset is not None:
+            self.WriteCode("pop pointer 1")
+            self.WriteCode("push that {0}".format(offset))
+            return
+        self.Visit(node.index)
+        self.WriteCode("add")
+        self.WriteCode("pop pointer 1")
+        self.WriteCode("push that 0")
+
+    def ConstantIndex(self, node):
+        """
+        Returns the index of an array access (ArrayRef or LetStatement)
+        if it is a constant that can be the offset of that, or None.
+        """
+        if "offsets" not in self.optimizations or node.index is None:
+            return None
+        index = ConstantOperand(node.index)
+        if index is None or index < 0:
+            return None
+        return index
+
+    def IsSelfCall(self, node):
+        """
+        Is the expression a call of the current function, or of the
+        current method on this, with one argument per parameter?
+        """
+        sub = self.current_sub_node
+        if not isinstance(node, SubroutineCall) or \
+                node.name != sub.name or sub.kind == "constructor" or \
+                len(node.arguments) != len(sub.parameters):
+            return False
+        if node.prefix is None:
+            return True
+        entry = self.SymbolTableLookup(node.prefix)
+        return sub.kind == "function" and \
+            node.prefix == self.current_class_name and \
+            not (entry is not None and CategoryUtils.IsIndexed(entry.category))
+
+    def WriteTailCall(self, node):
+        """
+        Writes return f(...), where f is the current subroutine, as a jump
+        back to its first statement with the new arguments, and its
+        locals set back to 0 as a call would. this stays the same.
+        """
+        for argument in node.arguments:
+            self.Visit(argument)
+        first_argument = 1 if self.current_sub_node.kind == "method" else 0
+        for index in reversed(range(len(node.arguments))):
+            self.WriteCode("pop argument {0}".format(first_argument + index))
+        for index in range(sum(len(var_dec.names) for var_dec in
+                               self.current_sub_node.local_vars)):
+            self.WriteCode("push constant 0")
+            self.WriteCode("pop local {0}".format(index))
+
+        if self.tail_call_label is None:
+            self.tail_call_label = self.GenerateUniqueLabel()
+        self.WriteCode("goto {0}".format(self.tail_call_label))
+
+    def VisitSubroutineCall(self, node):
+        nArgs = 0
+        if node.prefix is not None:
+            entry = self.SymbolTableLookup(node.prefix)
+            if entry is not None and CategoryUtils.IsIndexed(entry.category):
+                # varName.subName is a method call on the variable
+                self.WriteCode("push {0} {1} //{2}".
+                               format(entry.segment, entry.index,
+                                      node.prefix))
+                nArgs += 1
+                className = entry.type
+            else:
+                className = node.prefix
+        else:
+            className = self.current_class_name
+            entry = self.ClassSymbolTableLookup(node.name, className)
+            if entry is None or entry.type == "method":
+                self.WriteCode("push pointer 0 //this")
+                nArgs += 1
+
+        for argument in node.arguments:
+            self.Visit(argument)
+        nArgs += len(node.arguments)
+
+        self.WriteCode("call {0}.{1} {2}".format(className, node.name, nArgs))
+
+    def ClassSymbolTableLookup(self, name, containingClass):
+        table = self.class_symbol_tables.get(containingClass)
+        entry = None
+        if table is not None:  # None if not in the project (e.g. the OS)
+            entry = table.GetEntry(name)
+
+        if containingClass != self.current_class_name:
+            self.dependencies.setdefault(containingClass, {})[name] = \
+                entry.Describe() if entry is not None else None
+
+        return entry
+
+    def SymbolTableLookup(self, name):
+        entry = self.local_symbol_table.GetEntry(name)
+        if entry is not None:
+            return entry
+        else:
+            return self.ClassSymbolTableLookup(name, self.current_class_name)
+
+    def WriteCode(self, line):
+        self.code.append(line)
+
+    def GenerateUniqueLabel(self):
+        self.unique_label_index += 1
+        return "pfl{0}".format(self.unique_label_index - 1)
@@ -0,0 +1,152 @@
+commutative_commands = ['add', 'and', 'or', 'eq']
+binary_commands = ['add', 'sub', 'and', 'or', 'eq', 'gt', 'lt']
+unary_commands = ['neg', 'not']
+
+
+def Parse(line):
+    return line.split('//', 1)[0].split()
+
+
+class StackEntry(object):
+    """
+    A value on the stack: its value number, and the lines that computed
+    it (first and last index), if they can be deleted without side
+    effects.
+    """
+    __slots__ = ('value', 'first', 'last', 'pure')
+
+    def __init__(self, value, first, last, pure):
+        self.value = value
+        self.first = first
+        self.last = last
+        self.pure = pure
+
+
+class CommonSubexpressionEliminator(object):
+    """
+    Numbers the values computed in each extended basic block (a run of
+    code entered only at its top, which if-gotos leave but don't end),
+    so that two computations of the same value get the same number.
+    When an array access sets pointer 1 to the address THAT already
+    holds, the address computation and the "pop pointer 1" are deleted,
+    e.g. in let a[i] = a[i] + 1, or when a[i] is read twice.
+
+    Memory is tracked conservatively: a store through this or that
+    forgets every this and that value (they may alias), and a call
+    forgets them, the statics, the temps and THAT, since the callee (or
+    the code that replaces it when inlined) may change them.
+    removed counts the deleted lines.
+    """
+
+    def __init__(self):
+        self.removed = {'address computations': 0, 'pointer reloads': 0}
+
+    def Optimize(self, code):
+        self.values = {}  # {expression: value number}
+        deleted = set()
+        self.Reset()
+
+        for index, line in enumerate(code):
+            words = Parse(line)
+            command = words[0]
+
+            if command == 'push':
+                self.Push(self.Load(words[1], int(words[2])), index, True)
+            elif command == 'pop':
+                segment, segment_index = words[1], int(words[2])
+                entry = self.Pop()
+                if (segment, segment_index) == ('pointer', 1) and \
+                        entry.value == self.locations.get(('pointer', 1)) \
+                        and entry.pure and entry.first is not None:
+                    # THAT already points there
+                    span = range(entry.first, entry.last + 1)
+                    deleted.update(span)
+                    deleted.add(index)
+                    self.removed['address computations'] += len(span)
+                    self.removed['pointer reloads'] += 1
+                    if index + 1 < len(code) and \
+                            Parse(code[index - 1]) == ['pop', 'temp', '0'] and \
+                            Parse(code[index + 1]) == ['push', 'temp', '0']:
+                        deleted.update([index - 1, index + 1])
+                        self.removed['pointer reloads'] += 2
+                    continue
+                self.Store(segment, segment_index, entry.value)
+            elif command in binary_commands:
+                y, x = self.Pop(), self.Pop()
+                operands = (x.value, y.value)
+                if command in commutative_commands:
+                    operands = tuple(sorted(operands))
+                # The lines are only x's and y's if nothing came between
+                self.Push(self.Number((command,) + operands), x.first,
+                          x.pure and y.pure and x.last + 1 == y.first and
+                          y.last + 1 == index, index)
+            elif command in unary_commands:
+                x = self.Pop()
+                self.Push(self.Number((command, x.value)), x.first,
+                          x.pure and x.last + 1 == index, index)
+            elif command == 'call':
+                for argument in range(int(words[2])):
+                    self.Pop()
+                self.Forget(lambda location: location[0] in
+                            ('this', 'that', 'static', 'temp') or
+                            location == ('pointer', 1))
+                self.Push(self.NewNumber(), None, False, index)
+            elif command == 'if-goto':
+                self.Pop()
+            else:  # function, label, goto, return: a new block starts
+                self.Reset()
+
+        return [line for index, line in enumerate(code)
+                if index not in deleted]
+
+    def Reset(self):
+        self.locations = {}  # {(segment, index): value number}
+        self.stack = []
+
+    def NewNumber(self):
+        self.values[object()] = len(self.values)
+        return len(self.values) - 1
+
+    def Number(self, expression):
+        if expression not in self.values:
+            self.values[expression] = len(self.values)
+        return self.values[expression]
+
+    def Push(self, value, first, pure, last=None):
+        if first is None:
+            pure = False
+        self.stack.append(StackEntry(value, first,
+                                     first if last is None else last, pure))
+
+    def Pop(self):
+        if self.stack:
+            return self.stack.pop()
+        # Pushed before the block started
+        return StackEntry(self.NewNumber(), None, None, False)
+
+    def Load(self, segment, index):
+        if segment == 'constant':
+            return self.Number(('constant', index))
+        if segment == 'that':
+            location = ('that', self.locations.get(('pointer', 1)), index)
+        elif segment == 'this':
+            location = ('this', self.locations.get(('pointer', 0)), index)
+        else:
+            location = (segment, index)
+        if location not in self.locations:
+            self.locations[location] = self.NewNumber()
+        return self.locations[location]
+
+    def Store(self, segment, index, value):
+        if segment in ('this', 'that'):
+            self.Forget(lambda location: location[0] in ('this', 'that'))
+            pointer = ('pointer', 0) if segment == 'this' else ('pointer', 1)
+            location = (segment, self.locations.get(pointer), index)
+        else:
+            location = (segment, index)
+        self.locations[location] = value
+
+    def Forget(self, predicate):
+        for location in [location for location in self.locations
+                         if predicate(location)]:
+            del self.locations[location]
@@ -1,8 +1,26 @@
 from JackTokenizer import TokenType, Tokenizer
-from SymbolTable import (SymbolTable, CategoryUtils, SymbolTableEntry,
-                         Categories)
+from XmlWriter import XmlWriter
+from SymbolTable import SymbolTable, SymbolTableEntry
+from CodeGenerator import CodeGenerator, op_symbols, unary_symbols
+from ConstantFolder import ConstantFolder
+from LoopInvariants import LoopInvariantMover
+from ControlFlow import ControlFlowOptimizer
+from CommonSubexpressions import CommonSubexpressionEliminator
+from LocalSlots import LocalSlotAllocator
+from Peephole import PeepholeOptimizer
+from TreeShaker import TreeShaker, default_roots
+from Inliner import Inliner, default_max_size, default_max_depth
+from PythonGenerator import PythonGenerator
+from AssemblyWriter import AssemblyWriter
+from JackAST import (ClassNode, ClassVarDec, VarDec, SubroutineNode,
+                     LetStatement, IfStatement, WhileStatement, DoStatement,
+                     ReturnStatement, IntegerConstant, StringConstant,
+                     KeywordConstant, VarRef, ArrayRef, SubroutineCall,
+                     UnaryOp, BinaryOp)
 import sys
 import os
+import argparse
+import multiprocessing
 
 
 class Keyword:
@@ -29,168 +47,344 @@ class Keyword:
     THIS = 'this'
 
 
-op_symbols = {'+': 'add',
-              '-': 'sub',
-              '*': 'call Math.multiply 2',
-              '/': 'call Math.divide 2',
-              '&amp;': 'and',
-              '|': 'or',
-              "&lt;": 'lt',
-              "&gt;": 'gt',
-              '=': 'eq'}
-
-unary_symbols = {'-': 'neg',
-                 '~': 'not'}
-
 subroutine_types = [Keyword.CONSTRUCTOR, Keyword.FUNCTION, Keyword.METHOD]
 
+# The optional optimizations, in the order they are applied. The program
+# optimizations work on the whole program, so they are applied by
+# OptimizeProgram once every class is compiled, not by CompileClass.
+optimization_names = ['fold', 'licm', 'strength', 'strings', 'offsets',
+                      'tailcalls', 'cfg', 'cse', 'slots', 'peephole', 'inline',
+                      'shake']
+program_optimizations = ['inline', 'shake']
+
+# What the classes can be compiled to, and the extension of the files.
+# The Python backend only applies the optimizations that work on the AST.
+# The hack backend compiles to VM code, and translates the VM code of the
+# whole program to one .asm file.
+backends = ['vm', 'python', 'hack']
+backend_extensions = {'vm': ".vm", 'python': ".py"}
+ast_optimizations = ['fold', 'licm']
+
+# What the counts of each optimization's statistics are
+statistics_units = {'licm': "expressions hoisted",
+                    'cfg': "instructions removed",
+                    'cse': "instructions removed",
+                    'slots': "locals saved",
+                    'peephole': "instructions removed",
+                    'inline': "calls inlined",
+                    'shake': "instructions removed"}
+
 
 class CompilationEngine:
-    def __init__(self):
-        self.local_symbol_table = None
+    def __init__(self, xml_output=False, optimizations=(), backend="vm"):
+        """
+        xml_output: also write the parse tree of every class to
+        <output_path>.xml. When off, no XML is formatted at all.
+        optimizations: names from optimization_names to apply. Without
+        any, the generated code is the plain, unoptimized translation.
+        backend: "vm" to generate VM code, or "python" to generate a
+        Python module per class. For "hack", CompileClass generates VM
+        code, which CompileAssembly translates.
+        """
+        for name in optimizations:
+            if name not in optimization_names:
+                raise Exception("Unknown optimization " + name)
+        if backend not in backends:
+            raise Exception("Unknown backend " + backend)
+        self.xml_output = xml_output
+        self.backend = backend
+        self.optimizations = [name for name in optimization_names
+                              if name in optimizations and
+                              (backend != "python" or
+                               name in ast_optimizations)]
+        self.xml = None
         self.class_symbol_tables = {}
         self.type_size_map = {"int": 1, "bool": 1, "char": 1}
-        self.unique_label_index = 0
+        self.dependencies = {}
+
+        # What the optimizations did to the classes compiled so far:
+        # {optimization: {item: count}}
+        self.statistics = {}
+
+    def SetClass(self, input_path, output_path=None):
+        """
+        Gets ready to compile the class in input_path. CompileClass
+        writes the VM code to output_path, if given, and the XML parse
+        tree (when enabled) to <output_path>.xml.
+        """
+        self.BeginClass(Tokenizer(input_path), output_path)
+
+    def SetSource(self, source):
+        """
+        Gets ready to compile a class given as Jack source text. Nothing
+        is written; CompileClass only returns the VM code.
+        """
+        self.BeginClass(Tokenizer(None, source), None)
 
-    def SetClass(self, input_path, output_path):
-        self.tokenizer = Tokenizer(input_path)
-        self.output_file = open("{0}.xml".format(output_path), 'w')
-        self.code_file = open(output_path, 'w')
+    def BeginClass(self, tokenizer, output_path):
+        self.tokenizer = tokenizer
+        self.output_path = output_path
+        if self.xml_output and output_path is not None:
+            self.xml = XmlWriter("{0}.xml".format(output_path))
         self.tokenizer.advance()
-        self.indent_level = 0
 
         self.current_class_name = None
-        self.current_sub_name = None
+        self.class_node = None
 
     def CompileClass(self):
         """
-        Compiles a complete class.
+        Compiles a complete class, and returns its VM code (or Python
+        module). The AST of the class is left in self.class_node.
+        """
+        class_node = self.ParseClass()
+
+        # The class is normally declared already by DeclareClass
+        if class_node.name not in self.class_symbol_tables:
+            self.DeclareClassNode(class_node)
+
+        if "fold" in self.optimizations:
+            ConstantFolder().FoldClass(class_node)
+
+        if "licm" in self.optimizations:
+            mover = LoopInvariantMover()
+            mover.MoveClass(class_node)
+            AddStatistics(self.statistics, {"licm": mover.hoisted})
+
+        if self.backend == "python":
+            self.dependencies = {}
+            return self.WriteOutput(
+                PythonGenerator(self.class_symbol_tables).Visit(class_node))
+
+        generator = CodeGenerator(self.class_symbol_tables,
+                                  self.type_size_map, self.optimizations)
+        code = generator.Visit(class_node)
+        self.dependencies = generator.dependencies
+
+        if "cfg" in self.optimizations:
+            control_flow = ControlFlowOptimizer()
+            code = control_flow.Optimize(code)
+            AddStatistics(self.statistics, {"cfg": control_flow.removed})
+
+        if "cse" in self.optimizations:
+            eliminator = CommonSubexpressionEliminator()
+            code = eliminator.Optimize(code)
+            AddStatistics(self.statistics, {"cse": eliminator.removed})
+
+        if "slots" in self.optimizations:
+            allocator = LocalSlotAllocator(generator.local_names)
+            code = allocator.Optimize(code)
+            AddStatistics(self.statistics, {"slots": allocator.slots})
+
+        if "peephole" in self.optimizations:
+            peephole = PeepholeOptimizer()
+            code = peephole.Optimize(code)
+            AddStatistics(self.statistics, {"peephole": peephole.removed})
+
+        return self.WriteOutput(code)
+
+    def WriteOutput(self, code):
+        """
+        Joins the generated lines, writes them to the output path, if
+        any, and returns them.
+        """
+        text = '\n'.join(code) + '\n' if code else ''
+        if self.output_path is not None:
+            with open(self.output_path, 'w') as code_file:
+                code_file.write(text)
+        return text
+
+    def ParseClass(self):
+        """
+        Parses a complete class, and returns its AST.
         """
         self.EnterScope("class")
 
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.CLASS])
-        self.ConsumeDeclaration("class", None)
-
-        self.class_symbol_tables[self.current_class_name] = SymbolTable()
+        self.current_class_name = self.ConsumeIdentifier()
 
         self.ConsumeSymbol('{')
 
-        totalSize = 0
+        class_vars = []
         while (self.IsKeyword([Keyword.STATIC, Keyword.FIELD])):
-            totalSize += self.CompileClassVarDec()
-
-        self.type_size_map[self.current_class_name] = totalSize
+            class_vars.append(self.CompileClassVarDec())
 
         # subroutineDec*
+        subroutines = []
         while (self.IsKeyword(subroutine_types)):
-            self.CompileSubroutine()
+            subroutines.append(self.CompileSubroutine())
 
         self.ConsumeSymbol('}')
 
         self.ExitScope("class")
-        self.output_file.close()
+        if self.xml is not None:
+            self.xml.close()
+            self.xml = None
+
+        self.class_node = ClassNode(self.current_class_name, class_vars,
+                                    subroutines, position)
+        return self.class_node
+
+    def DeclareClassNode(self, class_node):
+        """
+        Fills in the class symbol table and size of a parsed class.
+        """
+        table = SymbolTable()
+        totalSize = 0
+        for class_var in class_node.class_vars:
+            for name in class_var.names:
+                entry = SymbolTableEntry()
+                entry.SetCategory(class_var.kind)
+                entry.name = name
+                entry.type = class_var.type
+                table.InsertEntry(entry)
+                if class_var.kind == Keyword.FIELD:
+                    totalSize += 1
+
+        for subroutine in class_node.subroutines:
+            entry = SymbolTableEntry()
+            entry.SetCategory(subroutine.kind)
+            entry.name = subroutine.name
+            entry.type = subroutine.kind
+            table.InsertEntry(entry)
+
+        self.class_symbol_tables[class_node.name] = table
+        self.type_size_map[class_node.name] = totalSize
+
+    def DeclareClass(self, input_path, source=None):
+        """
+        Fills in the class symbol table and size of a class by reading
+        only its declarations; subroutine bodies are skipped, and no
+        code or XML is written. Declaring every class of a project before
+        compiling any of them lets calls and constructors resolve against
+        all classes, whatever order the files are compiled in.
+        If source is given, it is read instead of input_path. Returns the
+        name of the class.
+        """
+        tokenizer = Tokenizer(input_path, source)
+        tokens = []
+        while tokenizer.hasMoreTokens():
+            tokenizer.advance()
+            tokens.append(tokenizer.token())
+        tokenizer.close()
+
+        def Expect(i, text):
+            if tokens[i].text != text:
+                raise Exception("Expected: {}, Actual: {}".
+                                format(text, tokens[i].text))
+            return i + 1
+
+        i = Expect(0, Keyword.CLASS)
+        class_name = tokens[i].text
+        table = SymbolTable()
+        i = Expect(i + 1, '{')
+
+        totalSize = 0
+        while tokens[i].text in [Keyword.STATIC, Keyword.FIELD]:
+            category = tokens[i].text
+            varType = tokens[i + 1].text
+            i += 2
+            while True:
+                entry = SymbolTableEntry()
+                entry.SetCategory(category)
+                entry.name = tokens[i].text
+                entry.type = varType
+                table.InsertEntry(entry)
+                if category == Keyword.FIELD:
+                    totalSize += 1
+                i += 1
+                if tokens[i].text != ',':
+                    break
+                i += 1
+            i = Expect(i, ';')
+
+        while tokens[i].text in subroutine_types:
+            entry = SymbolTableEntry()
+            entry.SetCategory(tokens[i].text)
+            entry.name = tokens[i + 2].text
+            entry.type = tokens[i].text
+            table.InsertEntry(entry)
+
+            # Skip the parameter list and the body
+            i = Expect(i + 3, '(')
+            while tokens[i].text != ')':
+                i += 1
+            i = Expect(i + 1, '{')
+            depth = 1
+            while depth > 0:
+                if tokens[i].type == TokenType.SYMBOL:
+                    if tokens[i].text == '{':
+                        depth += 1
+                    elif tokens[i].text == '}':
+                        depth -= 1
+                i += 1
+
+        Expect(i, '}')
+
+        self.class_symbol_tables[class_name] = table
+        self.type_size_map[class_name] = totalSize
+        return class_name
 
     def CompileClassVarDec(self):
         """
         Compiles a static declaration or a field declaration.
         """
         self.EnterScope("classVarDec")
-        amount = 0
-        category = self.tokenizer.keyword()
-        self.ConsumeKeyword([Keyword.STATIC, Keyword.FIELD])
+        position = self.tokenizer.tokenPosition()
+        category = self.ConsumeKeyword([Keyword.STATIC, Keyword.FIELD])
         varType = self.ConsumeType()
-        self.ConsumeDeclaration(category, varType)
-        amount += 1
+        names = [self.ConsumeIdentifier()]
         while (self.IsSymbol([','])):
             self.ConsumeSymbol(',')
-            self.ConsumeDeclaration(category, varType)
-            amount += 1
+            names.append(self.ConsumeIdentifier())
 
         self.ConsumeSymbol(';')
 
         self.ExitScope("classVarDec")
 
-        return amount
+        return ClassVarDec(category, varType, names, position)
 
     def CompileSubroutine(self):
         """
         Compiles a complete method, function, or constructor.
         """
         self.EnterScope("subroutineDec")
-        self.local_symbol_table = SymbolTable()
 
-        subType = self.tokenizer.keyword()
-        self.ConsumeKeyword([Keyword.CONSTRUCTOR, Keyword.FUNCTION,
-                             Keyword.METHOD])
+        position = self.tokenizer.tokenPosition()
+        subType = self.ConsumeKeyword([Keyword.CONSTRUCTOR, Keyword.FUNCTION,
+                                       Keyword.METHOD])
         if (self.IsKeyword([Keyword.VOID])):
-            self.ConsumeKeyword([Keyword.VOID])
+            returnType = self.ConsumeKeyword([Keyword.VOID])
         else:
-            self.ConsumeType()
-
-        # The first param is converted to internal rep. the second is preserved
-        self.ConsumeDeclaration(subType, subType)
+            returnType = self.ConsumeType()
 
-        if subType == "method":
-            self.local_symbol_table.indexList[Categories.ARGUMENT[0]] += 1
+        name = self.ConsumeIdentifier()
 
         self.ConsumeSymbol('(')
-        self.CompileParameterList()
+        parameters = self.CompileParameterList()
         self.ConsumeSymbol(')')
 
-        self.CompileSubroutineBody()
+        local_vars, statements = self.CompileSubroutineBody()
 
         self.ExitScope("subroutineDec")
 
+        return SubroutineNode(subType, returnType, name, parameters,
+                              local_vars, statements, position)
+
     def CompileSubroutineBody(self):
         self.EnterScope("subroutineBody")
 
-        nVars = 0
         self.ConsumeSymbol('{')
+        local_vars = []
         while (self.IsKeyword([Keyword.VAR])):
-            nVars += self.CompileVarDec()
-
-        self.WriteCode("function {0}.{1} {2}".format(self.current_class_name,
-                                                     self.current_sub_name,
-                                                     str(nVars)))
-
-        entry = self.SymbolTableLookup(self.current_sub_name)
+            local_vars.append(self.CompileVarDec())
 
-        if entry.type == "constructor":
-            self.WriteCode("push constant {0}".
-                           format(self.type_size_map[self.current_class_name]))
-            self.WriteCode("call Memory.alloc 1")
-            self.WriteCode("pop pointer 0")
-        elif entry.type == "method":
-            self.WriteCode("push argument 0")
-            self.WriteCode("pop pointer 0")
-
-        self.CompileStatements()
+        statements = self.CompileStatements()
         self.ConsumeSymbol('}')
 
         self.ExitScope("subroutineBody")
 
-    def ConsumeDeclaration(self, category, entry_type):
-        entry = SymbolTableEntry()
-        entry.SetCategory(category)
-        entry.name = self.ConsumeIdentifier()
-        entry.type = entry_type
-
-        local_categories = [Categories.VAR, Categories.ARGUMENT]
-        class_categories = [Categories.SUBROUTINE, Categories.FIELD,
-                            Categories.STATIC]
-
-        # Updating current class / subroutine names
-        if entry.category == Categories.CLASS:
-            self.current_class_name = entry.name
-        elif entry.category == Categories.SUBROUTINE:
-            self.current_sub_name = entry.name
-
-        # Updating local / class symbol tables
-        if entry.category in local_categories:
-            self.local_symbol_table.InsertEntry(entry)
-        elif entry.category in class_categories:
-            self.class_symbol_tables[self.current_class_name].\
-                InsertEntry(entry)
+        return local_vars, statements
 
     def CompileParameterList(self):
         """
@@ -198,43 +392,39 @@ class CompilationEngine:
         not including the enclosing "()".
         """
         self.EnterScope("parameterList")
-        nVars = 0
+        parameters = []
 
         if (not self.IsSymbol([')'])):
             varType = self.ConsumeType()
-            self.ConsumeDeclaration("argument", varType)
-            nVars += 1
+            parameters.append((varType, self.ConsumeIdentifier()))
 
         while(self.IsSymbol([','])):
             self.ConsumeSymbol(',')
             varType = self.ConsumeType()
-            self.ConsumeDeclaration("argument", varType)
-            nVars += 1
+            parameters.append((varType, self.ConsumeIdentifier()))
 
         self.ExitScope("parameterList")
 
-        return nVars
+        return parameters
 
     def CompileVarDec(self):
         """
         Compiles a var declaration.
         """
         self.EnterScope("varDec")
-        nVars = 0
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.VAR])
         varType = self.ConsumeType()
-        self.ConsumeDeclaration("var", varType)
-        nVars += 1
+        names = [self.ConsumeIdentifier()]
         while (self.IsSymbol([','])):
             self.ConsumeSymbol(',')
-            self.ConsumeDeclaration("var", varType)
-            nVars += 1
+            names.append(self.ConsumeIdentifier())
 
         self.ConsumeSymbol(';')
 
         self.ExitScope("varDec")
 
-        return nVars
+        return VarDec(varType, names, position)
 
     def CompileStatements(self):
         """
@@ -243,150 +433,106 @@ class CompilationEngine:
         """
         self.EnterScope("statements")
 
+        statements = []
         while self.IsKeyword([Keyword.LET, Keyword.IF, Keyword.WHILE,
                               Keyword.DO, Keyword.RETURN]):
             if self.IsKeyword([Keyword.LET]):
-                self.CompileLet()
+                statements.append(self.CompileLet())
 
             if self.IsKeyword([Keyword.IF]):
-                self.CompileIf()
+                statements.append(self.CompileIf())
 
             if self.IsKeyword([Keyword.WHILE]):
-                self.CompileWhile()
+                statements.append(self.CompileWhile())
 
             if self.IsKeyword([Keyword.DO]):
-                self.CompileDo()
+                statements.append(self.CompileDo())
 
             if self.IsKeyword([Keyword.RETURN]):
-                self.CompileReturn()
+                statements.append(self.CompileReturn())
 
         self.ExitScope("statements")
 
+        return statements
+
     def CompileDo(self):
         """
         Compiles a do statement.
         """
         self.EnterScope("doStatement")
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.DO])
-        prefix = self.ConsumeIdentifier()
-        calleeLocation = None
-        subName = None
-
-        if self.IsSymbol(['.']):
-            self.ConsumeSymbol('.')
-            entry = self.SymbolTableLookup(prefix)
-            if entry is not None and entry.category != Categories.CLASS:
-                calleeLocation = "{0} {1}".format(entry.segment, entry.index)
-                prefix = entry.type
-            postfix = self.ConsumeIdentifier()
-            subName = "{0}.{1}".format(prefix, postfix)
-        else:
-            subName = "{0}.{1}".format(self.current_class_name, prefix)
-            calleeLocation = "pointer 0"
-
-        nArgs = 0
-        # This means we are calling an instance method, so we push it first
-        if calleeLocation is not None:
-            self.WriteCode("push {0} //Pushing callee".format(calleeLocation))
-            nArgs += 1
-
-        self.ConsumeSymbol('(')
-        nArgs += self.CompileExpressionList()
-        self.ConsumeSymbol(')')
+        call_position = self.tokenizer.tokenPosition()
+        call = self.CompileSubroutineCall(self.ConsumeIdentifier(),
+                                          call_position)
         self.ConsumeSymbol(';')
 
-        self.WriteCode("call {0} {1}".format(subName, nArgs))
-
-        # Get rid of the return value (garbage)
-        self.WriteCode("pop temp 0")
-
         self.ExitScope("doStatement")
 
+        return DoStatement(call, position)
+
     def CompileLet(self):
         """
         Compiles a let statement.
         """
         self.EnterScope("letStatement")
 
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.LET])
         varName = self.ConsumeIdentifier()
-        entry = self.SymbolTableLookup(varName)
-        isArray = False
+        index = None
         if self.IsSymbol(['[']):
-            isArray = True
             self.ConsumeSymbol('[')
-            self.CompileExpression()
-            self.WriteCode("push {0} {1}".
-                           format(entry.segment, entry.index))  # array base
-            self.WriteCode("add")  # Add offset
+            index = self.CompileExpression()
             self.ConsumeSymbol(']')
         self.ConsumeSymbol('=')
-        self.CompileExpression()
+        value = self.CompileExpression()
         self.ConsumeSymbol(';')
 
-        if isArray:
-            self.WriteCode("pop temp 0")  # Save the expression result
-            self.WriteCode("pop pointer 1")  # Align THAT
-            self.WriteCode("push temp 0")  # Push the exp result
-            # Put the exp result in the array position
-            self.WriteCode("pop that 0")
-        else:
-            self.WriteCode("pop {0} {1}".format(entry.segment, entry.index))
-
         self.ExitScope("letStatement")
 
+        return LetStatement(varName, index, value, position)
+
     def CompileWhile(self):
         """
         Compiles a while statement.
         """
         self.EnterScope("whileStatement")
 
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.WHILE])
-        L1 = self.GenerateUniqueLabel()
-        L2 = self.GenerateUniqueLabel()
-
-        # While entry point
-        self.WriteCode("label {0}".format(L1))
 
         # while loop condition
         self.ConsumeSymbol('(')
-        self.CompileExpression()
+        condition = self.CompileExpression()
         self.ConsumeSymbol(')')
 
-        # Jump to L2 if condition doesn't hold
-        self.WriteCode("not")
-        self.WriteCode("if-goto {0}".format(L2))
-
         # While loop logic
         self.ConsumeSymbol('{')
-        self.CompileStatements()
+        statements = self.CompileStatements()
         self.ConsumeSymbol('}')
 
-        # Go back to L1 for another iteration
-        self.WriteCode("goto {0}".format(L1))
-
-        # While termination point
-        self.WriteCode("label {0}".format(L2))
-
         self.ExitScope("whileStatement")
 
+        return WhileStatement(condition, statements, position)
+
     def CompileReturn(self):
         """
         Compiles a return statement.
         """
         self.EnterScope("returnStatement")
 
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.RETURN])
+        value = None
         if not self.IsSymbol([';']):
-            self.CompileExpression()
-        else:
-            self.WriteCode("push constant 0")
+            value = self.CompileExpression()
         self.ConsumeSymbol(';')
 
-        self.WriteCode("return")
-
         self.ExitScope("returnStatement")
 
+        return ReturnStatement(value, position)
+
     def CompileIf(self):
         """
         Compiles an if statement, possibly with a trailing
@@ -394,50 +540,47 @@ class CompilationEngine:
         """
         self.EnterScope("ifStatement")
 
+        position = self.tokenizer.tokenPosition()
         self.ConsumeKeyword([Keyword.IF])
-        IF_TRUE = self.GenerateUniqueLabel()
-        IF_FALSE = self.GenerateUniqueLabel()
-        IF_END = self.GenerateUniqueLabel()
 
         # The if statement condition
         self.ConsumeSymbol('(')
-        self.CompileExpression()
+        condition = self.CompileExpression()
         self.ConsumeSymbol(')')
 
-        # Jump to L1 if condition doesn't hold
-        self.WriteCode("if-goto {0}".format(IF_TRUE))
-        self.WriteCode("goto {0}".format(IF_FALSE))
-        self.WriteCode("label {0}".format(IF_TRUE))
-
         self.ConsumeSymbol('{')
-        self.CompileStatements()
+        then_statements = self.CompileStatements()
         self.ConsumeSymbol('}')
 
-        self.WriteCode("goto {0}".format(IF_END))
-        self.WriteCode("label {0}".format(IF_FALSE))
+        else_statements = None
         if self.IsKeyword([Keyword.ELSE]):
             self.ConsumeKeyword([Keyword.ELSE])
             self.ConsumeSymbol('{')
-            self.CompileStatements()
+            else_statements = self.CompileStatements()
             self.ConsumeSymbol('}')
 
-        self.WriteCode("label {0}".format(IF_END))
         self.ExitScope("ifStatement")
 
+        return IfStatement(condition, then_statements, else_statements,
+                           position)
+
     def CompileExpression(self):
         """
         Compiles an expression.
         """
         self.EnterScope("expression")
 
-        self.CompileTerm()
+        expression = self.CompileTerm()
         while (self.IsSymbol(op_symbols.keys())):
+            position = self.tokenizer.tokenPosition()
             op = self.ConsumeSymbol(self.tokenizer.symbol())
-            self.CompileTerm()
-            self.WriteCode(op_symbols[op])
+            expression = BinaryOp(op, expression, self.CompileTerm(),
+                                  position)
 
         self.ExitScope("expression")
 
+        return expression
+
     def CompileTerm(self):
         """
         Compiles a term.
@@ -446,88 +589,57 @@ class CompilationEngine:
 
         keyword_constants = [Keyword.TRUE, Keyword.FALSE, Keyword.NULL,
                              Keyword.THIS]
-        termName = None
+        position = self.tokenizer.tokenPosition()
 
         if self.IsType(TokenType.INT_CONST):
-            self.WriteCode("push constant {0}".
-                           format(self.ConsumeIntegerConstant()))
+            term = IntegerConstant(self.ConsumeIntegerConstant(), position)
 
         elif self.IsType(TokenType.STRING_CONST):
-            self.ConsumeStringConstant()
+            term = StringConstant(self.ConsumeStringConstant(), position)
 
         elif self.IsKeyword(keyword_constants):
-                keyword = self.ConsumeKeyword(keyword_constants)
-                if keyword == "false":
-                    self.WriteCode("push constant 0")
-                elif keyword == "true":
-                    self.WriteCode("push constant 0")
-                    self.WriteCode("not")
-                elif keyword == "this":
-                    self.WriteCode("push pointer 0")
-                elif keyword == "null":
-                    self.WriteCode("push constant 0")
+            term = KeywordConstant(self.ConsumeKeyword(keyword_constants),
+                                   position)
 
         elif self.IsSymbol(['(']):
             self.ConsumeSymbol('(')
-            self.CompileExpression()
+            term = self.CompileExpression()
             self.ConsumeSymbol(')')
 
         elif self.IsSymbol(unary_symbols.keys()):
             symbol = self.ConsumeSymbol(self.tokenizer.symbol())
-            self.CompileTerm()
-            self.WriteCode(unary_symbols[symbol])
+            term = UnaryOp(symbol, self.CompileTerm(), position)
         else:
             termName = self.ConsumeIdentifier()
-            entry = self.SymbolTableLookup(termName)
-            if entry is not None:
-                if CategoryUtils.IsIndexed(entry.category):
-                    self.WriteCode("push {0} {1} //{2}".
-                                   format(CategoryUtils.
-                                          GetSegment(entry.category),
-                                          entry.index, termName))
-
-            if self.IsSymbol(['[']):  # varName '[' expression ']'
+            if self.IsSymbol(['(', '.']):  # subroutineCall
+                term = self.CompileSubroutineCall(termName, position)
+            elif self.IsSymbol(['[']):  # varName '[' expression ']'
                 self.ConsumeSymbol('[')
-                self.CompileExpression()
-                self.WriteCode("add")
-                self.WriteCode("pop pointer 1")
-                self.WriteCode("push that 0")
+                term = ArrayRef(termName, self.CompileExpression(), position)
                 self.ConsumeSymbol(']')
-            elif self.IsSymbol(['(']):  # subroutineCall
-                self.ConsumeSymbol('(')
-                self.WriteCode("call {0} {1}".
-                               format(termName, self.CompileExpressionList()))
-                self.ConsumeSymbol(')')
-            elif self.IsSymbol(['.']):
-                self.ConsumeSymbol('.')
-                funcName = self.ConsumeIdentifier()
-                entry = self.GetSubroutineEntry(termName, funcName)
-                extraParam = 0
-                if entry is not None and entry.type == "method":
-                    termName = self.SymbolTableLookup(termName).type
-                    extraParam = 1
-
-                self.ConsumeSymbol('(')
-                self.WriteCode("call {0}.{1} {2}".
-                               format(termName, funcName,
-                                      self.CompileExpressionList() +
-                                      extraParam))
-                self.ConsumeSymbol(')')
+            else:
+                term = VarRef(termName, position)
 
         self.ExitScope("term")
 
-        return termName
+        return term
 
-    def GetSubroutineEntry(self, prefix, postfix):
-        entry = self.SymbolTableLookup(postfix)
-        if entry is not None:
-            return entry
+    def CompileSubroutineCall(self, name, position):
+        """
+        Compiles a subroutine call whose first identifier (a subroutine,
+        class or variable name) was already consumed.
+        """
+        prefix = None
+        if self.IsSymbol(['.']):
+            self.ConsumeSymbol('.')
+            prefix = name
+            name = self.ConsumeIdentifier()
 
-        varEntry = self.SymbolTableLookup(prefix)
-        if varEntry is not None:
-            return self.ClassSymbolTableLookup(postfix, varEntry.type)
+        self.ConsumeSymbol('(')
+        arguments = self.CompileExpressionList()
+        self.ConsumeSymbol(')')
 
-        return None
+        return SubroutineCall(prefix, name, arguments, position)
 
     def CompileExpressionList(self):
         """
@@ -535,19 +647,17 @@ class CompilationEngine:
         list of expressions.
         """
         self.EnterScope("expressionList")
-        nArgs = 0
+        expressions = []
         if not self.IsSymbol(')'):
-            self.CompileExpression()
-            nArgs += 1
+            expressions.append(self.CompileExpression())
 
         while self.IsSymbol([',']):
             self.ConsumeSymbol(',')
-            self.CompileExpression()
-            nArgs += 1
+            expressions.append(self.CompileExpression())
 
         self.ExitScope("expressionList")
 
-        return nArgs
+        return expressions
 
     def IsKeyword(self, keyword_list):
         return (self.IsType(TokenType.KEYWORD) and
@@ -574,7 +684,8 @@ class CompilationEngine:
             raise Exception("Expected keywords: {}, Actual: {}".
                             format(keywordList, actual))
 
-        self.OutputTag("keyword", actual)
+        if self.xml is not None:
+            self.xml.OutputTag("keyword", actual)
         if self.tokenizer.hasMoreTokens():
             self.tokenizer.advance()
 
@@ -586,7 +697,8 @@ class CompilationEngine:
         if actual != symbol:
             raise Exception("Expected symbol: {}, Actual: {}".
                             format(symbol, actual))
-        self.OutputTag("symbol", actual)
+        if self.xml is not None:
+            self.xml.OutputTag("symbol", actual)
         if self.tokenizer.hasMoreTokens():
             self.tokenizer.advance()
 
@@ -595,7 +707,8 @@ class CompilationEngine:
     def ConsumeIntegerConstant(self):
         self.VerifyTokenType(TokenType.INT_CONST)
         actual = self.tokenizer.intVal()
-        self.OutputTag("integerConstant", self.tokenizer.intVal())
+        if self.xml is not None:
+            self.xml.OutputTag("integerConstant", actual)
         if self.tokenizer.hasMoreTokens():
             self.tokenizer.advance()
 
@@ -604,12 +717,8 @@ class CompilationEngine:
     def ConsumeStringConstant(self):
         self.VerifyTokenType(TokenType.STRING_CONST)
         actual = self.tokenizer.stringVal()
-        self.WriteCode("push constant {0}".format(len(actual)))
-        self.WriteCode("call String.new 1")
-        for c in actual:
-            self.WriteCode("push constant {0}".format(ord(c)))
-            self.WriteCode("call String.appendChar 2")
-        self.OutputTag("stringConstant", self.tokenizer.stringVal())
+        if self.xml is not None:
+            self.xml.OutputTag("stringConstant", actual)
         if self.tokenizer.hasMoreTokens():
             self.tokenizer.advance()
 
@@ -618,7 +727,8 @@ class CompilationEngine:
     def ConsumeIdentifier(self):
         self.VerifyTokenType(TokenType.IDENTIFIER)
         actual = self.tokenizer.identifier()
-        self.OutputTag("identifierName", self.tokenizer.identifier())
+        if self.xml is not None:
+            self.xml.OutputTag("identifierName", actual)
         if self.tokenizer.hasMoreTokens():
             self.tokenizer.advance()
 
@@ -631,43 +741,260 @@ class CompilationEngine:
                             format(tokenType, actual))
 
     def EnterScope(self, name):
-        self.Output("<{}>".format(name))
-        self.indent_level += 1
+        if self.xml is not None:
+            self.xml.EnterScope(name)
 
     def ExitScope(self, name):
-        self.indent_level -= 1
-        self.Output("</{}>".format(name))
-
-    def ClassSymbolTableLookup(self, name, containingClass):
-        return self.class_symbol_tables[containingClass].GetEntry(name)
-
-    def SymbolTableLookup(self, name):
-        entry = self.local_symbol_table.GetEntry(name)
-        if entry is not None:
-            return entry
-        else:
-            return self.ClassSymbolTableLookup(name, self.current_class_name)
-
-    def WriteCode(self, line):
-        self.code_file.write(line + '\n')
-
-    def OutputTag(self, tag, value):
-        self.Output("<{}> {} </{}>".format(tag, value, tag))
-
-    def Output(self, text):
-        self.output_file.write(("  " * self.indent_level) + text + '\n')
-
-    def GenerateUniqueLabel(self):
-        self.unique_label_index += 1
-        return "pfl{0}".format(self.unique_label_index - 1)
+        if self.xml is not None:
+            self.xml.ExitScope(name)
+
+
+def AddStatistics(statistics, other):
+    """
+    Adds the counts of other into statistics; both are
+    {optimization: {item: count}}.
+    """
+    for optimization, counts in other.items():
+        total = statistics.setdefault(optimization, {})
+        for item, count in counts.items():
+            total[item] = total.get(item, 0) + count
+
+
+def PrintStatistics(statistics):
+    for optimization in sorted(statistics):
+        counts = statistics[optimization]
+        print "{0}: {1} {2}".format(optimization, sum(counts.values()),
+                                    statistics_units[optimization])
+        for item in sorted(counts):
+            print "  {0}: {1}".format(item, counts[item])
+
+
+def OptimizeProgram(engine, vm_code, roots=(), inline_size=default_max_size,
+                    inline_depth=default_max_depth):
+    """
+    Applies the program optimizations of the engine to the VM code of a
+    whole program, {key: [lines]}, where a class's key is its name or the
+    path of its .vm file. The engine must hold the declarations of every
+    class. Returns the optimized program, without the classes that were
+    dropped.
+    roots: where the program can be entered besides Main.main.
+    inline_size, inline_depth: the largest subroutine body to inline, and
+    how many levels of calls to inline into inlined code.
+    """
+    if "inline" in engine.optimizations:
+        inliner = Inliner(engine.class_symbol_tables, inline_size,
+                          inline_depth)
+        changed = inliner.Inline(vm_code)
+        if "peephole" in engine.optimizations:  # Clean up after inlining
+            for key, code in changed.items():
+                peephole = PeepholeOptimizer()
+                changed[key] = peephole.Optimize(code)
+                AddStatistics(engine.statistics, {"peephole": peephole.removed})
+        vm_code = dict(vm_code)
+        vm_code.update(changed)
+        AddStatistics(engine.statistics, {"inline": inliner.inlined})
+
+    if "shake" in engine.optimizations:
+        shaker = TreeShaker(default_roots + list(roots))
+        vm_code = shaker.Shake(vm_code)
+        AddStatistics(engine.statistics, {"shake": shaker.removed})
+
+    return vm_code
+
+
+def OptimizeProgramFiles(engine, vm_paths, *args):
+    """
+    OptimizeProgram for a program compiled to the given .vm files, which
+    are rewritten, or deleted if their class was dropped.
+    """
+    vm_code = {}
+    for vm_path in vm_paths:
+        with open(vm_path) as vm_file:
+            vm_code[vm_path] = vm_file.read().splitlines()
+
+    optimized = OptimizeProgram(engine, vm_code, *args)
+    for vm_path in vm_paths:
+        if vm_path not in optimized:
+            os.remove(vm_path)
+        elif optimized[vm_path] != vm_code[vm_path]:
+            with open(vm_path, 'w') as vm_file:
+                vm_file.write('\n'.join(optimized[vm_path]) + '\n')
+
+
+def CompileAssembly(engine, sources, asm_path, bootstrap=False, *args):
+    """
+    Compiles the given sources to one Hack assembly program, written to
+    asm_path. The .vm files in the sources' directories that have no
+    .jack source (e.g. the OS's) are translated with them. The engine
+    must already hold the declarations of every class. The other
+    arguments are passed on to OptimizeProgram.
+    """
+    vm_code = {}
+    for source_file in sources:
+        engine.SetClass(source_file)
+        vm_code[engine.current_class_name] = \
+            engine.CompileClass().splitlines()
+
+    if set(engine.optimizations) & set(program_optimizations):
+        vm_code = OptimizeProgram(engine, vm_code, *args)
+
+    for directory in set(os.path.dirname(source_file)
+                         for source_file in sources):
+        for vm_file in os.listdir(directory or "."):
+            class_name = vm_file[:-len(".vm")]
+            if vm_file.endswith(".vm") and \
+                    class_name not in engine.class_symbol_tables:
+                with open(os.path.join(directory, vm_file)) as library:
+                    vm_code[class_name] = library.read().splitlines()
+
+    code = AssemblyWriter(bootstrap).Translate(vm_code)
+    with open(asm_path, 'w') as asm_file:
+        asm_file.write('\n'.join(code) + '\n')
+
+
+# The project declarations a worker process compiles against, whether it
+# writes XML, the optimizations it applies and its backend; set once per
+# worker by InitWorker.
+worker_declarations = None
+
+
+def InitWorker(class_symbol_tables, type_size_map, xml_output, optimizations,
+               backend):
+    global worker_declarations
+    worker_declarations = (class_symbol_tables, type_size_map, xml_output,
+                           optimizations, backend)
+
+
+def CompileWorker(source_file):
+    """
+    Compiles one class in a worker process, against the declarations of
+    the whole project. Returns its dependencies and optimization
+    statistics.
+    """
+    class_symbol_tables, type_size_map, xml_output, optimizations, backend = \
+        worker_declarations
+    engine = CompilationEngine(xml_output, optimizations, backend)
+    engine.class_symbol_tables.update(class_symbol_tables)
+    engine.type_size_map.update(type_size_map)
+    engine.SetClass(source_file, source_file.replace(
+        ".jack", backend_extensions[backend]))
+    engine.CompileClass()
+    return engine.dependencies, engine.statistics
+
+
+def CompileParallel(engine, sources, jobs):
+    """
+    Compiles the given sources on a pool of worker processes. The engine
+    must already hold the declarations of every class; these are sent to
+    each worker once. Returns the dependencies of each compiled class, in
+    the order of the sources, and adds up the workers' statistics in the
+    engine.
+    """
+    pool = multiprocessing.Pool(jobs, InitWorker,
+                                (engine.class_symbol_tables,
+                                 engine.type_size_map, engine.xml_output,
+                                 engine.optimizations, engine.backend))
+    try:
+        results = pool.map(CompileWorker, sources)
+    finally:
+        pool.close()
+        pool.join()
+
+    for dependencies, statistics in results:
+        AddStatistics(engine.statistics, statistics)
+    return [dependencies for dependencies, statistics in results]
+
+
+def CompileSources(sources, optimizations=(), roots=(), backend="vm"):
+    """
+    Compiles the classes of a project given as Jack source texts, without
+    touching the filesystem. Returns {class name: VM code}, or {class
+    name: Python module} for the python backend. roots are passed on to
+    OptimizeProgram.
+    """
+    engine = CompilationEngine(optimizations=optimizations, backend=backend)
+    for source in sources:
+        engine.DeclareClass(None, source)
+
+    vm_code = {}
+    for source in sources:
+        engine.SetSource(source)
+        code = engine.CompileClass()
+        vm_code[engine.current_class_name] = code
+
+    if set(engine.optimizations) & set(program_optimizations):
+        optimized = OptimizeProgram(
+            engine, dict((class_name, code.splitlines())
+                         for class_name, code in vm_code.items()), roots)
+        vm_code = dict((class_name, '\n'.join(code) + '\n')
+                       for class_name, code in optimized.items())
+    return vm_code
+
+
+def CompileSource(source, optimizations=()):
+    """
+    Compiles one class given as Jack source text, and returns its VM
+    code.
+    """
+    return CompileSources([source], optimizations).values()[0]
 
 
 def main(args):
-    if len(args) != 1:
-        print "Usage: (python) CompilationEngine.py <inputPath>"
-        return
-
-    jack_file_path = args[0]
+    parser = argparse.ArgumentParser(prog="(python) CompilationEngine.py")
+    parser.add_argument("inputPath",
+                        help="a .jack file or a directory of .jack files")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of classes to compile in parallel")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="only recompile classes affected by changes "
+                             "since the last incremental build")
+    parser.add_argument("-x", "--xml", action="store_true",
+                        help="also write the parse tree of every class "
+                             "to a .vm.xml file")
+    parser.add_argument("-O", "--optimize", action="append", default=[],
+                        choices=optimization_names + ["all"],
+                        metavar="NAME",
+                        help="apply an optimization (may be repeated): "
+                             "%s, or all" % ", ".join(optimization_names))
+    parser.add_argument("-r", "--report", action="store_true",
+                        help="print what the optimizations did")
+    parser.add_argument("-b", "--backend", choices=backends, default="vm",
+                        help="generate VM code (the default), a Python "
+                             "module per class, or one Hack assembly file")
+    parser.add_argument("--bootstrap", action="store_true",
+                        help="start the Hack assembly with code that sets "
+                             "up the stack and calls Sys.init")
+    parser.add_argument("--root", action="append", default=[],
+                        metavar="CLASS.SUBROUTINE",
+                        help="keep this subroutine, and what it calls, when "
+                             "tree shaking (Main.main always is)")
+    parser.add_argument("--inline-size", type=int, default=default_max_size,
+                        metavar="N",
+                        help="inline subroutines of up to N instructions "
+                             "(default %(default)s)")
+    parser.add_argument("--inline-depth", type=int,
+                        default=default_max_depth, metavar="N",
+                        help="inline calls in inlined code up to N levels "
+                             "deep (default %(default)s)")
+    options = parser.parse_args(args)
+
+    optimizations = options.optimize
+    if "all" in optimizations:
+        optimizations = [name for name in optimization_names
+                         if name not in program_optimizations or
+                         not options.incremental]
+    if options.incremental and options.backend != "vm":
+        parser.error("--incremental needs the vm backend")
+    if options.xml and options.backend == "hack":
+        parser.error("--xml can't be used with the hack backend")
+    if options.bootstrap and options.backend != "hack":
+        parser.error("--bootstrap needs the hack backend")
+    if options.incremental and set(optimizations) & set(program_optimizations):
+        parser.error("{0} need the whole program, so they can't be used "
+                     "with --incremental".
+                     format(", ".join(program_optimizations)))
+
+    jack_file_path = options.inputPath
 
     sources = []
 
@@ -678,10 +1005,48 @@ def main(args):
     else:
         sources = [jack_file_path]
 
-    engine = CompilationEngine()
+    if options.incremental:
+        from IncrementalBuild import BuildIncremental
+        statistics = {}
+        BuildIncremental(sources, options.jobs, options.xml, optimizations,
+                         statistics)
+        if options.report:
+            PrintStatistics(statistics)
+        return
+
+    # Declare every class first, so code generation sees the whole project
+    engine = CompilationEngine(options.xml, optimizations, options.backend)
     for source_file in sources:
-        engine.SetClass(source_file, source_file.replace(".jack", ".vm"))
-        engine.CompileClass()
+        engine.DeclareClass(source_file)
+
+    if options.backend == "hack":
+        if jack_file_path.endswith(".jack"):
+            asm_path = jack_file_path.replace(".jack", ".asm")
+        else:
+            directory = os.path.normpath(jack_file_path)
+            asm_path = os.path.join(directory,
+                                    os.path.basename(directory) + ".asm")
+        CompileAssembly(engine, sources, asm_path, options.bootstrap,
+                        options.root, options.inline_size,
+                        options.inline_depth)
+    elif options.jobs > 1 and len(sources) > 1:
+        CompileParallel(engine, sources, options.jobs)
+    else:
+        extension = backend_extensions[options.backend]
+        for source_file in sources:
+            engine.SetClass(source_file,
+                            source_file.replace(".jack", extension))
+            engine.CompileClass()
+
+    if set(engine.optimizations) & set(program_optimizations) and \
+            options.backend != "hack":
+        OptimizeProgramFiles(engine, [source_file.replace(".jack", ".vm")
+                                      for source_file in sources],
+                             options.root, options.inline_size,
+                             options.inline_depth)
+
+    if options.report:
+        PrintStatistics(engine.statistics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+from CompilationEngine import CompilationEngine
+import SocketServer
+import sys
+import os
+import json
+import socket
+import hashlib
+import threading
+
+
+class DeclarationCache(object):
+    """
+    Class declarations kept warm between requests. Files are keyed by
+    their path and revalidated by their stat; in-memory sources are keyed
+    by their content hash. The cached symbol tables are only read during
+    compilation, so concurrent requests share them.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def Declare(self, key, version, source_file, source=None):
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1:]
+
+        engine = CompilationEngine()
+        class_name = engine.DeclareClass(source_file, source)
+        cached = (version, class_name,
+                  engine.class_symbol_tables[class_name],
+                  engine.type_size_map[class_name])
+        with self.lock:
+            self.entries[key] = cached
+        return cached[1:]
+
+    def DeclareFile(self, source_file):
+        source_file = os.path.realpath(source_file)
+        stat = os.stat(source_file)
+        return self.Declare(source_file, (stat.st_mtime, stat.st_size),
+                            source_file)
+
+    def DeclareSource(self, source):
+        digest = hashlib.sha1(source).hexdigest()
+        return self.Declare("source:" + digest, digest, None, source)
+
+
+class CompileRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves newline-delimited JSON requests on one connection, answering
+    each with one JSON line:
+        {"ok": true, "vm": {"<class>": "<vm code>", ...}}
+        {"ok": false, "error": "<diagnostic>"}
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                response = {"ok": True,
+                            "vm": self.server.Compile(json.loads(line))}
+            except Exception as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class CompileServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    """
+    A long-running compiler serving requests over a Unix domain socket.
+    A request names .jack files to compile, in-memory sources, or both,
+    and optionally the optimizations to apply:
+        {"files": ["<path>", ...], "sources": {"<class>": "<jack code>"},
+         "optimize": ["<name>", ...]}
+    Files are compiled against all the .jack files in their directory.
+    Nothing is written to disk; the VM code is only sent back.
+    Every request gets its own CompilationEngine, so only the cached
+    declarations are shared between clients.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               CompileRequestHandler)
+        self.declarations = DeclarationCache()
+
+    def Compile(self, request):
+        engine = CompilationEngine(
+            optimizations=[str(name) for name in request.get("optimize", [])])
+        files = []
+        sources = []
+
+        def Declare(declaration):
+            class_name, table, size = declaration
+            engine.class_symbol_tables[class_name] = table
+            engine.type_size_map[class_name] = size
+            return class_name
+
+        directories = set()
+        for source_file in request.get("files", []):
+            directories.add(os.path.dirname(os.path.abspath(source_file)))
+            files.append(source_file)
+        for directory in directories:
+            for project_file in os.listdir(directory):
+                if project_file.endswith(".jack"):
+                    Declare(self.declarations.DeclareFile(
+                        os.path.join(directory, project_file)))
+
+        for source in request.get("sources", {}).values():
+            source = source.encode('utf-8')
+            Declare(self.declarations.DeclareSource(source))
+            sources.append(source)
+
+        vm = {}
+        for source_file in files:
+            engine.SetClass(source_file)
+            vm[engine.current_class_name] = engine.CompileClass()
+        for source in sources:
+            engine.SetSource(source)
+            vm[engine.current_class_name] = engine.CompileClass()
+        return vm
+
+
+def SendRequest(socket_path, request):
+    """
+    Sends one request to a running CompileServer and returns its answer.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        stream = client.makefile('rw')
+        stream.write(json.dumps(request) + '\n')
+        stream.flush()
+        return json.loads(stream.readline())
+    finally:
+        client.close()
+
+
+def main(args):
+    if len(args) != 1:
+        print "Usage: (python) CompileServer.py <socketPath>"
+        return
+
+    socket_path = args[0]
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = CompileServer(socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,291 @@
+from JackAST import (LetStatement, IfStatement, WhileStatement, DoStatement,
+                     ReturnStatement, IntegerConstant, KeywordConstant,
+                     VarRef, ArrayRef, SubroutineCall, UnaryOp, BinaryOp)
+
+
+def Wrap(value):
+    """
+    Reduces a Python integer to the VM's 16-bit two's complement range.
+    """
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def Divide(x, y):
+    """
+    Math.divide: the quotient of the magnitudes, negated when the signs
+    differ (so it rounds towards zero).
+    """
+    quotient = abs(x) // abs(y)
+    return Wrap(-quotient if (x < 0) != (y < 0) else quotient)
+
+
+binary_operations = {'+': lambda x, y: Wrap(x + y),
+                     '-': lambda x, y: Wrap(x - y),
+                     '*': lambda x, y: Wrap(x * y),
+                     '/': Divide,
+                     '&': lambda x, y: x & y,
+                     '|': lambda x, y: x | y,
+                     '<': lambda x, y: -1 if x < y else 0,
+                     '>': lambda x, y: -1 if x > y else 0,
+                     '=': lambda x, y: -1 if x == y else 0}
+
+unary_operations = {'-': lambda x: Wrap(-x),
+                    '~': lambda x: ~x}
+
+keyword_values = {'true': -1, 'false': 0, 'null': 0}
+
+
+def ConstantValue(node):
+    """
+    Returns the value of a constant expression node, or None.
+    """
+    if isinstance(node, IntegerConstant):
+        return node.value
+    if isinstance(node, KeywordConstant):
+        return keyword_values.get(node.keyword)
+    return None
+
+
+class ConstantFolder(object):
+    """
+    Folds constant subexpressions of a class's AST in place, with the
+    VM's 16-bit semantics, and propagates constants through locals that
+    are assigned once.
+    Folded values may be negative; the code generator knows how to push
+    them.
+    """
+
+    def FoldClass(self, class_node):
+        for subroutine in class_node.subroutines:
+            self.FoldSubroutine(subroutine)
+
+    def FoldSubroutine(self, subroutine):
+        local_names = set()
+        for var_dec in subroutine.local_vars:
+            local_names.update(var_dec.names)
+        # Parameters shadow nothing here, but a parameter is never a
+        # single-assignment constant
+        for varType, name in subroutine.parameters:
+            local_names.discard(name)
+
+        statements = self.FoldStatements(subroutine.statements)
+        while True:
+            constants = self.FindConstantLocals(statements, local_names)
+            if not constants:
+                break
+            statements = self.Propagate(statements, constants)
+            statements = self.FoldStatements(statements)
+        subroutine.statements = statements
+
+    # Folding
+
+    def FoldStatements(self, statements):
+        folded = []
+        for statement in statements:
+            folded.extend(self.FoldStatement(statement))
+        return folded
+
+    def FoldStatement(self, node):
+        """
+        Returns the statements that replace node.
+        """
+        if isinstance(node, LetStatement):
+            if node.index is not None:
+                node.index = self.FoldExpression(node.index)
+            node.value = self.FoldExpression(node.value)
+        elif isinstance(node, DoStatement):
+            node.call = self.FoldExpression(node.call)
+        elif isinstance(node, ReturnStatement):
+            if node.value is not None:
+                node.value = self.FoldExpression(node.value)
+        elif isinstance(node, IfStatement):
+            node.condition = self.FoldExpression(node.condition)
+            node.then_statements = self.FoldStatements(node.then_statements)
+            if node.else_statements is not None:
+                node.else_statements = \
+                    self.FoldStatements(node.else_statements)
+            condition = ConstantValue(node.condition)
+            if condition is not None:  # Only one branch can ever run
+                if condition != 0:
+                    return node.then_statements
+                return node.else_statements or []
+        elif isinstance(node, WhileStatement):
+            node.condition = self.FoldExpression(node.condition)
+            node.statements = self.FoldStatements(node.statements)
+            if ConstantValue(node.condition) == 0:  # Never entered
+                return []
+        return [node]
+
+    def FoldExpression(self, node):
+        """
+        Returns the folded form of an expression node.
+        """
+        if isinstance(node, BinaryOp):
+            node.left = self.FoldExpression(node.left)
+            node.right = self.FoldExpression(node.right)
+            left = ConstantValue(node.left)
+            right = ConstantValue(node.right)
+            if left is not None and right is not None:
+                if node.op == '/' and (right == 0 or left == -32768 or
+                                       right == -32768):
+                    return node  # Leave the OS's error and edge cases alone
+                return IntegerConstant(binary_operations[node.op](left, right),
+                                       node.position)
+            return self.Reassociate(node)
+
+        if isinstance(node, UnaryOp):
+            node.operand = self.FoldExpression(node.operand)
+            operand = ConstantValue(node.operand)
+            if operand is not None:
+                return IntegerConstant(unary_operations[node.op](operand),
+                                       node.position)
+            return node
+
+        if isinstance(node, ArrayRef):
+            node.index = self.FoldExpression(node.index)
+        elif isinstance(node, SubroutineCall):
+            node.arguments = [self.FoldExpression(argument)
+                              for argument in node.arguments]
+        return node
+
+    def Reassociate(self, node):
+        """
+        (x + c1) + c2 becomes x + (c1 + c2), and likewise for -; addition
+        modulo 2^16 is associative, so this is exact.
+        """
+        right = ConstantValue(node.right)
+        left = node.left
+        if (right is None or node.op not in '+-' or
+                not isinstance(left, BinaryOp) or left.op not in '+-'):
+            return node
+        inner = ConstantValue(left.right)
+        if inner is None:
+            return node
+
+        if left.op == '-':
+            inner = -inner
+        total = Wrap(inner + right if node.op == '+' else inner - right)
+        if total < 0 and total != -32768:
+            return BinaryOp('-', left.left,
+                            IntegerConstant(-total, node.position),
+                            node.position)
+        return BinaryOp('+', left.left, IntegerConstant(total, node.position),
+                        node.position)
+
+    # Propagation
+
+    def FindConstantLocals(self, statements, local_names):
+        """
+        Returns {name: value} for the locals that are assigned exactly
+        once, by a top-level statement, to a constant, and are only read
+        after that statement, and never as an array or an object.
+        """
+        assignments = {}
+        disqualified = set()
+        read_before = set()
+
+        def Reads(node, names):
+            if isinstance(node, VarRef):
+                names.add(node.name)
+            elif isinstance(node, ArrayRef):
+                disqualified.add(node.name)
+                Reads(node.index, names)
+            elif isinstance(node, SubroutineCall):
+                if node.prefix is not None:
+                    disqualified.add(node.prefix)
+                for argument in node.arguments:
+                    Reads(argument, names)
+            elif isinstance(node, BinaryOp):
+                Reads(node.left, names)
+                Reads(node.right, names)
+            elif isinstance(node, UnaryOp):
+                Reads(node.operand, names)
+
+        def Walk(statements, top_level, names):
+            for statement in statements:
+                if isinstance(statement, LetStatement):
+                    if statement.index is not None:
+                        disqualified.add(statement.name)
+                        Reads(statement.index, names)
+                    Reads(statement.value, names)
+                    if statement.index is None:
+                        if statement.name in assignments or not top_level:
+                            disqualified.add(statement.name)
+                        else:
+                            assignments[statement.name] = statement
+                            if statement.name in names:
+                                read_before.add(statement.name)
+                elif isinstance(statement, DoStatement):
+                    Reads(statement.call, names)
+                elif isinstance(statement, ReturnStatement):
+                    if statement.value is not None:
+                        Reads(statement.value, names)
+                elif isinstance(statement, IfStatement):
+                    Reads(statement.condition, names)
+                    Walk(statement.then_statements, False, names)
+                    if statement.else_statements is not None:
+                        Walk(statement.else_statements, False, names)
+                elif isinstance(statement, WhileStatement):
+                    Reads(statement.condition, names)
+                    Walk(statement.statements, False, names)
+
+        Walk(statements, True, set())
+
+        constants = {}
+        for name, statement in assignments.items():
+            value = ConstantValue(statement.value)
+            if (name in local_names and value is not None and
+                    name not in disqualified and name not in read_before):
+                constants[name] = value
+        return constants
+
+    def Propagate(self, statements, constants):
+        """
+        Replaces reads of the given locals by their values, and drops
+        their assignments.
+        """
+        def Replace(node):
+            if isinstance(node, VarRef) and node.name in constants:
+                return IntegerConstant(constants[node.name], node.position)
+            if isinstance(node, BinaryOp):
+                node.left = Replace(node.left)
+                node.right = Replace(node.right)
+            elif isinstance(node, UnaryOp):
+                node.operand = Replace(node.operand)
+            elif isinstance(node, ArrayRef):
+                node.index = Replace(node.index)
+            elif isinstance(node, SubroutineCall):
+                node.arguments = [Replace(argument)
+                                  for argument in node.arguments]
+            return node
+
+        def Walk(statements):
+            kept = []
+            for statement in statements:
+                if isinstance(statement, LetStatement):
+                    if (statement.index is None and
+                            statement.name in constants):
+                        continue
+                    if statement.index is not None:
+                        statement.index = Replace(statement.index)
+                    statement.value = Replace(statement.value)
+                elif isinstance(statement, DoStatement):
+                    statement.call = Replace(statement.call)
+                elif isinstance(statement, ReturnStatement):
+                    if statement.value is not None:
+                        statement.value = Replace(statement.value)
+                elif isinstance(statement, IfStatement):
+                    statement.condition = Replace(statement.condition)
+                    statement.then_statements = \
+                        Walk(statement.then_statements)
+                    if statement.else_statements is not None:
+                        statement.else_statements = \
+                            Walk(statement.else_statements)
+                elif isinstance(statement, WhileStatement):
+                    statement.condition = Replace(statement.condition)
+                    statement.statements = Walk(statement.statements)
+                kept.append(statement)
+            return kept
+
+        return Walk(statements)
@@ -0,0 +1,250 @@
+from TreeShaker import SplitFunctions
+
+# Longest loop condition copied to the bottom of its loop, so the loop
+# branches back on the condition instead of jumping up to test it
+max_duplicate_size = 8
+
+# The commands whose result is always true (-1) or false (0). not is
+# bitwise, so it only inverts a condition when applied to one of these.
+comparison_commands = ['eq', 'gt', 'lt']
+
+
+def Parse(line):
+    return line.split('//', 1)[0].split()
+
+
+def IsComparison(lines):
+    """
+    Do the lines end with a comparison, possibly followed by a not, so
+    that a branch on them can be inverted by adding or dropping a not?
+    """
+    words = [Parse(line) for line in lines[-2:]]
+    if words and words[-1] == ['not']:
+        words.pop()
+    return bool(words) and bool(words[-1]) and \
+        words[-1][0] in comparison_commands
+
+
+class Block(object):
+    """
+    A basic block: straight-line lines entered only through its labels or
+    from the block before it, ending in its terminator (a goto, if-goto
+    or return line), or falling through if that is None.
+    """
+    __slots__ = ('labels', 'lines', 'terminator', 'target', 'next', 'label')
+
+    def __init__(self):
+        self.labels = []
+        self.lines = []
+        self.terminator = None
+        self.target = None  # The block a goto or if-goto jumps to
+        self.next = None  # The block execution falls through to
+        self.label = None  # The label of the block in the new layout
+
+    def Jump(self):
+        if self.terminator is None:
+            return None
+        return Parse(self.terminator)[0]
+
+
+class ControlFlowOptimizer(object):
+    """
+    Rebuilds the code of each function from its control-flow graph:
+    jumps go straight to their final target, blocks that can't be
+    reached and labels nothing jumps to are dropped, and blocks are laid
+    out so that execution falls through instead of jumping where it can.
+    A loop condition that is a short enough comparison is also copied to
+    the bottom of its loop, inverted, so each iteration takes one jump
+    instead of two. Branches are only inverted on comparisons, since not
+    is bitwise.
+    removed counts the lines taken out, by kind; duplicated lines are
+    counted as negative.
+    """
+
+    def __init__(self):
+        self.removed = {'unreachable': 0, 'jumps': 0, 'labels': 0,
+                        'duplicated': 0}
+        self.new_label_index = 0
+
+    def Optimize(self, code):
+        optimized = []
+        for name, lines in SplitFunctions(code):
+            optimized.append(lines[0])
+            optimized.extend(self.OptimizeFunction(lines[1:]))
+        return optimized
+
+    def BuildBlocks(self, lines):
+        blocks = [Block()]
+        for line in lines:
+            words = Parse(line)
+            if words[0] == 'label':
+                if blocks[-1].lines or blocks[-1].terminator is not None:
+                    blocks.append(Block())
+                blocks[-1].labels.append(words[1])
+                continue
+            if blocks[-1].terminator is not None:
+                blocks.append(Block())
+            if words[0] in ('goto', 'if-goto', 'return'):
+                blocks[-1].terminator = line
+            else:
+                blocks[-1].lines.append(line)
+
+        label_blocks = {}
+        for block in blocks:
+            for label in block.labels:
+                label_blocks[label] = block
+        for index, block in enumerate(blocks):
+            jump = block.Jump()
+            if jump in ('goto', 'if-goto'):
+                block.target = label_blocks[Parse(block.terminator)[1]]
+            if jump in (None, 'if-goto') and index + 1 < len(blocks):
+                block.next = blocks[index + 1]
+        return blocks
+
+    def Resolve(self, block):
+        """
+        Follows empty blocks that only jump or fall through elsewhere to
+        the block execution really continues at.
+        """
+        seen = set()
+        while block is not None and not block.lines and block not in seen:
+            seen.add(block)
+            jump = block.Jump()
+            if jump == 'goto':
+                block = block.target
+            elif jump is None and block.next is not None:
+                block = block.next
+            else:
+                break
+        return block
+
+    def OptimizeFunction(self, lines):
+        blocks = self.BuildBlocks(lines)
+        for block in blocks:
+            block.target = self.Resolve(block.target)
+            block.next = self.Resolve(block.next)
+
+        reachable = set()
+        pending = [blocks[0]]
+        while pending:
+            block = pending.pop()
+            if block is None or block in reachable:
+                continue
+            reachable.add(block)
+            pending += [block.target, block.next]
+
+        for block in blocks:
+            if block not in reachable:
+                self.removed['unreachable'] += len(block.labels) + \
+                    len(block.lines) + (block.terminator is not None)
+        blocks = [block for block in blocks if block in reachable]
+
+        layout = self.Layout(blocks)
+        return self.Emit(blocks, layout)
+
+    def Layout(self, blocks):
+        """
+        Orders the blocks into chains of fall-throughs, starting from the
+        entry, and decides how each one ends. Returns [(block, lines,
+        jumps)] where jumps are ('goto' or 'if-goto', target block),
+        ('not',) or ('return', line).
+        """
+        order = dict((block, index) for index, block in enumerate(blocks))
+        placed = set()
+        layout = []
+
+        def Unplaced(block):
+            return block is not None and block not in placed
+
+        for start in blocks:
+            block = start
+            while Unplaced(block):
+                placed.add(block)
+                lines = list(block.lines)
+                jump = block.Jump()
+                target, following = block.target, block.next
+
+                if jump == 'goto' and not Unplaced(target) and \
+                        target.Jump() == 'if-goto' and target is not block and \
+                        len(target.lines) <= max_duplicate_size and \
+                        IsComparison(target.lines):
+                    # Test the loop condition here again, inverted
+                    lines += target.lines
+                    self.removed['duplicated'] -= len(target.lines)
+                    jump = 'if-goto'
+                    target, following = target.target, target.next
+
+                jumps = []
+                successor = None
+                if jump == 'return':
+                    jumps.append(('return', block.terminator))
+                elif jump == 'goto':
+                    if Unplaced(target):
+                        successor = target
+                    else:
+                        jumps.append(('goto', target))
+                elif jump == 'if-goto':
+                    if Unplaced(following) and (not Unplaced(target) or
+                                                order[following] <=
+                                                order[target] or
+                                                not IsComparison(lines)):
+                        jumps.append(('if-goto', target))
+                        successor = following
+                    elif Unplaced(target):
+                        # Branch away on the opposite condition instead
+                        jumps += [('invert',), ('if-goto', following)]
+                        successor = target
+                    else:
+                        jumps += [('if-goto', target), ('goto', following)]
+                elif following is not None:
+                    if Unplaced(following):
+                        successor = following
+                    else:
+                        jumps.append(('goto', following))
+
+                layout.append((block, lines, jumps))
+                block = successor
+        return layout
+
+    def Emit(self, blocks, layout):
+        targets = set()
+        for block, lines, jumps in layout:
+            for jump in jumps:
+                if jump[0] in ('goto', 'if-goto'):
+                    targets.add(jump[1])
+
+        for block, lines, jumps in layout:
+            self.removed['labels'] += len(block.labels)
+            if block in targets:
+                if block.labels:
+                    block.label = block.labels[-1]
+                else:
+                    block.label = "cfg{0}".format(self.new_label_index)
+                    self.new_label_index += 1
+                self.removed['labels'] -= 1
+
+        code = []
+        for block, lines, jumps in layout:
+            if block.label is not None:
+                code.append("label {0}".format(block.label))
+            code.extend(lines)
+            for jump in jumps:
+                if jump[0] == 'return':
+                    code.append(jump[1])
+                elif jump[0] == 'invert':
+                    if Parse(code[-1]) == ['not']:
+                        code.pop()
+                        self.removed['jumps'] += 1
+                    else:
+                        code.append("not")
+                        self.removed['jumps'] -= 1
+                else:
+                    code.append("{0} {1}".format(jump[0], jump[1].label))
+
+        original_jumps = sum(block.Jump() in ('goto', 'if-goto')
+                             for block in blocks)
+        emitted_jumps = sum(jump[0] in ('goto', 'if-goto')
+                            for block, lines, jumps in layout
+                            for jump in jumps)
+        self.removed['jumps'] += original_jumps - emitted_jumps
+        return code
@@ -0,0 +1,458 @@
+from CompilationEngine import CompileSources, optimization_names
+from VMInterpreter import VMInterpreter
+from AssemblyWriter import AssemblyWriter
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+import argparse
+
+# The lines the keyboard reads, for the samples that read numbers
+sample_inputs = ["3", "10", "20", "30"]
+
+# Prints what Main.main returns, for the programs below. The hack backend
+# runs them without it (and without the OS) and reads the result from the
+# stack.
+harness_source = """
+class Sys {
+    function void init() {
+        do Output.printInt(Main.main());
+        return;
+    }
+}
+"""
+
+# Programs that exercise the corners of the optimizations and backends.
+# They don't use the OS, apart from the classes they define themselves.
+conditions_source = """
+class Main {
+    function int main() {
+        var int x, n, r, count;
+        let x = 5;
+        if (x & 1) { let r = 1; }
+        if (x) { let r = r + 2; } else { let r = r - 2; }
+        if (~x) { let r = r + 4; }
+        if (x = 5) { let r = r + 8; }
+        if (~(x = 5)) { let r = r + 16; } else { let r = r + 32; }
+        if (x & 2) { let r = r + 64; } else { let r = r + 128; }
+        let n = 3;
+        while (n) { let count = count + 1; let n = n - 1; }
+        let n = 3;
+        while (~(n = 0)) { let count = count + 16; let n = n - 1; }
+        let n = 0;
+        while (~n) { let count = count + 256; let n = n - 1; }
+        let n = -1;
+        while (n) { let count = count + 1024; let n = n + 1; }
+        let n = 4;
+        while ((n > 0) & (n < 10)) {
+            let count = count + 2048;
+            let n = n - 2;
+        }
+        return r + count;
+    }
+}
+"""
+
+recursion_source = """
+class Main {
+    function int fib(int n) {
+        if (n < 2) { return n; }
+        return Main.fib(n - 1) + Main.fib(n - 2);
+    }
+    function int sum(int n, int acc) {
+        if (n = 0) { return acc; }
+        return Main.sum(n - 1, acc + n);
+    }
+    function int down(int n) {
+        var int t;
+        let t = n - 1;
+        if (t) { return Main.down(t); }
+        return n;
+    }
+    function int main() {
+        return Main.fib(12) + Main.sum(100, 0) + Main.down(40);
+    }
+}
+"""
+
+objects_source = """
+class Memory {
+    static int free;
+    function int alloc(int size) {
+        var int block;
+        if (free = 0) { let free = 2048; }
+        let block = free;
+        let free = free + size;
+        return block;
+    }
+}
+class Counter {
+    field int value, mask;
+    constructor Counter new(int m) {
+        let value = 0;
+        let mask = m;
+        return this;
+    }
+    method int get() { return value; }
+    method void add(int n) { let value = value + (n & mask); return; }
+    method int odd() { return value & 1; }
+}
+class Main {
+    function int main() {
+        var Counter c, d;
+        var int i, r;
+        let c = Counter.new(7);
+        let d = Counter.new(-1);
+        let i = 0;
+        while (i < 20) {
+            do c.add(i);
+            do d.add(c.get());
+            if (c.odd()) { let r = r + 1; }
+            let i = i + 1;
+        }
+        return d.get() + r + c.get();
+    }
+}
+"""
+
+arithmetic_source = """
+class Math {
+    function int multiply(int x, int y) {
+        var int sum, bit, i;
+        let bit = 1;
+        while (i < 16) {
+            if (~((y & bit) = 0)) { let sum = sum + x; }
+            let x = x + x;
+            let bit = bit + bit;
+            let i = i + 1;
+        }
+        return sum;
+    }
+    function int divide(int x, int y) {
+        var int q, sign;
+        let sign = 1;
+        if (x < 0) { let x = -x; let sign = -sign; }
+        if (y < 0) { let y = -y; let sign = -sign; }
+        while (~(x < y)) { let x = x - y; let q = q + 1; }
+        if (sign < 0) { return -q; }
+        return q;
+    }
+}
+class Main {
+    function int main() {
+        var int x, y, r;
+        let x = -32767 - 1;
+        let y = 1;
+        if (x < y) { let r = r + 1; }
+        if (y > x) { let r = r + 2; }
+        if (x > y) { let r = r + 4; }
+        let x = 30000;
+        let y = -30000;
+        if (x > y) { let r = r + 8; }
+        if (y < x) { let r = r + 16; }
+        let x = 1234;
+        let r = r + (x * 8) + (x * 3) + (x * -2) + (x / 4) + (-x / 16);
+        let r = r + ((x * x) / 100) + (x * 0) + (x / 1);
+        return r + (x - y) + (32767 + x);
+    }
+}
+"""
+
+arrays_source = """
+class Memory {
+    static int free;
+    function int alloc(int size) {
+        var int block;
+        if (free = 0) { let free = 2048; }
+        let block = free;
+        let free = free + size;
+        return block;
+    }
+}
+class Array {
+    function Array new(int size) { return Memory.alloc(size); }
+}
+class Main {
+    function int main() {
+        var Array a, b;
+        var int i, sum;
+        let a = Array.new(10);
+        let b = Array.new(10);
+        let i = 0;
+        while (i < 10) {
+            let a[i] = i + i;
+            let b[i] = a[i] + a[i];
+            let i = i + 1;
+        }
+        let a[0] = b[9];
+        let a[a[3]] = a[1] + b[2];
+        let b[1] = a[6] + a[0];
+        let i = 0;
+        while (i < 10) {
+            let sum = sum + a[i] + b[i] - a[i];
+            let i = i + 1;
+        }
+        return sum + a[0] + a[6] + b[1];
+    }
+}
+"""
+
+# (name, source of the classes, backends to run it with besides the VM).
+# Arrays are addresses here, which the python backend doesn't support.
+edge_programs = [("conditions", conditions_source, ['python', 'hack']),
+                 ("recursion", recursion_source, ['python', 'hack']),
+                 ("objects", objects_source, ['python', 'hack']),
+                 ("arithmetic", arithmetic_source, ['python', 'hack']),
+                 ("arrays", arrays_source, ['hack'])]
+
+
+def SplitSources(text):
+    """
+    Splits Jack source text holding several classes into one source per
+    class.
+    """
+    return ["class" + source for source in text.split("\nclass")[1:]]
+
+
+def Configurations():
+    """
+    The optimization sets to test: each optimization alone, then all of
+    them.
+    """
+    return [[name] for name in optimization_names] + [optimization_names]
+
+
+def RunVM(sources, optimizations, max_steps, roots=()):
+    """
+    Compiles and runs a program on the VM interpreter. Returns its
+    output, or None if it didn't halt.
+    """
+    vm_code = CompileSources(sources, optimizations, roots)
+    interpreter = VMInterpreter(vm_code, sample_inputs)
+    if not interpreter.Run(max_steps):
+        return None
+    return interpreter.Output()
+
+
+def RunPython(sources, optimizations):
+    """
+    Compiles a program with the python backend, and runs it with
+    PythonRuntime in another process. Returns its output.
+    """
+    modules = CompileSources(sources, optimizations, backend="python")
+    directory = tempfile.mkdtemp()
+    try:
+        for class_name, module in modules.items():
+            with open(os.path.join(directory, class_name + ".py"),
+                      'w') as module_file:
+                module_file.write(module)
+        runtime = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "PythonRuntime.py")
+        arguments = [sys.executable, runtime, directory]
+        for line in sample_inputs:
+            arguments += ["--input", line]
+        output = subprocess.check_output(arguments)
+    finally:
+        shutil.rmtree(directory)
+    return output
+
+
+def RunHack(sources, optimizations, max_steps):
+    """
+    Compiles a program with the hack backend, with the bootstrap, and
+    runs it on a Hack CPU. Returns what Main.main returned, or None if it
+    didn't return.
+    """
+    vm_code = CompileSources(sources, optimizations)
+    code = AssemblyWriter(True).Translate(
+        dict((class_name, lines.splitlines())
+             for class_name, lines in vm_code.items()))
+    instructions, symbols = Assemble(code)
+    memory = [0] * 32768
+    if not Execute(instructions, memory, symbols["$halt"], max_steps):
+        return None
+    return str(memory[256])
+
+
+def Assemble(code):
+    """
+    Assembles Hack assembly into [(is A-instruction, value or (comp, dest,
+    jump))], and returns them with the symbol table.
+    """
+    symbols = {'SP': 0, 'LCL': 1, 'ARG': 2, 'THIS': 3, 'THAT': 4,
+               'SCREEN': 16384, 'KBD': 24576}
+    for register in range(16):
+        symbols["R{0}".format(register)] = register
+    lines = []
+    for line in code:
+        line = line.split('//', 1)[0].strip()
+        if line.startswith('('):
+            symbols[line[1:-1]] = len(lines)
+        elif line:
+            lines.append(line)
+
+    instructions = []
+    next_variable = 16
+    for line in lines:
+        if line.startswith('@'):
+            value = line[1:]
+            if not value.isdigit():
+                if value not in symbols:
+                    symbols[value] = next_variable
+                    next_variable += 1
+                value = symbols[value]
+            instructions.append((True, int(value)))
+        else:
+            dest, comp, jump = '', line, ''
+            if '=' in comp:
+                dest, comp = comp.split('=', 1)
+            if ';' in comp:
+                comp, jump = comp.split(';', 1)
+            instructions.append((False, (comp, dest, jump)))
+    return instructions, symbols
+
+
+def Compute(comp, a, d, m):
+    """
+    What the ALU computes for comp; the register names stand for their
+    values.
+    """
+    values = {'A': a, 'D': d, 'M': m}
+    if comp in ('0', '1', '-1'):
+        return int(comp)
+    if len(comp) == 1:
+        return values[comp]
+    if len(comp) == 2:
+        operand = values[comp[1]]
+        return ~operand if comp[0] == '!' else -operand
+    x, op, y = values[comp[0]], comp[1], comp[2:]
+    y = 1 if y == '1' else values[y]
+    return {'+': x + y, '-': x - y, '&': x & y, '|': x | y}[op]
+
+
+jump_conditions = {'': lambda value: False,
+                   'JGT': lambda value: value > 0,
+                   'JEQ': lambda value: value == 0,
+                   'JGE': lambda value: value >= 0,
+                   'JLT': lambda value: value < 0,
+                   'JNE': lambda value: value != 0,
+                   'JLE': lambda value: value <= 0,
+                   'JMP': lambda value: True}
+
+
+def Execute(instructions, memory, halt, max_steps):
+    """
+    Runs assembled instructions from address 0 until they reach halt, or
+    for max_steps. Returns whether they reached halt.
+    """
+    a = d = pc = 0
+    for step in xrange(max_steps):
+        if pc == halt:
+            return True
+        is_address, value = instructions[pc]
+        pc += 1
+        if is_address:
+            a = value
+            continue
+        comp, dest, jump = value
+        result = (Compute(comp, a, d, memory[a & 32767]) + 32768 & 65535) - \
+            32768
+        target = a
+        if 'M' in dest:
+            memory[a & 32767] = result
+        if 'D' in dest:
+            d = result
+        if 'A' in dest:
+            a = result
+        if jump_conditions[jump](result):
+            pc = target & 32767
+    return False
+
+
+def TestProgram(name, sources, backends, max_steps, harness=False):
+    """
+    Runs a program without optimizations, then with every configuration
+    and backend, and returns a description of every run whose output
+    differs. With harness, the program's output is what Main.main
+    returns.
+    """
+    failures = []
+    roots = []
+    printed_sources = sources
+    if harness:
+        roots = ["Sys.init"]
+        printed_sources = sources + [harness_source]
+    expected = RunVM(printed_sources, [], max_steps, roots)
+    if expected is None:
+        print "{0}: skipped, it doesn't halt in {1} steps".format(name,
+                                                                  max_steps)
+        return failures
+
+    runs = [("vm", optimizations, lambda optimizations:
+             RunVM(printed_sources, optimizations, max_steps, roots))
+            for optimizations in Configurations()]
+    if 'python' in backends:
+        runs += [("python", optimizations, lambda optimizations:
+                  RunPython(printed_sources, optimizations))
+                 for optimizations in ([], optimization_names)]
+    if 'hack' in backends:
+        runs += [("hack", optimizations, lambda optimizations:
+                  RunHack(sources, optimizations, max_steps))
+                 for optimizations in [[]] + Configurations()]
+
+    for backend, optimizations, run in runs:
+        try:
+            output = run(optimizations)
+        except Exception as error:
+            output = "error: {0}".format(error)
+        if output != expected:
+            failures.append("{0}: -b {1} -O {2}: expected {3!r}, got {4!r}".
+                            format(name, backend,
+                                   ",".join(optimizations) or "none",
+                                   expected, output))
+    print "{0}: {1} runs, {2} differences".format(name, len(runs),
+                                                  len(failures))
+    return failures
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Check that every optimization and backend preserves "
+                    "what the programs print")
+    parser.add_argument("samples", nargs="?",
+                        default=os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)),
+                            "Input"),
+                        help="a directory of sample program directories "
+                             "(default: Input)")
+    parser.add_argument("-s", "--steps", type=int, default=10000000,
+                        metavar="N",
+                        help="stop a program after N instructions "
+                             "(default %(default)s)")
+    options = parser.parse_args(args)
+
+    failures = []
+    for name, text, backends in edge_programs:
+        failures += TestProgram(name, SplitSources(text), backends,
+                                options.steps, True)
+
+    for sample in sorted(os.listdir(options.samples)):
+        directory = os.path.join(options.samples, sample)
+        sources = []
+        for source_file in sorted(os.listdir(directory)):
+            if source_file.endswith(".jack"):
+                with open(os.path.join(directory, source_file)) as source:
+                    sources.append(source.read())
+        if sources:
+            failures += TestProgram(sample, sources, ['python'],
+                                    options.steps)
+
+    for failure in failures:
+        print failure
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
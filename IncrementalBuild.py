@@ -0,0 +1,182 @@
+from CompilationEngine import (CompilationEngine, CompileParallel,
+                               AddStatistics)
+from SymbolTable import SymbolTable, SymbolTableEntry
+import os
+import json
+import hashlib
+
+state_file_name = ".jack_build_state"
+state_version = 1
+
+
+def ExportInterface(table, size):
+    """
+    Returns what other classes can see of a class: its fields, statics
+    and subroutine kinds, and its instance size.
+    """
+    symbols = sorted([entry.name] + entry.Describe()
+                     for entry in table.SymbolMap.values())
+    return {"size": size, "symbols": symbols}
+
+
+def ImportInterface(interface):
+    """
+    Rebuilds a class symbol table from an exported interface.
+    """
+    table = SymbolTable()
+    # Indexed entries must be inserted in index order to get them back
+    for name, category, entry_type, index in sorted(interface["symbols"],
+                                                    key=lambda s: s[3]):
+        entry = SymbolTableEntry()
+        entry.SetCategory(str(category))
+        entry.name = str(name)
+        entry.type = str(entry_type)
+        table.InsertEntry(entry)
+    return table
+
+
+def LookupInterface(interface, name):
+    for symbol in interface["symbols"]:
+        if symbol[0] == name:
+            return symbol[1:]
+    return None
+
+
+def HashFile(path):
+    with open(path, 'rb') as source_file:
+        return hashlib.sha1(source_file.read()).hexdigest()
+
+
+def LoadState(state_path, optimizations, xml_output):
+    """
+    Returns the classes recorded by the last build, or none if that build
+    applied different optimizations, or wrote XML when this one doesn't
+    (or the other way round).
+    """
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (IOError, ValueError):
+        return {}
+    if state.get("version") != state_version or \
+            state.get("optimizations", []) != optimizations or \
+            state.get("xml_output", False) != xml_output:
+        return {}
+    return state["classes"]
+
+
+def SaveState(state_path, classes, optimizations, xml_output):
+    temp_path = state_path + ".tmp"
+    with open(temp_path, 'w') as state_file:
+        json.dump({"version": state_version, "classes": classes,
+                   "optimizations": optimizations,
+                   "xml_output": xml_output}, state_file, sort_keys=True)
+    os.rename(temp_path, state_path)
+
+
+def IsStale(record, interfaces):
+    """
+    Does a class's code depend on a part of another class's interface
+    that is not what it was when the class was last compiled?
+    """
+    for class_name, symbols in record["dependencies"].items():
+        interface = interfaces.get(class_name)
+        for name, description in symbols.items():
+            current = None
+            if interface is not None:
+                current = LookupInterface(interface, name)
+            if current != description:
+                return True
+    return False
+
+
+def BuildIncremental(sources, jobs=1, xml_output=False, optimizations=(),
+                     statistics=None):
+    """
+    Compiles the classes among the sources that changed since the last
+    incremental build, plus the classes whose code depends on a part of
+    another class's interface that changed. The state of the build is
+    kept in a file next to the sources. The optimization statistics of
+    the recompiled classes are added to statistics, if given.
+    """
+    if not sources:
+        return []
+
+    # The engine puts the optimizations in their canonical order
+    engine = CompilationEngine(xml_output, optimizations)
+    optimizations = engine.optimizations
+
+    state_path = os.path.join(os.path.dirname(sources[0]), state_file_name)
+    old_classes = LoadState(state_path, optimizations, xml_output)
+    classes = {}
+    changed = []
+
+    for source_file in sources:
+        class_name = os.path.basename(source_file)[:-len(".jack")]
+        stat = os.stat(source_file)
+        record = old_classes.get(class_name)
+
+        if record is not None and record["source"] == source_file and \
+                os.path.exists(source_file.replace(".jack", ".vm")):
+            if record["stat"] == [stat.st_mtime, stat.st_size]:
+                classes[class_name] = record
+                continue
+            digest = HashFile(source_file)
+            if record["hash"] == digest:
+                record["stat"] = [stat.st_mtime, stat.st_size]
+                classes[class_name] = record
+                continue
+        else:
+            digest = HashFile(source_file)
+
+        classes[class_name] = {"source": source_file, "hash": digest,
+                               "stat": [stat.st_mtime, stat.st_size],
+                               "interface": None, "dependencies": {}}
+        changed.append(class_name)
+
+    # Interfaces of the changed classes are read again; the others are
+    # known from the last build.
+    for class_name in changed:
+        engine.DeclareClass(classes[class_name]["source"])
+        classes[class_name]["interface"] = ExportInterface(
+            engine.class_symbol_tables[class_name],
+            engine.type_size_map[class_name])
+
+    interfaces = dict((class_name, record["interface"])
+                      for class_name, record in classes.items())
+
+    dirty = set(changed)
+    for class_name, record in classes.items():
+        if class_name not in dirty and IsStale(record, interfaces):
+            dirty.add(class_name)
+
+    if dirty:
+        for class_name, record in classes.items():
+            if class_name not in engine.class_symbol_tables:
+                engine.class_symbol_tables[class_name] = \
+                    ImportInterface(record["interface"])
+                engine.type_size_map[class_name] = \
+                    record["interface"]["size"]
+
+        rebuild = sorted(dirty)
+        rebuild_sources = [classes[name]["source"] for name in rebuild]
+        if jobs > 1 and len(rebuild) > 1:
+            dependencies = CompileParallel(engine, rebuild_sources, jobs)
+        else:
+            dependencies = []
+            for source_file in rebuild_sources:
+                engine.SetClass(source_file,
+                                source_file.replace(".jack", ".vm"))
+                engine.CompileClass()
+                dependencies.append(engine.dependencies)
+
+        for class_name, class_dependencies in zip(rebuild, dependencies):
+            classes[class_name]["dependencies"] = class_dependencies
+
+    if statistics is not None:
+        AddStatistics(statistics, engine.statistics)
+
+    if dirty or classes != old_classes:
+        SaveState(state_path, classes, optimizations, xml_output)
+
+    return sorted(dirty)
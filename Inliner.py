@@ -0,0 +1,202 @@
+from TreeShaker import SplitFunctions
+
+# Temps 0-2 are scratch registers of the code generator; inlined
+# subroutines keep their arguments and locals in the others.
+first_inline_temp = 3
+inline_temps = 5
+
+default_max_size = 12
+default_max_depth = 2
+
+
+def Parse(line):
+    return line.split('//', 1)[0].split()
+
+
+class InlineBody(object):
+    """
+    The code of a subroutine that can be inlined, ready to be remapped.
+    """
+
+    def __init__(self, class_name, is_method, nArgs, nVars, body):
+        self.class_name = class_name
+        self.is_method = is_method
+        self.nArgs = nArgs  # Arguments kept in temps (not this)
+        self.nVars = nVars
+        self.body = body  # Without the function line, prologue and return
+        self.uses_statics = any(Parse(line)[1:2] == ['static']
+                                for line in body)
+
+
+class Inliner(object):
+    """
+    Inlines small subroutines at their call sites across the program.
+
+    A subroutine is inlined if its body is straight-line code ending in
+    its only return, of at most max_size lines, and if nothing the call
+    would have saved is needed: its arguments and locals move to temps 3-7
+    and the fields of a method are read through THAT, so it must not use
+    THAT or the pointer segment itself, nor read an argument, local or
+    field after a call it makes (the callee may use the same temps).
+    Subroutines that use statics are only inlined into their own class.
+    Calls in inlined code are inlined in turn up to max_depth levels,
+    which bounds recursion. inlined counts the call sites of every
+    subroutine that were replaced.
+    """
+
+    def __init__(self, class_symbol_tables, max_size=default_max_size,
+                 max_depth=default_max_depth):
+        self.class_symbol_tables = class_symbol_tables
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.inlined = {}
+
+    def Inline(self, vm_code):
+        """
+        vm_code: {key: [lines]} for the whole program, where a class's
+        key is its name or the path of its .vm file. Returns the same,
+        with the changed classes only.
+        """
+        bodies = {}
+        for key, code in vm_code.items():
+            for name, lines in SplitFunctions(code):
+                body = self.InlineBody(name, lines)
+                if body is not None:
+                    bodies[name] = body
+
+        changed = {}
+        for level in range(self.max_depth):
+            inlined_any = False
+            for key, code in vm_code.items():
+                code = changed.get(key, code)
+                inlined_code = []
+                for name, lines in SplitFunctions(code):
+                    inlined_lines = self.InlineCalls(name, lines, bodies)
+                    if inlined_lines is not lines:
+                        inlined_any = True
+                    inlined_code.extend(inlined_lines)
+                if inlined_code != code:
+                    changed[key] = inlined_code
+            if not inlined_any:
+                break
+        return changed
+
+    def InlineBody(self, name, lines):
+        """
+        Returns the InlineBody of a subroutine, or None if it can't be
+        inlined.
+        """
+        class_name, sub_name = name.split('.', 1)
+        table = self.class_symbol_tables.get(class_name)
+        entry = table.GetEntry(sub_name) if table is not None else None
+        if entry is None or entry.type not in ("function", "method"):
+            return None
+
+        is_method = entry.type == "method"
+        nVars = int(Parse(lines[0])[2])
+        body = lines[1:]
+        if is_method:
+            if [Parse(line) for line in body[:2]] != \
+                    [['push', 'argument', '0'], ['pop', 'pointer', '0']]:
+                return None
+            body = body[2:]
+        if not body or Parse(body[-1]) != ['return']:
+            return None
+        body = body[:-1]
+        if len(body) > self.max_size:
+            return None
+
+        nArgs = 0
+        called = False
+        for line in body:
+            words = Parse(line)
+            if words[0] in ('label', 'goto', 'if-goto', 'return',
+                            'function'):
+                return None
+            if words[0] == 'call':
+                if words[1] == name:
+                    return None
+                called = True
+            elif words[0] in ('push', 'pop'):
+                segment, index = words[1], int(words[2])
+                if segment == 'that' or \
+                        (segment == 'pointer' and
+                         (index == 1 or words[0] == 'pop')) or \
+                        (segment == 'temp' and index >= first_inline_temp):
+                    return None
+                if called and (segment in ('argument', 'local', 'this') or
+                               segment == 'pointer'):
+                    return None
+                if segment == 'argument':
+                    nArgs = max(nArgs, index + 1)
+
+        if is_method:
+            nArgs = max(nArgs - 1, 0)
+        if nArgs + nVars > inline_temps:
+            return None
+        return InlineBody(class_name, is_method, nArgs, nVars, body)
+
+    def InlineCalls(self, name, lines, bodies):
+        """
+        Returns the lines of a function with its calls to inlinable
+        subroutines inlined, or lines itself if there are none.
+        """
+        class_name = name.split('.', 1)[0]
+        inlined_lines = None
+        for i, line in enumerate(lines):
+            words = Parse(line)
+            body = None
+            if words and words[0] == 'call':
+                body = bodies.get(words[1])
+            if body is None or words[1] == name or \
+                    (body.uses_statics and body.class_name != class_name):
+                if inlined_lines is not None:
+                    inlined_lines.append(line)
+                continue
+
+            if inlined_lines is None:
+                inlined_lines = lines[:i]
+            inlined_lines.extend(self.Expand(body, int(words[2])))
+            self.inlined[words[1]] = self.inlined.get(words[1], 0) + 1
+
+        return inlined_lines if inlined_lines is not None else lines
+
+    def Expand(self, body, nArgs):
+        """
+        Returns the code replacing a call to body with nArgs arguments on
+        the stack. The return value is left on the stack, as the call
+        would.
+        """
+        first_argument = 1 if body.is_method else 0
+        temps = {}
+        for index in range(body.nArgs):
+            temps['argument', first_argument + index] = \
+                first_inline_temp + index
+        for index in range(body.nVars):
+            temps['local', index] = first_inline_temp + body.nArgs + index
+
+        code = []
+        for index in reversed(range(first_argument, nArgs)):
+            # Arguments the body never reads go to the scratch temp
+            code.append("pop temp {0}".format(temps.get(('argument', index),
+                                                         0)))
+        if body.is_method:
+            code.append("pop pointer 1")  # The object, for its fields
+        for index in range(body.nVars):  # Locals start as 0
+            code.append("push constant 0")
+            code.append("pop temp {0}".format(temps['local', index]))
+
+        for line in body.body:
+            words = Parse(line)
+            if words[0] in ('push', 'pop'):
+                segment, index = words[1], int(words[2])
+                if (segment, index) in temps:
+                    line = "{0} temp {1}".format(words[0],
+                                                 temps[segment, index])
+                elif body.is_method and segment == 'this':
+                    line = "{0} that {1}".format(words[0], index)
+                elif body.is_method and (segment == 'pointer' or
+                                         segment == 'argument'):
+                    line = "{0} pointer 1".format(words[0])  # this
+            code.append(line)
+        return code
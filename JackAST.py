@@ -0,0 +1,177 @@
+"""
+The abstract syntax tree built by CompilationEngine and consumed by the
+code generators. Every node records the source offset of its first token
+in position.
+"""
+
+
+class Node(object):
+    __slots__ = ('position',)
+
+
+class ClassNode(Node):
+    __slots__ = ('name', 'class_vars', 'subroutines')
+
+    def __init__(self, name, class_vars, subroutines, position):
+        self.name = name
+        self.class_vars = class_vars  # [ClassVarDec]
+        self.subroutines = subroutines  # [SubroutineNode]
+        self.position = position
+
+
+class ClassVarDec(Node):
+    __slots__ = ('kind', 'type', 'names')
+
+    def __init__(self, kind, var_type, names, position):
+        self.kind = kind  # 'static' or 'field'
+        self.type = var_type
+        self.names = names
+        self.position = position
+
+
+class VarDec(Node):
+    __slots__ = ('type', 'names')
+
+    def __init__(self, var_type, names, position):
+        self.type = var_type
+        self.names = names
+        self.position = position
+
+
+class SubroutineNode(Node):
+    __slots__ = ('kind', 'return_type', 'name', 'parameters', 'local_vars',
+                 'statements')
+
+    def __init__(self, kind, return_type, name, parameters, local_vars,
+                 statements, position):
+        self.kind = kind  # 'constructor', 'function' or 'method'
+        self.return_type = return_type
+        self.name = name
+        self.parameters = parameters  # [(type, name)]
+        self.local_vars = local_vars  # [VarDec]
+        self.statements = statements
+        self.position = position
+
+
+# Statements
+
+class LetStatement(Node):
+    __slots__ = ('name', 'index', 'value')
+
+    def __init__(self, name, index, value, position):
+        self.name = name
+        self.index = index  # Expression, or None if not an array entry
+        self.value = value
+        self.position = position
+
+
+class IfStatement(Node):
+    __slots__ = ('condition', 'then_statements', 'else_statements')
+
+    def __init__(self, condition, then_statements, else_statements,
+                 position):
+        self.condition = condition
+        self.then_statements = then_statements
+        self.else_statements = else_statements  # None if there is no else
+        self.position = position
+
+
+class WhileStatement(Node):
+    __slots__ = ('condition', 'statements')
+
+    def __init__(self, condition, statements, position):
+        self.condition = condition
+        self.statements = statements
+        self.position = position
+
+
+class DoStatement(Node):
+    __slots__ = ('call',)
+
+    def __init__(self, call, position):
+        self.call = call  # SubroutineCall
+        self.position = position
+
+
+class ReturnStatement(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value, position):
+        self.value = value  # Expression, or None
+        self.position = position
+
+
+# Expressions
+
+class IntegerConstant(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value, position):
+        self.value = value
+        self.position = position
+
+
+class StringConstant(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value, position):
+        self.value = value
+        self.position = position
+
+
+class KeywordConstant(Node):
+    __slots__ = ('keyword',)
+
+    def __init__(self, keyword, position):
+        self.keyword = keyword  # 'true', 'false', 'null' or 'this'
+        self.position = position
+
+
+class VarRef(Node):
+    __slots__ = ('name',)
+
+    def __init__(self, name, position):
+        self.name = name
+        self.position = position
+
+
+class ArrayRef(Node):
+    __slots__ = ('name', 'index')
+
+    def __init__(self, name, index, position):
+        self.name = name
+        self.index = index
+        self.position = position
+
+
+class SubroutineCall(Node):
+    __slots__ = ('prefix', 'name', 'arguments')
+
+    def __init__(self, prefix, name, arguments, position):
+        self.prefix = prefix  # Class or variable name, or None
+        self.name = name
+        self.arguments = arguments  # [Expression]
+        self.position = position
+
+
+class UnaryOp(Node):
+    __slots__ = ('op', 'operand')
+
+    def __init__(self, op, operand, position):
+        self.op = op  # '-' or '~'
+        self.operand = operand
+        self.position = position
+
+
+class BinaryOp(Node):
+    """
+    Jack has no operator precedence, so "a op b op c" is built as
+    BinaryOp(BinaryOp(a, b), c).
+    """
+    __slots__ = ('op', 'left', 'right')
+
+    def __init__(self, op, left, right, position):
+        self.op = op
+        self.left = left
+        self.right = right
+        self.position = position
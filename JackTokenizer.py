@@ -1,5 +1,8 @@
 import sys
 import os
+import re
+import mmap
+from array import array
 
 
 class TokenType:
@@ -16,26 +19,138 @@ Keywords = ['class', 'method', 'function', 'constructor', 'int', 'boolean',
 Symbols = ['{', '}', '(', ')', '[', ']', '.', ',', ';', '+',
            '-', '*', '/', '&', '|', '<', '>', '=', '~']
 
+# A single master pattern scans the whole source; the name of the group
+# that matched (match.lastgroup) tells what kind of lexeme was found.
+token_pattern = re.compile(r"""
+      (?P<space>[ \t\r\n]+)
+    | (?P<line_comment>//[^\r\n]*[\r\n]?)
+    | (?P<block_comment>/\*.*?\*/)
+    | (?P<bad_comment>/\*)
+    | (?P<string>"[^"\n]*")
+    | (?P<bad_string>"[^"\n]*)
+    | (?P<int>[0-9]+)
+    | (?P<keyword>(?:%s)\b)
+    | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+    """ % '|'.join(Keywords), re.VERBOSE | re.DOTALL)
+
+ignored_groups = ('space', 'line_comment', 'block_comment')
+
+group_types = {'keyword': TokenType.KEYWORD,
+               'word': TokenType.IDENTIFIER,
+               'int': TokenType.INT_CONST,
+               'string': TokenType.STRING_CONST,
+               'symbol': TokenType.SYMBOL}
+
+
+class Token(object):
+    """
+    A single token. Keyword, symbol and identifier tokens are interned
+    by their tokenizer, so every occurrence of the same name in a source
+    is the same Token object.
+    """
+    __slots__ = ('type', 'text')
+
+    def __init__(self, token_type, text):
+        self.type = token_type
+        self.text = text
+
+    def __repr__(self):
+        return "Token({0}, {1!r})".format(self.type, self.text)
+
+
+def replaceUnsafeXmlSafeChars(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
 
 class Tokenizer(object):
 
-    def __init__(self, filePath):
+    def __init__(self, filePath, source=None):
         """
-        Opens the input file and get ready to tokenize it.
+        Maps the input file into memory and tokenizes all of it. The
+        token stream is kept in parallel arrays of types and (start, end)
+        offsets into the mapped buffer; Token objects and their text are
+        only built for the token the parser is looking at.
+        If source is given, it is tokenized instead and filePath is
+        ignored.
         """
-        self.file = open(filePath)        
-        self.current_token = None
-        self.current_token_type = None
-
-        self.next_token = None
-        self.next_token_type = None
-        self.readNextToken()
+        if source is not None:
+            if isinstance(source, unicode):
+                source = source.encode('utf-8')
+            self.source = source
+        else:
+            with open(filePath, 'rb') as source_file:
+                if os.fstat(source_file.fileno()).st_size > 0:
+                    self.source = mmap.mmap(source_file.fileno(), 0,
+                                            access=mmap.ACCESS_READ)
+                else:
+                    self.source = ''
+
+        self.types = array('B')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.scan()
+
+        self.current_index = -1
+        self.current = None
+
+        # The interned tokens of this source only, so a long-running
+        # process (e.g. the compile server) doesn't keep every name it
+        # has seen
+        self.interned_tokens = {}
+
+    def internToken(self, token_type, text):
+        key = (token_type, text)
+        token = self.interned_tokens.get(key)
+        if token is None:
+            token = self.interned_tokens[key] = Token(token_type,
+                                                      intern(text))
+        return token
+
+    def scan(self):
+        source = self.source
+        types = self.types
+        starts = self.starts
+        ends = self.ends
+        position = 0
+
+        while True:
+            match = token_pattern.match(source, position)
+            if match is None:
+                if position >= len(source):  # EOF
+                    return
+                raise Exception("Bad character at offset {0}: {1!r}".
+                                format(position, source[position]))
+
+            position = match.end()
+            kind = match.lastgroup
+
+            if kind in ignored_groups:
+                continue
+
+            if kind == 'bad_comment':
+                raise Exception("Error reading comment: reached EOF")
+
+            if kind == 'bad_string':
+                raise Exception("new-line is not a legal string character")
+
+            start, end = match.span()
+            if kind == 'string':  # Drop the enclosing quotes
+                start += 1
+                end -= 1
+            elif kind == 'int':
+                if end - start > 4 and int(source[start:end]) > 32767:
+                    raise Exception("Integer out of bounds")
+
+            types.append(group_types[kind])
+            starts.append(start)
+            ends.append(end)
 
     def hasMoreTokens(self):
         """
         Do we have more tokens in the input?
         """
-        return self.next_token is not None
+        return self.current_index + 1 < len(self.types)
 
     def advance(self):
         """
@@ -45,15 +160,38 @@ class Tokenizer(object):
         """
         if not self.hasMoreTokens():
             raise "hasMoreTokens() is false."
-        self.current_token = self.next_token
-        self.current_token_type = self.next_token_type
-        self.readNextToken()
+        self.current_index += 1
+        self.current = None
+        if not self.hasMoreTokens():
+            self.close()
 
     def tokenType(self):
         """
         Returns the type of the current token.
         """
-        return self.current_token_type
+        if self.current_index < 0:
+            return None
+        return self.types[self.current_index]
+
+    def tokenPosition(self):
+        """
+        Returns the offset of the current token in the source.
+        """
+        return self.starts[self.current_index]
+
+    def token(self):
+        """
+        Returns the current token as a Token object.
+        """
+        if self.current is None and self.current_index >= 0:
+            i = self.current_index
+            token_type = self.types[i]
+            text = self.source[self.starts[i]:self.ends[i]]
+            if token_type in (TokenType.INT_CONST, TokenType.STRING_CONST):
+                self.current = Token(token_type, text)
+            else:
+                self.current = self.internToken(token_type, text)
+        return self.current
 
     def keyword(self):
         """
@@ -62,7 +200,7 @@ class Tokenizer(object):
         """
         if self.tokenType() is not TokenType.KEYWORD:
             raise "tokenType() is not KEYWORD"
-        return self.current_token
+        return self.token().text
 
     def symbol(self):
         """
@@ -71,7 +209,7 @@ class Tokenizer(object):
         """
         if self.tokenType() is not TokenType.SYMBOL:
             raise "tokenType() is not SYMBOL"
-        return self.replaceUnsafeXmlSafeChars(self.current_token)
+        return self.token().text
 
     def identifier(self):
         """
@@ -80,7 +218,7 @@ class Tokenizer(object):
         """
         if self.tokenType() is not TokenType.IDENTIFIER:
             raise "tokenType() is not IDENTIFIER"
-        return self.current_token
+        return self.token().text
 
     def intVal(self):
         """
@@ -89,7 +227,7 @@ class Tokenizer(object):
         """
         if self.tokenType() is not TokenType.INT_CONST:
             raise "tokenType() is not INT_CONST"
-        return int(self.current_token)
+        return int(self.token().text)
 
     def stringVal(self):
         """
@@ -98,115 +236,17 @@ class Tokenizer(object):
         """
         if self.tokenType() is not TokenType.STRING_CONST:
             raise "tokenType() is not STRING_CONST"
-        return self.replaceUnsafeXmlSafeChars(self.current_token)
-
-    def readNextToken(self):
-        self.readNullCharacters()
-
-        c = self.peekChar()
-
-        if c == '':  # EOF
-            self.next_token = None
-            self.next_token_type = None
-            self.file.close()
-            return
-
-        if c == '"':  # String constant
-            self.next_token = self.readStringConstant()
-            self.next_token_type = TokenType.STRING_CONST
-            return
-
-        if c == '/':  # Comment or symbol
-            c = self.readChar()
-            if (self.peekChar() in ['/', '*']):  # Comment
-                self.readComment()
-                self.readNextToken()
-                return
-            else:  # Symbol
-                self.next_token = c
-                self.next_token_type = TokenType.SYMBOL
-                return
-
-        if c in Symbols:  # Definitely symbol
-            self.next_token = self.readChar()
-            self.next_token_type = TokenType.SYMBOL
-            return
-
-        if c.isdigit():  # Integer constant
-            self.next_token = self.readIntegerConstant()
-            self.next_token_type = TokenType.INT_CONST
-            return
-
-        if (c.isalpha() or (c == '_')):
-            self.next_token = self.readKeywordOfIdentifier()
-            if self.next_token in Keywords:
-                self.next_token_type = TokenType.KEYWORD
-            else:
-                self.next_token_type = TokenType.IDENTIFIER
-            return
-
-        raise "Bad character"
-
-    def readComment(self):
-        #  One '/' already read
-        c = self.readChar()
-        if (c == '/'):  # Single line comment
-            while (self.readChar() not in ['\r', '\n']):
-                pass
-        elif (c == '*'):  # Multi-line comment
-            first = self.readChar()
-            second = self.readChar()
-            while not (first == '*' and second == '/'):
-                first = second
-                second = self.readChar()
-                if second == '':
-                    raise "Error reading comment: reached EOF"
-        else:
-            raise "Error reading comment."
-
-    def readStringConstant(self):
-        string = ''
-        self.readChar()
-        while self.peekChar() not in ['"', '\n']:
-            string += self.readChar()
-        c = self.readChar()
-        if c == '\n':
-            raise "new-line is not a legal string character"
-        return string
-
-    def readIntegerConstant(self):
-        int_string = ''
-        while self.peekChar().isdigit():
-            int_string += self.readChar()
-        if int(int_string) > 32767:
-            raise "Integer out of bounds"
-        return int_string
-
-    def readKeywordOfIdentifier(self):
-        def isIdentifierChar(c):
-            return c.isdigit() or c.isalpha() or c == '_'
-
-        temp_string = ''
-        while isIdentifierChar(self.peekChar()):
-            temp_string += self.readChar()
-
-        return temp_string
-
-    def readNullCharacters(self):
-        while (self.peekChar() in [' ', '\r', '\n', '\t']):
-            self.readChar()
-
-    def readChar(self):
-        return self.file.read(1)
-
-    def peekChar(self):
-        pos = self.file.tell()
-        char = self.file.read(1)
-        self.file.seek(pos)
-        return char
-
-    def replaceUnsafeXmlSafeChars(self, s):
-        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return self.token().text
+
+    def close(self):
+        """
+        Releases the mapped input. The current token is materialized
+        first, so it stays readable after the end of input.
+        """
+        self.token()
+        if isinstance(self.source, mmap.mmap):
+            self.source.close()
+        self.source = ''
 
 def main(args):
     if len(args) != 1:
@@ -227,7 +267,7 @@ def main(args):
             continue
 
         if t is TokenType.SYMBOL:
-            print "<symbol> {} </symbol>".format(tokenizer.symbol())
+            print "<symbol> {} </symbol>".format(replaceUnsafeXmlSafeChars(tokenizer.symbol()))
             continue
 
         if t is TokenType.IDENTIFIER:
@@ -239,7 +279,7 @@ def main(args):
             continue
 
         if t is TokenType.STRING_CONST:
-            print "<stringConstant> {} </stringConstant>".format(tokenizer.stringVal())
+            print "<stringConstant> {} </stringConstant>".format(replaceUnsafeXmlSafeChars(tokenizer.stringVal()))
             continue
 
     print "</tokens>"
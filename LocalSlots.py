@@ -0,0 +1,173 @@
+from TreeShaker import SplitFunctions
+from ControlFlow import ControlFlowOptimizer
+
+
+def Parse(line):
+    return line.split('//', 1)[0].split()
+
+
+def LocalAccess(words):
+    """
+    Returns the local a push or pop line accesses, or None.
+    """
+    if len(words) == 3 and words[0] in ('push', 'pop') and \
+            words[1] == 'local':
+        return int(words[2])
+    return None
+
+
+class LocalSlotAllocator(object):
+    """
+    Shares local slots between the locals of a function whose values are
+    never needed at the same time, so the function header asks the VM for
+    fewer locals to zero on every call.
+
+    A local is live where its value may still be read. Two locals
+    interfere if one is assigned while the other is live (unless it is
+    assigned a copy of the other), or if both are read before being
+    assigned, when they both hold the 0 the VM starts them with. The
+    locals are then given the lowest slot none of the locals they
+    interfere with has, preferring the slot of a local they are copied
+    from or to, so the copy becomes a self-assignment for peephole to
+    drop. Locals that are never accessed get no slot.
+
+    local_names: {function name: [local names, by index]}, for the
+    report. slots maps "<function> local <slot>" to the number of locals
+    saved by sharing that slot, for every function that got smaller; the
+    names sharing the slot are part of the key.
+    """
+
+    def __init__(self, local_names=None):
+        self.local_names = local_names or {}
+        self.slots = {}
+
+    def Optimize(self, code):
+        optimized = []
+        for name, lines in SplitFunctions(code):
+            optimized.extend(self.AllocateFunction(name, lines))
+        return optimized
+
+    def AllocateFunction(self, name, lines):
+        words = Parse(lines[0])
+        nVars = int(words[2])
+        if nVars == 0:
+            return lines
+
+        blocks = ControlFlowOptimizer().BuildBlocks(lines[1:])
+        interference, copies = self.Interference(blocks, nVars)
+
+        used = set()
+        for line in lines:
+            local = LocalAccess(Parse(line))
+            if local is not None:
+                used.add(local)
+
+        slot_of = {}
+        for local in sorted(used):
+            taken = set(slot_of[other] for other in interference[local]
+                        if other in slot_of)
+            partners = [slot_of[other] for other in sorted(copies[local])
+                        if other in slot_of]
+            free = [slot for slot in partners if slot not in taken]
+            if free:
+                slot_of[local] = free[0]
+            else:
+                slot = 0
+                while slot in taken:
+                    slot += 1
+                slot_of[local] = slot
+
+        new_nVars = len(set(slot_of.values()))
+        if new_nVars == nVars:
+            return lines
+
+        names = self.local_names.get(name, [])
+        for slot in range(new_nVars):
+            sharing = [names[local] if local < len(names)
+                       else "local {0}".format(local)
+                       for local in sorted(slot_of) if slot_of[local] == slot]
+            key = "{0} local {1}: {2}".format(name, slot, ", ".join(sharing))
+            self.slots[key] = len(sharing) - 1
+        unused = nVars - len(used)
+        if unused:
+            self.slots["{0}: unused".format(name)] = unused
+
+        allocated = ["function {0} {1}".format(name, new_nVars)]
+        for line in lines[1:]:
+            words = Parse(line)
+            local = LocalAccess(words)
+            if local is not None:
+                comment = line.split('//', 1)[1:]
+                line = "{0} local {1}".format(words[0], slot_of[local])
+                if comment:
+                    line += " //" + comment[0]
+            allocated.append(line)
+        return allocated
+
+    def Interference(self, blocks, nVars):
+        """
+        Returns {local: set of interfering locals} and {local: set of
+        locals it is copied from or to}.
+        """
+        uses = []
+        definitions = []
+        for block in blocks:
+            used, defined = set(), set()
+            for line in block.lines:
+                words = Parse(line)
+                local = LocalAccess(words)
+                if local is None:
+                    continue
+                if words[0] == 'push' and local not in defined:
+                    used.add(local)
+                elif words[0] == 'pop':
+                    defined.add(local)
+            uses.append(used)
+            definitions.append(defined)
+
+        index_of = dict((block, index) for index, block in enumerate(blocks))
+        live_in = [set() for block in blocks]
+        live_out = [set() for block in blocks]
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(range(len(blocks))):
+                block = blocks[index]
+                out = set()
+                for successor in (block.target, block.next):
+                    if successor is not None:
+                        out |= live_in[index_of[successor]]
+                live = uses[index] | (out - definitions[index])
+                if out != live_out[index] or live != live_in[index]:
+                    live_out[index], live_in[index] = out, live
+                    changed = True
+
+        interference = dict((local, set()) for local in range(nVars))
+        copies = dict((local, set()) for local in range(nVars))
+        for index, block in enumerate(blocks):
+            live = set(live_out[index])
+            previous = [None] + [LocalAccess(Parse(line)) if
+                                 Parse(line)[0] == 'push' else None
+                                 for line in block.lines[:-1]]
+            for line, source in reversed(zip(block.lines, previous)):
+                words = Parse(line)
+                local = LocalAccess(words)
+                if local is None:
+                    continue
+                if words[0] == 'pop':
+                    live.discard(local)
+                    if source is not None:  # push local source; pop local
+                        copies[local].add(source)
+                        copies[source].add(local)
+                    for other in live:
+                        if other != source:
+                            interference[local].add(other)
+                            interference[other].add(local)
+                else:
+                    live.add(local)
+
+        # Locals read before being assigned all hold 0 at the start
+        entry = live_in[0] if blocks else set()
+        for local in entry:
+            interference[local] |= entry - set([local])
+        return interference, copies
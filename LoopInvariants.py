@@ -0,0 +1,237 @@
+from JackAST import (VarDec, LetStatement, IfStatement, WhileStatement,
+                     DoStatement, ReturnStatement, IntegerConstant,
+                     KeywordConstant, VarRef, ArrayRef, SubroutineCall,
+                     UnaryOp, BinaryOp)
+from ConstantFolder import ConstantValue
+
+
+def Key(node):
+    """
+    A hashable description of an expression, equal for expressions that
+    compute the same thing.
+    """
+    if isinstance(node, BinaryOp):
+        return (node.op, Key(node.left), Key(node.right))
+    if isinstance(node, UnaryOp):
+        return (node.op, Key(node.operand))
+    if isinstance(node, VarRef):
+        return ('var', node.name)
+    if isinstance(node, IntegerConstant):
+        return ('int', node.value)
+    if isinstance(node, KeywordConstant):
+        return ('keyword', node.keyword)
+    return ('node', id(node))
+
+
+def Uses(node):
+    """
+    Does the expression use a variable or this (rather than only
+    constants, which are better left to folding)?
+    """
+    if isinstance(node, BinaryOp):
+        return Uses(node.left) or Uses(node.right)
+    if isinstance(node, UnaryOp):
+        return Uses(node.operand)
+    return isinstance(node, VarRef) or \
+        (isinstance(node, KeywordConstant) and node.keyword == "this")
+
+
+class LoopSummary(object):
+    """
+    What a loop may change: the variables it assigns, and whether it
+    makes calls (which may change fields, statics and any memory) or
+    stores into arrays (which may change any memory).
+    """
+
+    def __init__(self, loop, temps):
+        self.assigned = set()
+        self.has_calls = False
+        self.has_array_stores = False
+        self.Expression(loop.condition)
+        self.Statements(loop.statements, temps)
+
+    def Statements(self, statements, temps):
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                if statement.index is not None:
+                    self.has_array_stores = True
+                    self.Expression(statement.index)
+                elif statement.name not in temps:
+                    # Temps are assigned by their hoisted expression only
+                    self.assigned.add(statement.name)
+                self.Expression(statement.value)
+            elif isinstance(statement, IfStatement):
+                self.Expression(statement.condition)
+                self.Statements(statement.then_statements, temps)
+                self.Statements(statement.else_statements or [], temps)
+            elif isinstance(statement, WhileStatement):
+                self.Expression(statement.condition)
+                self.Statements(statement.statements, temps)
+            elif isinstance(statement, DoStatement):
+                self.has_calls = True
+                self.Expression(statement.call)
+            elif isinstance(statement, ReturnStatement):
+                if statement.value is not None:
+                    self.Expression(statement.value)
+
+    def Expression(self, node):
+        if isinstance(node, SubroutineCall):
+            self.has_calls = True
+            for argument in node.arguments:
+                self.Expression(argument)
+        elif isinstance(node, BinaryOp):
+            self.Expression(node.left)
+            self.Expression(node.right)
+        elif isinstance(node, UnaryOp):
+            self.Expression(node.operand)
+        elif isinstance(node, ArrayRef):
+            self.Expression(node.index)
+
+
+class LoopInvariantMover(object):
+    """
+    Hoists the expressions of while loops that compute the same value on
+    every iteration into new locals, assigned right before the loop.
+
+    An expression is invariant if it only combines constants, this, and
+    variables the loop doesn't assign. Fields and statics also need a
+    loop without calls or array stores, which could change them behind
+    the compiler's back. Array entries, string literals and calls are
+    never hoisted; * and / are, since Math.multiply and Math.divide have
+    no side effects, but only / by a nonzero constant, which can't fail
+    when the loop would not have run it. Inner loops are handled first,
+    and the assignments they hoisted move further out when they are
+    invariant in the outer loop too. hoisted counts the hoisted
+    expressions of every subroutine.
+    """
+
+    def __init__(self):
+        self.hoisted = {}
+
+    def MoveClass(self, class_node):
+        for subroutine in class_node.subroutines:
+            self.MoveSubroutine(class_node.name, subroutine)
+
+    def MoveSubroutine(self, class_name, subroutine):
+        self.name = "{0}.{1}".format(class_name, subroutine.name)
+        self.local_names = set(name for varType, name in subroutine.parameters)
+        for var_dec in subroutine.local_vars:
+            self.local_names.update(var_dec.names)
+        self.temps = []
+
+        subroutine.statements = self.MoveStatements(subroutine.statements)
+        if self.temps:
+            subroutine.local_vars.append(VarDec("int", self.temps,
+                                                subroutine.position))
+
+    def MoveStatements(self, statements):
+        moved = []
+        for statement in statements:
+            if isinstance(statement, IfStatement):
+                statement.then_statements = \
+                    self.MoveStatements(statement.then_statements)
+                if statement.else_statements is not None:
+                    statement.else_statements = \
+                        self.MoveStatements(statement.else_statements)
+            elif isinstance(statement, WhileStatement):
+                statement.statements = self.MoveStatements(statement.statements)
+                moved.extend(self.Hoist(statement))
+            moved.append(statement)
+        return moved
+
+    def Hoist(self, loop):
+        """
+        Replaces the invariant expressions of a loop by temps, and returns
+        the assignments of the temps to put before it.
+        """
+        self.summary = LoopSummary(loop, self.temps)
+        self.variant_temps = set()
+        self.loop_temps = {}  # {Key(expression): temp}
+        self.assignments = []
+
+        loop.condition = self.Replace(loop.condition)
+        loop.statements = self.ReplaceStatements(loop.statements)
+        return self.assignments
+
+    def ReplaceStatements(self, statements):
+        kept = []
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                if statement.index is not None:
+                    statement.index = self.Replace(statement.index)
+                elif statement.name in self.temps:
+                    # Hoisted from an inner loop; hoist it further
+                    if self.IsInvariant(statement.value):
+                        self.assignments.append(statement)
+                        continue
+                    self.variant_temps.add(statement.name)
+                statement.value = self.Replace(statement.value)
+            elif isinstance(statement, IfStatement):
+                statement.condition = self.Replace(statement.condition)
+                statement.then_statements = \
+                    self.ReplaceStatements(statement.then_statements)
+                if statement.else_statements is not None:
+                    statement.else_statements = \
+                        self.ReplaceStatements(statement.else_statements)
+            elif isinstance(statement, WhileStatement):
+                statement.condition = self.Replace(statement.condition)
+                statement.statements = \
+                    self.ReplaceStatements(statement.statements)
+            elif isinstance(statement, DoStatement):
+                statement.call = self.Replace(statement.call)
+            elif isinstance(statement, ReturnStatement):
+                if statement.value is not None:
+                    statement.value = self.Replace(statement.value)
+            kept.append(statement)
+        return kept
+
+    def Replace(self, node):
+        if isinstance(node, (BinaryOp, UnaryOp)) and Uses(node) and \
+                self.IsInvariant(node):
+            return VarRef(self.Temp(node), node.position)
+
+        if isinstance(node, BinaryOp):
+            node.left = self.Replace(node.left)
+            node.right = self.Replace(node.right)
+        elif isinstance(node, UnaryOp):
+            node.operand = self.Replace(node.operand)
+        elif isinstance(node, ArrayRef):
+            node.index = self.Replace(node.index)
+        elif isinstance(node, SubroutineCall):
+            node.arguments = [self.Replace(argument)
+                              for argument in node.arguments]
+        return node
+
+    def IsInvariant(self, node):
+        if isinstance(node, IntegerConstant):
+            return True
+        if isinstance(node, KeywordConstant):
+            return True
+        if isinstance(node, VarRef):
+            if node.name in self.summary.assigned or \
+                    node.name in self.variant_temps:
+                return False
+            if node.name in self.local_names or node.name in self.temps:
+                return True
+            # A field or static
+            return not (self.summary.has_calls or
+                        self.summary.has_array_stores)
+        if isinstance(node, UnaryOp):
+            return self.IsInvariant(node.operand)
+        if isinstance(node, BinaryOp):
+            if node.op == '/' and not ConstantValue(node.right):
+                return False
+            return self.IsInvariant(node.left) and \
+                self.IsInvariant(node.right)
+        return False
+
+    def Temp(self, node):
+        key = Key(node)
+        if key not in self.loop_temps:
+            temp = "$loop{0}".format(len(self.temps))
+            self.temps.append(temp)
+            self.loop_temps[key] = temp
+            self.assignments.append(LetStatement(temp, None, node,
+                                                 node.position))
+            self.hoisted[self.name] = self.hoisted.get(self.name, 0) + 1
+        return self.loop_temps[key]
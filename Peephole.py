@@ -0,0 +1,291 @@
+arithmetic_commands = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or',
+                       'not']
+
+# The commands whose result is always true (-1) or false (0). not is
+# bitwise, so it only inverts a condition when applied to one of these.
+comparison_commands = ['eq', 'gt', 'lt']
+
+# How many values each arithmetic command pops and pushes
+stack_effects = {'neg': (1, 1), 'not': (1, 1)}
+for command in arithmetic_commands:
+    stack_effects.setdefault(command, (2, 1))
+
+
+def Parse(line):
+    """
+    Splits a VM line into its words, without the trailing comment.
+    """
+    return tuple(line.split('//', 1)[0].split())
+
+
+def IsJump(words):
+    return len(words) == 2 and words[0] in ('goto', 'if-goto')
+
+
+def IsLabel(words):
+    return len(words) == 2 and words[0] == 'label'
+
+
+def IsPure(words):
+    """
+    Does the command only move values on the stack, without touching
+    THAT, the pointer segment or any memory? These can be reordered
+    around "pop pointer 1".
+    """
+    if words and words[0] in stack_effects:
+        return True
+    return (len(words) == 3 and words[0] == 'push' and
+            words[1] not in ('that', 'pointer'))
+
+
+def StackEffect(words):
+    if words[0] == 'push':
+        return 0, 1
+    return stack_effects[words[0]]
+
+
+class Context(object):
+    """
+    What the rules may know about the code beyond their window: the
+    number of jumps to each label, and the index of each label.
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.words = [Parse(line) for line in code]
+        self.references = {}
+        self.targets = {}
+        for index, words in enumerate(self.words):
+            if IsJump(words):
+                self.references[words[1]] = \
+                    self.references.get(words[1], 0) + 1
+            elif IsLabel(words):
+                self.targets[words[1]] = index
+
+    def Resolve(self, label):
+        """
+        Follows a label through the labels and unconditional gotos that
+        come right after it, to where execution really continues.
+        Returns the last label of that chain.
+        """
+        seen = set()
+        while label not in seen and label in self.targets:
+            seen.add(label)
+            index = self.targets[label] + 1
+            while index < len(self.words) and IsLabel(self.words[index]):
+                label = self.words[index][1]
+                index += 1
+            if index < len(self.words) and self.words[index][0] == 'goto':
+                label = self.words[index][1]
+            else:
+                break
+        return label
+
+
+# Rules. Each gets the context and an index, and returns None or
+# (number of lines matched at the index, replacement lines).
+
+def NotNot(context, i):
+    if context.words[i:i + 2] == [('not',), ('not',)]:
+        return 2, []
+
+
+def NegNeg(context, i):
+    if context.words[i:i + 2] == [('neg',), ('neg',)]:
+        return 2, []
+
+
+def AddZero(context, i):
+    words = context.words[i:i + 2]
+    if len(words) == 2 and words[0] == ('push', 'constant', '0') and \
+            words[1] in [('add',), ('sub',), ('or',)]:
+        return 2, []
+
+
+def ConstantBranch(context, i):
+    """
+    A branch on a constant either never jumps or always does.
+    """
+    words = context.words[i:i + 3]
+    if len(words) >= 2 and words[0][:2] == ('push', 'constant') and \
+            words[1][0] == 'if-goto':
+        if words[0][2] == '0':
+            return 2, []
+        return 2, ["goto {0}".format(words[1][1])]
+    if len(words) == 3 and words[0] == ('push', 'constant', '0') and \
+            words[1] == ('not',) and words[2][0] == 'if-goto':
+        return 3, ["goto {0}".format(words[2][1])]
+
+
+def BranchOverGoto(context, i):
+    """
+    A comparison followed by if-goto T; goto F; label T becomes a branch
+    to F on the opposite comparison (dropping the not after it, or adding
+    one), keeping label T only if something else jumps to it. Other
+    conditions are left alone: not x is only false for -1, so inverting
+    them would take more instructions than the goto saves.
+    """
+    if context.words[i][0] not in comparison_commands:
+        return None
+    condition = [context.code[i]]
+    start = i + 1
+    if context.words[start:start + 1] == [('not',)]:
+        start += 1
+    else:
+        condition.append("not")
+    words = context.words[start:start + 3]
+    if len(words) == 3 and words[0][0] == 'if-goto' and \
+            words[1][0] == 'goto' and IsLabel(words[2]) and \
+            words[0][1] == words[2][1]:
+        replacement = condition + ["if-goto {0}".format(words[1][1])]
+        if context.references[words[0][1]] > 1:
+            replacement.append(context.code[start + 2])
+        return start + 3 - i, replacement
+
+
+def ArrayStore(context, i):
+    """
+    let a[i] = <simple value> saves the value in temp 0 only because
+    computing it could move THAT. When it can't, THAT is set first:
+        <value>; pop temp 0; pop pointer 1; push temp 0; pop that 0
+    becomes
+        pop pointer 1; <value>; pop that 0
+    (or that k, for a constant index).
+    """
+    depth = 0
+    index = i
+    while index < len(context.words) and IsPure(context.words[index]):
+        pops, pushes = StackEffect(context.words[index])
+        depth -= pops
+        if depth < 0:
+            return None
+        depth += pushes
+        index += 1
+        if depth == 1 and context.words[index:index + 3] == \
+                [('pop', 'temp', '0'), ('pop', 'pointer', '1'),
+                 ('push', 'temp', '0')] and \
+                context.words[index + 3:index + 4] and \
+                context.words[index + 3][:2] == ('pop', 'that'):
+            return (index + 4 - i,
+                    ["pop pointer 1"] + context.code[i:index] +
+                    [context.code[index + 3]])
+    return None
+
+
+def SelfAssignment(context, i):
+    words = context.words[i:i + 2]
+    if len(words) == 2 and words[0][0] == 'push' and \
+            words[1][0] == 'pop' and words[0][1:] == words[1][1:]:
+        return 2, []
+
+
+def Discard(context, i):
+    """
+    A value pushed only to be discarded, e.g. what an inlined void
+    subroutine returns. temp 0 is a scratch register; only array stores
+    read it back, right after "pop pointer 1".
+    """
+    words = context.words[i:i + 3]
+    if len(words) >= 2 and words[0][0] == 'push' and \
+            words[1] == ('pop', 'temp', '0') and \
+            words[2:3] != [('pop', 'pointer', '1')]:
+        return 2, []
+
+
+def JumpThreading(context, i):
+    """
+    A jump to a label that is followed by more labels or by a goto jumps
+    straight to where execution continues.
+    """
+    words = context.words[i]
+    if IsJump(words):
+        target = context.Resolve(words[1])
+        if target != words[1]:
+            return 1, ["{0} {1}".format(words[0], target)]
+
+
+def GotoNext(context, i):
+    """
+    A goto to the label right after it.
+    """
+    words = context.words[i]
+    if words[0] == 'goto':
+        index = i + 1
+        while index < len(context.words) and IsLabel(context.words[index]):
+            if context.words[index][1] == words[1]:
+                return 1, []
+            index += 1
+
+
+def UnusedLabel(context, i):
+    words = context.words[i]
+    if IsLabel(words) and words[1] not in context.references:
+        return 1, []
+
+
+# The rule table, in the order the rules are tried
+peephole_rules = [('not-not', NotNot),
+                  ('neg-neg', NegNeg),
+                  ('add-zero', AddZero),
+                  ('constant-branch', ConstantBranch),
+                  ('branch-over-goto', BranchOverGoto),
+                  ('array-store', ArrayStore),
+                  ('self-assignment', SelfAssignment),
+                  ('discard', Discard),
+                  ('jump-threading', JumpThreading),
+                  ('goto-next', GotoNext),
+                  ('unused-label', UnusedLabel)]
+
+
+class PeepholeOptimizer(object):
+    """
+    Rewrites windows of VM code into shorter equivalents, with the rules
+    of peephole_rules (or the named subset of them), until none applies.
+    removed counts the lines each rule took out.
+    """
+
+    def __init__(self, rule_names=None):
+        if rule_names is None:
+            self.rules = peephole_rules
+        else:
+            known = dict(peephole_rules)
+            for name in rule_names:
+                if name not in known:
+                    raise Exception("Unknown peephole rule " + name)
+            self.rules = [(name, rule) for name, rule in peephole_rules
+                          if name in rule_names]
+        self.removed = dict((name, 0) for name, rule in self.rules)
+
+    def Optimize(self, code):
+        changed = True
+        while changed:
+            changed = False
+            for name, rule in self.rules:
+                code, rewrites = self.Apply(name, rule, code)
+                changed = changed or rewrites > 0
+        return code
+
+    def Apply(self, name, rule, code):
+        """
+        Sweeps one rule over the code. The context describes the code as
+        it was before the sweep.
+        """
+        context = Context(code)
+        optimized = []
+        rewrites = 0
+        i = 0
+        while i < len(code):
+            if context.words[i]:
+                match = rule(context, i)
+            else:
+                match = None
+            if match is None:
+                optimized.append(code[i])
+                i += 1
+                continue
+            length, replacement = match
+            optimized.extend(replacement)
+            self.removed[name] += length - len(replacement)
+            rewrites += 1
+            i += length
+        return optimized, rewrites
@@ -0,0 +1,334 @@
+from SymbolTable import Categories
+from JackAST import (LetStatement, IfStatement, WhileStatement,
+                     IntegerConstant, KeywordConstant, VarRef, UnaryOp,
+                     BinaryOp)
+from CodeGenerator import HasCalls
+import keyword
+
+# The names a generated module defines or imports besides the
+# program's: runtime helpers, and the class of its objects
+runtime_names = ['Divide', 'Equal', 'Literal', 'Object']
+
+# Keeps a Python integer in the 16-bit two's complement range, as
+# ConstantFolder.Wrap does, without a call
+wrap_format = "((({0}) + 32768 & 65535) - 32768)"
+
+arithmetic_formats = {'+': wrap_format.format("{0} + {1}"),
+                      '-': wrap_format.format("{0} - {1}"),
+                      '*': wrap_format.format("{0} * {1}"),
+                      '/': "Divide({0}, {1})",
+                      '&': "({0} & {1})",
+                      '|': "({0} | {1})"}
+
+comparison_symbols = {'<': '<', '>': '>', '=': '=='}
+
+numeric_types = ["int", "char", "boolean"]
+
+indentation = "    "
+
+
+def Identifier(name):
+    """
+    A Jack name as a Python name: Jack names can be Python keywords.
+    """
+    if keyword.iskeyword(name) or name in ("None", "True", "False"):
+        return name + "_"
+    return name
+
+
+def LocalName(name):
+    """
+    The Python name of a local or parameter. Temps the optimizations add
+    start with $, which Jack names can't contain.
+    """
+    if name.startswith("$"):
+        return "t_" + name[1:]
+    return "l_" + name
+
+
+def AssignedStatics(statements, statics):
+    """
+    Returns the statics the statements assign.
+    """
+    assigned = set()
+    for statement in statements:
+        if isinstance(statement, LetStatement):
+            if statement.index is None and statement.name in statics:
+                assigned.add(statement.name)
+        elif isinstance(statement, IfStatement):
+            assigned |= AssignedStatics(statement.then_statements, statics)
+            assigned |= AssignedStatics(statement.else_statements or [],
+                                        statics)
+        elif isinstance(statement, WhileStatement):
+            assigned |= AssignedStatics(statement.statements, statics)
+    return assigned
+
+
+class PythonGenerator(object):
+    """
+    Generates a Python module from the AST of one class, for the Python
+    backend. Subroutines become module functions named after them
+    (methods take the object first, as in the VM), fields become slots
+    of the module's Object class, and statics become module variables.
+    Every arithmetic result is wrapped to 16 bits, comparisons give -1
+    or 0, and everything is evaluated in the VM's order, so programs
+    compute what their VM code does. Program classes are imported as
+    modules; the other classes come from PythonRuntime's host OS.
+
+    Objects and arrays are Python objects rather than addresses, so
+    programs that compute with addresses (e.g. arrays used as objects,
+    or Memory.peek of an object's fields) need the VM backend.
+    """
+
+    def __init__(self, class_symbol_tables):
+        self.class_symbol_tables = class_symbol_tables
+        self.lines = []
+        self.level = 0
+        self.used_classes = set()
+        self.current_class_name = None
+        self.local_types = None  # {local or parameter name: type}
+
+    def Visit(self, node):
+        return getattr(self, "Visit" + node.__class__.__name__)(node)
+
+    def VisitStatements(self, statements):
+        if not statements:
+            self.WriteLine("pass")
+        for statement in statements:
+            self.Visit(statement)
+
+    def VisitClassNode(self, node):
+        self.current_class_name = node.name
+        statics = [name for var_dec in node.class_vars
+                   if var_dec.kind == "static" for name in var_dec.names]
+        fields = [name for var_dec in node.class_vars
+                  if var_dec.kind == "field" for name in var_dec.names]
+
+        for name in statics:
+            self.WriteLine("s_{0} = 0".format(name))
+        self.WriteLine("")
+        self.WriteLine("")
+        self.WriteLine("class Object(object):")
+        self.level += 1
+        self.WriteLine("__slots__ = ({0})".format(
+            "".join("'f_{0}', ".format(name) for name in fields).rstrip()))
+        if fields:
+            self.WriteLine("")
+            self.WriteLine("def __init__(self):")
+            self.level += 1
+            for name in fields:
+                self.WriteLine("self.f_{0} = 0".format(name))
+            self.level -= 1
+        self.level -= 1
+
+        for subroutine in node.subroutines:
+            self.WriteLine("")
+            self.WriteLine("")
+            self.VisitSubroutineNode(subroutine, statics)
+
+        names = set(Identifier(subroutine.name)
+                    for subroutine in node.subroutines)
+        taken = names & (set(runtime_names) | self.used_classes)
+        if taken:
+            raise Exception("{0}.{1} can't be translated to Python: the "
+                            "name is taken".format(node.name,
+                                                   sorted(taken)[0]))
+
+        header = ["from PythonRuntime import {0}".format(
+            ", ".join(runtime_names[:-1]))]
+        for class_name in sorted(self.used_classes):
+            if class_name in self.class_symbol_tables:
+                header.append("import {0}".format(class_name))
+            else:
+                header.append("from PythonRuntime import {0}".
+                              format(class_name))
+        if statics:
+            header.append("")
+        return header + self.lines
+
+    def VisitSubroutineNode(self, node, statics):
+        self.local_types = {}
+        parameters = []
+        if node.kind == "method":
+            parameters.append("this")
+        for varType, name in node.parameters:
+            self.local_types[name] = varType
+            parameters.append(LocalName(name))
+
+        self.WriteLine("def {0}({1}):".format(Identifier(node.name),
+                                             ", ".join(parameters)))
+        self.level += 1
+        assigned = AssignedStatics(node.statements, statics)
+        if assigned:
+            self.WriteLine("global {0}".format(
+                ", ".join("s_" + name for name in sorted(assigned))))
+        if node.kind == "constructor":
+            self.WriteLine("this = Object()")
+        for var_dec in node.local_vars:
+            for name in var_dec.names:
+                self.local_types[name] = var_dec.type
+                self.WriteLine("{0} = 0".format(LocalName(name)))
+        self.VisitStatements(node.statements)
+        self.level -= 1
+
+    def VisitLetStatement(self, node):
+        target = self.Variable(node.name)
+        if node.index is None:
+            self.WriteLine("{0} = {1}".format(target, self.Visit(node.value)))
+        elif HasCalls(node.index) or HasCalls(node.value):
+            # Python would evaluate the value first; the VM evaluates the
+            # index, then the array, then the value
+            self.WriteLine("t_index = {0}".format(self.Visit(node.index)))
+            self.WriteLine("t_array = {0}".format(target))
+            self.WriteLine("t_array[t_index] = {0}".
+                           format(self.Visit(node.value)))
+        else:
+            self.WriteLine("{0}[{1}] = {2}".format(target,
+                                                   self.Visit(node.index),
+                                                   self.Visit(node.value)))
+
+    def VisitIfStatement(self, node):
+        self.WriteLine("if {0}:".format(self.Condition(node.condition)))
+        self.level += 1
+        self.VisitStatements(node.then_statements)
+        self.level -= 1
+        if node.else_statements:
+            self.WriteLine("else:")
+            self.level += 1
+            self.VisitStatements(node.else_statements)
+            self.level -= 1
+
+    def VisitWhileStatement(self, node):
+        self.WriteLine("while {0}:".format(self.Condition(node.condition,
+                                                          True)))
+        self.level += 1
+        self.VisitStatements(node.statements)
+        self.level -= 1
+
+    def VisitDoStatement(self, node):
+        self.WriteLine(self.Visit(node.call))
+
+    def VisitReturnStatement(self, node):
+        if node.value is not None:
+            self.WriteLine("return {0}".format(self.Visit(node.value)))
+        else:
+            self.WriteLine("return 0")
+
+    def Condition(self, node, loop=False):
+        """
+        An expression as a Python condition: true when it isn't 0, as the
+        VM's if tests it. The VM's while continues on not x being false,
+        so for a loop only -1 is true.
+        """
+        if isinstance(node, BinaryOp) and node.op in comparison_symbols and \
+                (node.op != '=' or self.IsNumeric(node.left) or
+                 self.IsNumeric(node.right)):
+            return "{0} {1} {2}".format(self.Visit(node.left),
+                                        comparison_symbols[node.op],
+                                        self.Visit(node.right))
+        if loop:
+            return "{0} == -1".format(self.Visit(node))
+        return "{0} != 0".format(self.Visit(node))
+
+    def IsNumeric(self, node):
+        """
+        Is the expression's value known to be a number rather than an
+        object or array?
+        """
+        if isinstance(node, (IntegerConstant, UnaryOp, BinaryOp)):
+            return True
+        if isinstance(node, KeywordConstant):
+            return node.keyword != "this"
+        if isinstance(node, VarRef):
+            return self.VariableType(node.name) in numeric_types
+        return False
+
+    def VisitBinaryOp(self, node):
+        left = self.Visit(node.left)
+        right = self.Visit(node.right)
+        if node.op in arithmetic_formats:
+            return arithmetic_formats[node.op].format(left, right)
+        if node.op == '=' and not (self.IsNumeric(node.left) or
+                                   self.IsNumeric(node.right)):
+            return "Equal({0}, {1})".format(left, right)
+        return "(-1 if {0} {1} {2} else 0)".format(
+            left, comparison_symbols[node.op], right)
+
+    def VisitUnaryOp(self, node):
+        operand = self.Visit(node.operand)
+        if node.op == '-':
+            return wrap_format.format("-" + operand)
+        return "(~{0})".format(operand)
+
+    def VisitIntegerConstant(self, node):
+        if node.value < 0:
+            return "({0})".format(node.value)
+        return str(node.value)
+
+    def VisitStringConstant(self, node):
+        self.used_classes.add("String")
+        return "Literal(String, {0!r})".format(node.value)
+
+    def VisitKeywordConstant(self, node):
+        return {"true": "-1", "false": "0", "null": "0",
+                "this": "this"}[node.keyword]
+
+    def VisitVarRef(self, node):
+        return self.Variable(node.name)
+
+    def VisitArrayRef(self, node):
+        return "{0}[{1}]".format(self.Variable(node.name),
+                                 self.Visit(node.index))
+
+    def VisitSubroutineCall(self, node):
+        arguments = []
+        if node.prefix is not None:
+            variable_type = self.VariableType(node.prefix)
+            if variable_type is not None:
+                # varName.subName is a method call on the variable
+                arguments.append(self.Variable(node.prefix))
+                class_name = variable_type
+            else:
+                class_name = node.prefix
+        else:
+            class_name = self.current_class_name
+            entry = self.ClassEntry(node.name)
+            if entry is None or entry.type == "method":
+                arguments.append("this")
+
+        arguments += [self.Visit(argument) for argument in node.arguments]
+        function = Identifier(node.name)
+        if class_name != self.current_class_name:
+            self.used_classes.add(class_name)
+            function = "{0}.{1}".format(class_name, function)
+        return "{0}({1})".format(function, ", ".join(arguments))
+
+    def ClassEntry(self, name):
+        table = self.class_symbol_tables.get(self.current_class_name)
+        return table.GetEntry(name) if table is not None else None
+
+    def VariableType(self, name):
+        """
+        Returns the type of a local, parameter, field or static, or None
+        if there is no such variable.
+        """
+        if name in self.local_types:
+            return self.local_types[name]
+        entry = self.ClassEntry(name)
+        if entry is not None and entry.category in (Categories.FIELD,
+                                                    Categories.STATIC):
+            return entry.type
+        return None
+
+    def Variable(self, name):
+        if name in self.local_types:
+            return LocalName(name)
+        entry = self.ClassEntry(name)
+        if entry is not None and entry.category == Categories.FIELD:
+            return "this.f_" + name
+        if entry is not None and entry.category == Categories.STATIC:
+            return "s_" + name
+        raise Exception("Unknown variable " + name)
+
+    def WriteLine(self, line):
+        self.lines.append(indentation * self.level + line if line else "")
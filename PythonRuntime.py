@@ -0,0 +1,355 @@
+from ConstantFolder import Wrap, Divide
+import sys
+import os
+import argparse
+
+# Characters of the Jack character set beyond ASCII
+new_line = 128
+back_space = 129
+
+
+class Halt(Exception):
+    """
+    Raised by Sys.halt.
+    """
+
+
+def Equal(x, y):
+    """
+    Jack's =, for values that may be objects or arrays: those are equal
+    only to themselves (a list's == would compare the entries).
+    """
+    if isinstance(x, int) and isinstance(y, int):
+        return -1 if x == y else 0
+    return -1 if x is y else 0
+
+
+def Literal(string_class, text):
+    """
+    A new String holding a string literal, built as the VM code builds
+    it, with string_class (the program's own String class, if it has
+    one).
+    """
+    if string_class is String:
+        string = String()
+        string.capacity = len(text)
+        string.chars = [ord(c) for c in text]
+        return string
+    string = string_class.new(len(text))
+    for c in text:
+        string = string_class.appendChar(string, ord(c))
+    return string
+
+
+# Host implementations of the Jack OS classes. Their subroutines keep the
+# Jack names, and methods take the object first, as the generated code
+# calls them. Objects are Python objects rather than addresses, so
+# Memory.peek and Memory.poke reach a RAM of their own, which nothing else
+# is stored in.
+
+memory_size = 32768
+
+class Math(object):
+
+    @staticmethod
+    def multiply(x, y):
+        return Wrap(x * y)
+
+    @staticmethod
+    def divide(x, y):
+        if y == 0:
+            raise Exception("Division by zero")
+        return Divide(x, y)
+
+    @staticmethod
+    def min(x, y):
+        return min(x, y)
+
+    @staticmethod
+    def max(x, y):
+        return max(x, y)
+
+    @staticmethod
+    def abs(x):
+        return Wrap(abs(x))
+
+    @staticmethod
+    def sqrt(x):
+        if x < 0:
+            raise Exception("Square root of a negative number")
+        return int(x ** 0.5)
+
+
+class Array(object):
+
+    @staticmethod
+    def new(size):
+        return [0] * max(size, 1)
+
+    @staticmethod
+    def dispose(array):
+        return 0
+
+
+class Memory(object):
+    ram = [0] * memory_size
+
+    @staticmethod
+    def alloc(size):
+        return [0] * max(size, 1)
+
+    @staticmethod
+    def deAlloc(block):
+        return 0
+
+    @staticmethod
+    def peek(address):
+        return Memory.ram[address]
+
+    @staticmethod
+    def poke(address, value):
+        Memory.ram[address] = value
+        return 0
+
+
+class String(object):
+    __slots__ = ('capacity', 'chars')
+
+    @staticmethod
+    def new(capacity):
+        string = String()
+        string.capacity = capacity
+        string.chars = []
+        return string
+
+    @staticmethod
+    def dispose(string):
+        return 0
+
+    @staticmethod
+    def length(string):
+        return len(string.chars)
+
+    @staticmethod
+    def charAt(string, index):
+        return string.chars[index]
+
+    @staticmethod
+    def setCharAt(string, index, c):
+        string.chars[index] = c
+        return 0
+
+    @staticmethod
+    def appendChar(string, c):
+        if len(string.chars) >= string.capacity:
+            raise Exception("String is full")
+        string.chars.append(c)
+        return string
+
+    @staticmethod
+    def eraseLastChar(string):
+        if string.chars:
+            string.chars.pop()
+        return 0
+
+    @staticmethod
+    def intValue(string):
+        text = ''.join(chr(c) for c in string.chars)
+        digits = len(text) - len(text.lstrip('-'))
+        while digits < len(text) and text[digits].isdigit():
+            digits += 1
+        try:
+            return Wrap(int(text[:digits]))
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def setInt(string, value):
+        string.chars = []
+        for c in str(value):
+            String.appendChar(string, ord(c))
+        return 0
+
+    @staticmethod
+    def newLine():
+        return new_line
+
+    @staticmethod
+    def backSpace():
+        return back_space
+
+    @staticmethod
+    def doubleQuote():
+        return ord('"')
+
+
+class Output(object):
+    stream = sys.stdout
+
+    @staticmethod
+    def init():
+        return 0
+
+    @staticmethod
+    def moveCursor(row, column):
+        return 0
+
+    @staticmethod
+    def printChar(c):
+        if c == new_line:
+            Output.stream.write('\n')
+        elif c == back_space:
+            Output.stream.write('\b')
+        elif 0 <= c < 256:
+            Output.stream.write(chr(c))
+        return 0
+
+    @staticmethod
+    def printString(string):
+        for c in string.chars:
+            Output.printChar(c)
+        return 0
+
+    @staticmethod
+    def printInt(value):
+        Output.stream.write(str(value))
+        return 0
+
+    @staticmethod
+    def println():
+        return Output.printChar(new_line)
+
+    @staticmethod
+    def backSpace():
+        return Output.printChar(back_space)
+
+
+class Screen(object):
+    """
+    Draws nothing; programs run headless.
+    """
+
+    @staticmethod
+    def init():
+        return 0
+
+    @staticmethod
+    def clearScreen():
+        return 0
+
+    @staticmethod
+    def setColor(color):
+        return 0
+
+    @staticmethod
+    def drawPixel(x, y):
+        return 0
+
+    @staticmethod
+    def drawLine(x1, y1, x2, y2):
+        return 0
+
+    @staticmethod
+    def drawRectangle(x1, y1, x2, y2):
+        return 0
+
+    @staticmethod
+    def drawCircle(x, y, r):
+        return 0
+
+
+class Keyboard(object):
+    """
+    Never has a key pressed; reads lines from inputs, then from stdin.
+    """
+    inputs = []
+
+    @staticmethod
+    def init():
+        return 0
+
+    @staticmethod
+    def keyPressed():
+        return 0
+
+    @staticmethod
+    def readChar():
+        if not Keyboard.inputs:
+            Keyboard.inputs.append(sys.stdin.readline().rstrip('\n'))
+        line = Keyboard.inputs[0]
+        if not line:
+            Keyboard.inputs.pop(0)
+            return new_line
+        Keyboard.inputs[0] = line[1:]
+        return ord(line[0])
+
+    @staticmethod
+    def readLine(message):
+        Output.printString(message)
+        if Keyboard.inputs:
+            line = Keyboard.inputs.pop(0)
+        else:
+            line = sys.stdin.readline().rstrip('\n')
+        Output.stream.write(line + '\n')  # Echoed as it is typed
+        return Literal(String, line)
+
+    @staticmethod
+    def readInt(message):
+        return String.intValue(Keyboard.readLine(message))
+
+
+class Sys(object):
+
+    @staticmethod
+    def init():
+        return 0
+
+    @staticmethod
+    def halt():
+        raise Halt()
+
+    @staticmethod
+    def error(code):
+        raise Exception("Sys.error {0}".format(code))
+
+    @staticmethod
+    def wait(duration):
+        return 0
+
+
+def RunProgram(path):
+    """
+    Imports the Python modules compiled into the directory path, and runs
+    the program from Sys.init if it has one, or Main.main.
+    """
+    sys.path.insert(0, os.path.abspath(path))
+    if os.path.exists(os.path.join(path, "Sys.py")):
+        entry = __import__("Sys").init
+    else:
+        entry = __import__("Main").main
+    try:
+        entry()
+    except Halt:
+        pass
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Run a Jack program compiled with --backend python")
+    parser.add_argument("inputPath",
+                        help="the directory of the compiled .py files")
+    parser.add_argument("--input", action="append", default=[],
+                        metavar="LINE",
+                        help="a line for the keyboard to read (may be "
+                             "repeated)")
+    options = parser.parse_args(args)
+
+    # Run with the module the generated code imports, not with __main__
+    import PythonRuntime
+    PythonRuntime.Keyboard.inputs = options.input
+    PythonRuntime.RunProgram(options.inputPath)
+    PythonRuntime.Output.stream.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
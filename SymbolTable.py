@@ -72,6 +72,15 @@ class SymbolTableEntry(object):
         if CategoryUtils.IsIndexed(self.category):
             self.segment = CategoryUtils.GetSegment(self.category)
 
+    def Describe(self):
+        """
+        Returns the entry as a plain [declaration keyword, type, index]
+        list, which SetCategory accepts back.
+        """
+        if self.category == Categories.SUBROUTINE:
+            return [self.type, self.type, self.index]
+        return [CategoryUtils.ToString(self.category), self.type, self.index]
+
 
 class SymbolTable(object):
 
@@ -90,7 +99,7 @@ class SymbolTable(object):
         return self.SymbolMap[name].index
 
     def GetEntry(self, name):
-        if name in self.SymbolMap.keys():
+        if name in self.SymbolMap:
             return self.SymbolMap[name]
         else:
             return None
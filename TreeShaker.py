@@ -0,0 +1,72 @@
+default_roots = ["Main.main"]
+
+
+def SplitFunctions(code):
+    """
+    Splits the VM code of a class into [(function name, lines)].
+    """
+    functions = []
+    for line in code:
+        words = line.split('//', 1)[0].split()
+        if words and words[0] == 'function':
+            functions.append((words[1], []))
+        if functions:
+            functions[-1][1].append(line)
+    return functions
+
+
+def Callees(lines):
+    callees = set()
+    for line in lines:
+        words = line.split('//', 1)[0].split()
+        if words and words[0] == 'call':
+            callees.add(words[1])
+    return callees
+
+
+class TreeShaker(object):
+    """
+    Drops the functions of a program that can't be reached from its
+    roots through the calls in the code. Jack has no function pointers,
+    so the static call graph is exact. removed maps every dropped
+    function to its number of lines.
+    """
+
+    def __init__(self, roots=None):
+        self.roots = roots or default_roots
+        self.removed = {}
+
+    def Shake(self, vm_code):
+        """
+        vm_code: {class name: [lines]} for the whole program. Returns the
+        same for the reachable functions; classes left empty are gone.
+        """
+        functions = {}
+        for class_name, code in vm_code.items():
+            for name, lines in SplitFunctions(code):
+                functions[name] = lines
+
+        roots = [root for root in self.roots if root in functions]
+        if not roots:
+            raise Exception("Tree shaking needs one of these subroutines: " +
+                            ", ".join(self.roots))
+
+        reachable = set(roots)
+        pending = list(roots)
+        while pending:
+            for callee in Callees(functions[pending.pop()]):
+                if callee in functions and callee not in reachable:
+                    reachable.add(callee)
+                    pending.append(callee)
+
+        shaken = {}
+        for class_name, code in vm_code.items():
+            kept = []
+            for name, lines in SplitFunctions(code):
+                if name in reachable:
+                    kept.extend(lines)
+                else:
+                    self.removed[name] = len(lines)
+            if kept:
+                shaken[class_name] = kept
+        return shaken
@@ -0,0 +1,539 @@
+from ConstantFolder import Wrap, Divide
+import sys
+import os
+import argparse
+
+# The VM's registers and memory map
+SP, LCL, ARG, THIS, THAT = 0, 1, 2, 3, 4
+temp_base = 5
+static_base = 16
+stack_base = 256
+heap_base = 2048
+screen_base = 16384
+memory_size = 32768
+
+default_max_steps = 10 ** 7
+
+# Characters of the Jack character set beyond ASCII
+new_line = 128
+back_space = 129
+
+binary_operations = {'add': lambda x, y: Wrap(x + y),
+                     'sub': lambda x, y: Wrap(x - y),
+                     'and': lambda x, y: x & y,
+                     'or': lambda x, y: x | y,
+                     'eq': lambda x, y: -1 if x == y else 0,
+                     'gt': lambda x, y: -1 if x > y else 0,
+                     'lt': lambda x, y: -1 if x < y else 0}
+
+
+class Halt(Exception):
+    """
+    Raised by Sys.halt, and when the program's entry function returns.
+    """
+
+
+class FunctionProfile(object):
+    """
+    The cost of one function: how many times it was called, the VM
+    instructions it ran itself, and those it ran together with its
+    callees (counted once for recursive calls).
+    """
+    __slots__ = ('calls', 'self_steps', 'inclusive_steps')
+
+    def __init__(self):
+        self.calls = 0
+        self.self_steps = 0
+        self.inclusive_steps = 0
+
+
+def LoadProgram(path):
+    """
+    Reads a .vm file, or the .vm files of a directory, into
+    {class name: [lines]}.
+    """
+    if path.endswith(".vm"):
+        paths = [path]
+    else:
+        paths = [os.path.join(path, vm_file) for vm_file in
+                 sorted(os.listdir(path)) if vm_file.endswith(".vm")]
+
+    vm_code = {}
+    for vm_path in paths:
+        with open(vm_path) as vm_file:
+            class_name = os.path.basename(vm_path)[:-3]
+            vm_code[class_name] = vm_file.read().splitlines()
+    return vm_code
+
+
+class NativeOS(object):
+    """
+    Stand-ins for the Jack OS classes, written in Python so programs run
+    without the OS .vm files. Memory is a bump allocator that never
+    frees; Output collects the printed text; Screen draws nothing;
+    Keyboard reads lines from inputs and never has a key pressed.
+    Strings live on the heap as [capacity, length, characters...].
+    """
+
+    def __init__(self, memory, inputs=()):
+        self.memory = memory
+        self.inputs = list(inputs)
+        self.heap_free = heap_base
+        self.output = []
+        self.functions = {
+            'Math.multiply': lambda x, y: Wrap(x * y),
+            'Math.divide': self.MathDivide,
+            'Math.min': min,
+            'Math.max': max,
+            'Math.abs': lambda x: Wrap(abs(x)),
+            'Math.sqrt': self.MathSqrt,
+            'Memory.peek': lambda address: self.memory[address],
+            'Memory.poke': self.MemoryPoke,
+            'Memory.alloc': self.MemoryAlloc,
+            'Memory.deAlloc': lambda block: 0,
+            'Array.new': self.MemoryAlloc,
+            'Array.dispose': lambda array: 0,
+            'String.new': self.StringNew,
+            'String.dispose': lambda string: 0,
+            'String.length': lambda string: self.memory[string + 1],
+            'String.charAt': self.StringCharAt,
+            'String.setCharAt': self.StringSetCharAt,
+            'String.appendChar': self.StringAppendChar,
+            'String.eraseLastChar': self.StringEraseLastChar,
+            'String.intValue': self.StringIntValue,
+            'String.setInt': self.StringSetInt,
+            'String.newLine': lambda: new_line,
+            'String.backSpace': lambda: back_space,
+            'String.doubleQuote': lambda: ord('"'),
+            'Output.init': lambda: 0,
+            'Output.moveCursor': lambda row, column: 0,
+            'Output.printChar': self.OutputPrintChar,
+            'Output.printString': self.OutputPrintString,
+            'Output.printInt': self.OutputPrintInt,
+            'Output.println': lambda: self.OutputPrintChar(new_line),
+            'Output.backSpace': lambda: self.OutputPrintChar(back_space),
+            'Screen.init': lambda: 0,
+            'Screen.clearScreen': lambda: 0,
+            'Screen.setColor': lambda color: 0,
+            'Screen.drawPixel': lambda x, y: 0,
+            'Screen.drawLine': lambda x1, y1, x2, y2: 0,
+            'Screen.drawRectangle': lambda x1, y1, x2, y2: 0,
+            'Screen.drawCircle': lambda x, y, r: 0,
+            'Keyboard.init': lambda: 0,
+            'Keyboard.keyPressed': lambda: 0,
+            'Keyboard.readChar': self.KeyboardReadChar,
+            'Keyboard.readLine': self.KeyboardReadLine,
+            'Keyboard.readInt': self.KeyboardReadInt,
+            'Sys.wait': lambda duration: 0,
+            'Sys.halt': self.SysHalt,
+            'Sys.error': self.SysError}
+
+    def Output(self):
+        return ''.join(self.output)
+
+    def MathDivide(self, x, y):
+        if y == 0:
+            raise Exception("Division by zero")
+        return Divide(x, y)
+
+    def MathSqrt(self, x):
+        if x < 0:
+            raise Exception("Square root of a negative number")
+        return int(x ** 0.5)
+
+    def MemoryPoke(self, address, value):
+        self.memory[address] = value
+        return 0
+
+    def MemoryAlloc(self, size):
+        block = self.heap_free
+        self.heap_free += max(size, 1)
+        if self.heap_free > screen_base:
+            raise Exception("Heap overflow")
+        return block
+
+    def StringNew(self, capacity):
+        string = self.MemoryAlloc(capacity + 2)
+        self.memory[string] = capacity
+        self.memory[string + 1] = 0
+        return string
+
+    def StringValue(self, string):
+        length = self.memory[string + 1]
+        return ''.join(chr(self.memory[string + 2 + index])
+                       for index in range(length))
+
+    def StringCharAt(self, string, index):
+        return self.memory[string + 2 + index]
+
+    def StringSetCharAt(self, string, index, c):
+        self.memory[string + 2 + index] = c
+        return 0
+
+    def StringAppendChar(self, string, c):
+        length = self.memory[string + 1]
+        if length >= self.memory[string]:
+            raise Exception("String is full")
+        self.memory[string + 2 + length] = c
+        self.memory[string + 1] = length + 1
+        return string
+
+    def StringEraseLastChar(self, string):
+        if self.memory[string + 1] > 0:
+            self.memory[string + 1] -= 1
+        return 0
+
+    def StringIntValue(self, string):
+        text = self.StringValue(string)
+        digits = len(text) - len(text.lstrip('-'))
+        while digits < len(text) and text[digits].isdigit():
+            digits += 1
+        try:
+            return Wrap(int(text[:digits]))
+        except ValueError:
+            return 0
+
+    def StringSetInt(self, string, value):
+        self.memory[string + 1] = 0
+        for c in str(value):
+            self.StringAppendChar(string, ord(c))
+        return 0
+
+    def OutputPrintChar(self, c):
+        if c == new_line:
+            self.output.append('\n')
+        elif c == back_space:
+            if self.output:
+                self.output[-1] = self.output[-1][:-1]
+        elif 0 <= c < 256:
+            self.output.append(chr(c))
+        return 0
+
+    def OutputPrintString(self, string):
+        for c in self.StringValue(string):
+            self.OutputPrintChar(ord(c))
+        return 0
+
+    def OutputPrintInt(self, value):
+        self.output.append(str(value))
+        return 0
+
+    def KeyboardReadChar(self):
+        if not self.inputs:
+            return new_line
+        line = self.inputs[0]
+        if not line:
+            self.inputs.pop(0)
+            return new_line
+        self.inputs[0] = line[1:]
+        return ord(line[0])
+
+    def KeyboardReadLine(self, message):
+        self.OutputPrintString(message)
+        line = self.inputs.pop(0) if self.inputs else ''
+        self.output.append(line + '\n')  # Echoed as it is typed
+        string = self.StringNew(len(line))
+        for c in line:
+            self.StringAppendChar(string, ord(c))
+        return string
+
+    def KeyboardReadInt(self, message):
+        return self.StringIntValue(self.KeyboardReadLine(message))
+
+    def SysHalt(self):
+        raise Halt()
+
+    def SysError(self, code):
+        raise Exception("Sys.error {0}".format(code))
+
+
+class VMInterpreter(object):
+    """
+    Runs the VM code of a program, for a bounded number of steps (VM
+    instructions), and profiles it. Functions the program doesn't define
+    are run by NativeOS, so the OS .vm files aren't needed; a call to one
+    counts as a single step of the caller. The program starts at Sys.init
+    if it has one, and at Main.main otherwise.
+
+    profile maps every function called to its FunctionProfile; steps and
+    calls are the totals.
+    """
+
+    def __init__(self, vm_code, inputs=()):
+        """
+        vm_code: {class name: [lines] or VM code text}, e.g. what
+        CompileSources or LoadProgram return.
+        inputs: the lines the keyboard reads, in order.
+        """
+        self.memory = [0] * memory_size
+        self.os = NativeOS(self.memory, inputs)
+        self.code = []
+        self.functions = {}  # {function name: index of its first line}
+        self.next_static = static_base
+        for class_name in sorted(vm_code):
+            code = vm_code[class_name]
+            if isinstance(code, basestring):
+                code = code.splitlines()
+            self.Load(class_name, code)
+        self.Resolve()
+
+        self.profile = {}
+        self.steps = 0
+        self.calls = 0
+
+    def Load(self, class_name, lines):
+        """
+        Decodes the lines of a class into (command, argument 1, argument 2)
+        instructions, with statics given their address.
+        """
+        statics = {}
+        function = None
+        for line in lines:
+            words = line.split('//', 1)[0].split()
+            if not words:
+                continue
+            command = words[0]
+            if command == 'function':
+                function = words[1]
+                self.functions[function] = len(self.code)
+                self.code.append(('function', function, int(words[2])))
+            elif command in ('push', 'pop'):
+                segment, index = words[1], int(words[2])
+                if segment == 'static':
+                    if index not in statics:
+                        statics[index] = self.next_static
+                        self.next_static += 1
+                        if self.next_static > stack_base:
+                            raise Exception("Too many statics")
+                    index = statics[index]
+                if command == 'pop' and segment == 'constant':
+                    raise Exception("Can't pop to constant: " + line)
+                self.code.append((command, segment, index))
+            elif command in ('label', 'goto', 'if-goto'):
+                # Labels are local to their function
+                self.code.append((command, "{0}${1}".format(function,
+                                                            words[1]), None))
+            elif command == 'call':
+                self.code.append(('call', words[1], int(words[2])))
+            else:
+                self.code.append((command, None, None))
+
+    def Resolve(self):
+        """
+        Replaces the labels of jumps by line indices, and checks that
+        every function called exists.
+        """
+        labels = {}
+        for index, (command, label, unused) in enumerate(self.code):
+            if command == 'label':
+                labels[label] = index
+        for index, (command, target, argument) in enumerate(self.code):
+            if command in ('goto', 'if-goto'):
+                if target not in labels:
+                    raise Exception("Unknown label " + target)
+                self.code[index] = (command, target, labels[target])
+            elif command == 'call' and target not in self.functions and \
+                    target not in self.os.functions:
+                raise Exception("Unknown function " + target)
+
+    def Output(self):
+        return self.os.Output()
+
+    def Profile(self, function):
+        if function not in self.profile:
+            self.profile[function] = FunctionProfile()
+        return self.profile[function]
+
+    def Run(self, max_steps=default_max_steps):
+        """
+        Runs the program until it halts, or for max_steps. Returns whether
+        it halted.
+        """
+        entry = "Sys.init" if "Sys.init" in self.functions else "Main.main"
+        if entry not in self.functions:
+            raise Exception("The program has no Sys.init or Main.main")
+
+        memory = self.memory
+        code = self.code
+        functions = self.functions
+        natives = self.os.functions
+        segments = {'local': LCL, 'argument': ARG, 'this': THIS, 'that': THAT}
+
+        # Call the entry as Sys.init would be, returning nowhere
+        memory[SP] = stack_base + 5
+        memory[stack_base] = -1
+        memory[ARG] = stack_base
+        memory[LCL] = stack_base + 5
+        pc = functions[entry]
+        frames = [(entry, 0)]  # (function, steps when it was called)
+        active = {entry: 1}  # Frames of each function
+        self.Profile(entry).calls += 1
+        self.calls += 1
+        current = entry
+        switch_step = 0  # When the current function last started running
+
+        steps = 0
+        halted = True
+        try:
+            while True:
+                if steps >= max_steps:
+                    halted = False
+                    break
+                steps += 1
+                command, a, b = code[pc]
+                pc += 1
+
+                if command == 'push':
+                    if a == 'constant':
+                        value = b
+                    elif a in segments:
+                        value = memory[memory[segments[a]] + b]
+                    elif a == 'temp':
+                        value = memory[temp_base + b]
+                    elif a == 'pointer':
+                        value = memory[THIS + b]
+                    else:  # static
+                        value = memory[b]
+                    sp = memory[SP]
+                    memory[sp] = value
+                    memory[SP] = sp + 1
+                elif command == 'pop':
+                    sp = memory[SP] - 1
+                    memory[SP] = sp
+                    value = memory[sp]
+                    if a in segments:
+                        memory[memory[segments[a]] + b] = value
+                    elif a == 'temp':
+                        memory[temp_base + b] = value
+                    elif a == 'pointer':
+                        memory[THIS + b] = value
+                    else:  # static
+                        memory[b] = value
+                elif command in binary_operations:
+                    sp = memory[SP] - 1
+                    memory[sp - 1] = binary_operations[command](
+                        memory[sp - 1], memory[sp])
+                    memory[SP] = sp
+                elif command == 'neg':
+                    memory[memory[SP] - 1] = Wrap(-memory[memory[SP] - 1])
+                elif command == 'not':
+                    memory[memory[SP] - 1] = ~memory[memory[SP] - 1]
+                elif command == 'goto':
+                    pc = b
+                elif command == 'if-goto':
+                    sp = memory[SP] - 1
+                    memory[SP] = sp
+                    if memory[sp] != 0:
+                        pc = b
+                elif command == 'label':
+                    pass
+                elif command == 'function':
+                    sp = memory[SP]
+                    if sp + b >= heap_base:
+                        raise Exception("Stack overflow in " + a)
+                    for index in range(b):
+                        memory[sp + index] = 0
+                    memory[SP] = sp + b
+                elif command == 'call':
+                    self.calls += 1
+                    self.Profile(a).calls += 1
+                    sp = memory[SP]
+                    if a in functions:
+                        if sp + 5 >= heap_base:
+                            raise Exception("Stack overflow in " + a)
+                        memory[sp] = pc
+                        memory[sp + 1] = memory[LCL]
+                        memory[sp + 2] = memory[ARG]
+                        memory[sp + 3] = memory[THIS]
+                        memory[sp + 4] = memory[THAT]
+                        memory[ARG] = sp - b
+                        memory[LCL] = sp + 5
+                        memory[SP] = sp + 5
+                        pc = functions[a]
+
+                        self.Profile(current).self_steps += steps - switch_step
+                        current, switch_step = a, steps
+                        frames.append((a, steps))
+                        active[a] = active.get(a, 0) + 1
+                    else:
+                        value = natives[a](*memory[sp - b:sp])
+                        memory[sp - b] = Wrap(value)
+                        memory[SP] = sp - b + 1
+                elif command == 'return':
+                    frame = memory[LCL]
+                    return_address = memory[frame - 5]
+                    memory[memory[ARG]] = memory[memory[SP] - 1]
+                    memory[SP] = memory[ARG] + 1
+                    memory[THAT] = memory[frame - 1]
+                    memory[THIS] = memory[frame - 2]
+                    memory[ARG] = memory[frame - 3]
+                    memory[LCL] = memory[frame - 4]
+
+                    self.Profile(current).self_steps += steps - switch_step
+                    function, called = frames.pop()
+                    active[function] -= 1
+                    if not active[function]:  # Not counted by a caller
+                        self.Profile(function).inclusive_steps += \
+                            steps - called
+                    switch_step = steps
+                    if return_address == -1:
+                        raise Halt()
+                    current = frames[-1][0]
+                    pc = return_address
+                else:
+                    raise Exception("Unknown command " + command)
+        except Halt:
+            pass
+
+        # Charge the functions still running
+        self.Profile(current).self_steps += steps - switch_step
+        for function, called in frames:
+            if active[function]:
+                self.Profile(function).inclusive_steps += steps - called
+                active[function] = 0
+        self.steps = steps
+        return halted
+
+
+def PrintProfile(interpreter):
+    print "{0:<32} {1:>8} {2:>10} {3:>10}".format("function", "calls",
+                                                  "self", "inclusive")
+    for function, profile in sorted(interpreter.profile.items(),
+                                    key=lambda item: (-item[1].inclusive_steps,
+                                                      item[0])):
+        print "{0:<32} {1:>8} {2:>10} {3:>10}".format(
+            function, profile.calls, profile.self_steps,
+            profile.inclusive_steps)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Run the VM code of a Jack program and profile it")
+    parser.add_argument("inputPath",
+                        help="a .vm file or a directory of .vm files")
+    parser.add_argument("-s", "--steps", type=int, default=default_max_steps,
+                        metavar="N",
+                        help="stop after N VM instructions "
+                             "(default %(default)s)")
+    parser.add_argument("--input", action="append", default=[],
+                        metavar="LINE",
+                        help="a line for the keyboard to read (may be "
+                             "repeated)")
+    parser.add_argument("-p", "--profile", action="store_true",
+                        help="print the cost of every function")
+    options = parser.parse_args(args)
+
+    interpreter = VMInterpreter(LoadProgram(options.inputPath), options.input)
+    halted = interpreter.Run(options.steps)
+    output = interpreter.Output()
+    if output:
+        print output
+    print "{0} steps, {1} calls{2}".format(
+        interpreter.steps, interpreter.calls,
+        "" if halted else " (stopped at the step limit)")
+    if options.profile:
+        PrintProfile(interpreter)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,30 @@
+from JackTokenizer import replaceUnsafeXmlSafeChars
+
+
+class XmlWriter(object):
+    """
+    Streams the parse tree of a class as indented XML, through a large
+    write buffer.
+    """
+
+    def __init__(self, path, buffer_size=1 << 16):
+        self.file = open(path, 'w', buffer_size)
+        self.indent_level = 0
+
+    def EnterScope(self, name):
+        self.Output("<{0}>".format(name))
+        self.indent_level += 1
+
+    def ExitScope(self, name):
+        self.indent_level -= 1
+        self.Output("</{0}>".format(name))
+
+    def OutputTag(self, tag, value):
+        self.Output("<{0}> {1} </{0}>".
+                    format(tag, replaceUnsafeXmlSafeChars(str(value))))
+
+    def Output(self, text):
+        self.file.write(("  " * self.indent_level) + text + '\n')
+
+    def close(self):
+        self.file.close()